@@ -0,0 +1,245 @@
+"""
+Admission control of the web requests.
+Exports fan out into many upstream requests, so only a limited number of them runs
+at the same time per worker, and per user. Further requests wait in a bounded queue
+for a while and are turned away with a 429 when it is full. Interactive requests
+(e.g. RFID tag lookups) are granted before waiting exports, and a few slots are
+kept free of exports for them.
+"""
+import asyncio
+import functools
+import math
+import time
+
+from collections import deque
+from collections.abc import Callable
+
+from quart import make_response, request
+from quart.wrappers.response import IterableBody
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+LANES = (INTERACTIVE, BULK)
+
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_MAX_PER_USER = 2
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_QUEUE_TIMEOUT = 15.0
+# slots exports never take, an interactive request waits for a slot at most this long
+DEFAULT_INTERACTIVE_RESERVE = 2
+# weight of the newest request in the average duration of a lane
+DURATION_SMOOTHING = 0.2
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is turned away, the client should retry later"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """
+    Slot of an admitted request, released exactly once"""
+
+    def __init__(self, controller: "AdmissionController", user: str,
+                 lane: str):
+        self._controller = controller
+        self.user = user
+        self.lane = lane
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        """Return the slot"""
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(self)
+
+
+class AdmissionController:
+    """
+    Global and per user limit of running requests with a bounded wait queue"""
+
+    def __init__(self,
+                 max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 max_per_user: int = DEFAULT_MAX_PER_USER,
+                 queue_size: int = DEFAULT_QUEUE_SIZE,
+                 queue_timeout: float = DEFAULT_QUEUE_TIMEOUT,
+                 interactive_reserve: int = DEFAULT_INTERACTIVE_RESERVE):
+        """
+        Admission control
+        :param max_in_flight: requests running at the same time
+        :param max_per_user: requests of one user running at the same time
+        :param queue_size: requests waiting at the same time, further ones are rejected
+        :param queue_timeout: seconds a request waits before it is rejected
+        :param interactive_reserve: slots only interactive requests may take"""
+        self._max_in_flight = max_in_flight
+        self._max_per_user = max_per_user
+        self._queue_size = queue_size
+        self._queue_timeout = queue_timeout
+        self._max_bulk = max(1, max_in_flight - interactive_reserve)
+        self._running = {lane: 0 for lane in LANES}
+        self._per_user = {}
+        self._waiters = {lane: deque() for lane in LANES}
+        self._durations = {lane: 1.0 for lane in LANES}
+        # requests turned away, by reason
+        self.rejected = {"full": 0, "timeout": 0}
+
+    @property
+    def in_flight(self) -> int:
+        return sum(self._running.values())
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def retry_after(self, lane: str) -> int:
+        """Estimate when a rejected request may get a slot
+        :param lane: lane of the request
+        :return: seconds, at least 1"""
+        waiting = self.queued + 1
+        return max(
+            1,
+            math.ceil(self._durations[lane] * waiting / self._max_in_flight))
+
+    def _may_run(self, user: str, lane: str) -> bool:
+        if self.in_flight >= self._max_in_flight:
+            return False
+        if lane == BULK and self._running[BULK] >= self._max_bulk:
+            return False
+        return self._per_user.get(user, 0) < self._max_per_user
+
+    def _grant(self, user: str, lane: str) -> Ticket:
+        self._running[lane] += 1
+        self._per_user[user] = self._per_user.get(user, 0) + 1
+        return Ticket(self, user, lane)
+
+    def _dispatch(self) -> None:
+        """Grant free slots to the waiting requests, interactive ones first
+        A request blocked by the limit of its user does not hold up the others."""
+        for lane in LANES:
+            waiters = self._waiters[lane]
+            for entry in list(waiters):
+                if self.in_flight >= self._max_in_flight:
+                    return
+                user, waiter = entry
+                if waiter.done():
+                    # timed out or cancelled while waiting
+                    waiters.remove(entry)
+                    continue
+                if self._may_run(user, lane):
+                    waiters.remove(entry)
+                    waiter.set_result(self._grant(user, lane))
+
+    async def acquire(self, user: str, lane: str = BULK) -> Ticket:
+        """Wait for a slot
+        :param user: key of the user, e.g. the client address
+        :param lane: INTERACTIVE or BULK
+        :return: Ticket object, release it when the request is done
+        :raises AdmissionRejected: if the queue is full or the wait timed out"""
+        if not self._waiters[lane] and self._may_run(user, lane):
+            return self._grant(user, lane)
+        if self.queued >= self._queue_size:
+            self.rejected["full"] += 1
+            raise AdmissionRejected("Too many requests waiting",
+                                    self.retry_after(lane))
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (user, waiter)
+        self._waiters[lane].append(entry)
+        # may run next to waiting requests blocked by the limit of their user
+        self._dispatch()
+        try:
+            async with asyncio.timeout(self._queue_timeout):
+                return await waiter
+        except BaseException as exc:
+            if waiter.done() and not waiter.cancelled():
+                # granted and timed out or cancelled at the same time
+                waiter.result().release()
+            elif entry in self._waiters[lane]:
+                self._waiters[lane].remove(entry)
+            if isinstance(exc, TimeoutError):
+                self.rejected["timeout"] += 1
+                raise AdmissionRejected("Timed out waiting for a slot",
+                                        self.retry_after(lane)) from exc
+            raise
+
+    def _release(self, ticket: Ticket) -> None:
+        seconds = time.monotonic() - ticket.started
+        self._durations[ticket.lane] += DURATION_SMOOTHING * (
+            seconds - self._durations[ticket.lane])
+        self._running[ticket.lane] -= 1
+        self._per_user[ticket.user] -= 1
+        if not self._per_user[ticket.user]:
+            del self._per_user[ticket.user]
+        self._dispatch()
+
+
+class ReleasingBody:
+    """
+    Streamed response body releasing a ticket (or lease) when sent or abandoned"""
+
+    def __init__(self, iterator, release: Callable[[], None]):
+        """
+        Wrap a response body
+        :param iterator: async iterator of the body
+        :param release: called when the body is done, possibly more than once"""
+        self._iterator = iterator
+        self._release = release
+
+    def __aiter__(self) -> "ReleasingBody":
+        return self
+
+    async def __anext__(self):
+        try:
+            return await anext(self._iterator)
+        except BaseException:
+            self._release()
+            raise
+
+    async def aclose(self) -> None:
+        # also called if the body was never iterated, e.g. on a disconnect
+        self._release()
+        aclose = getattr(self._iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def admitted(controller: AdmissionController,
+             lane: str,
+             user_header: str | None = None,
+             methods: tuple[str, ...] = ("POST", )):
+    """Decorator running an async Quart view only with a slot of the controller.
+    A streamed response holds the slot until its body is sent.
+    :param controller: AdmissionController of the worker
+    :param lane: INTERACTIVE or BULK
+    :param user_header: header naming the user, e.g. X-Forwarded-For behind a proxy,
+        the client address is used if empty
+    :param methods: methods admitted, other requests pass through
+    :raises AdmissionRejected: if the request is turned away"""
+
+    def decorator(view):
+
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            if request.method not in methods:
+                return await view(*args, **kwargs)
+            user = request.headers.get(user_header, "") if user_header else ""
+            user = user.split(",")[0].strip() or request.remote_addr or ""
+            ticket = await controller.acquire(user, lane)
+            try:
+                response = await make_response(await view(*args, **kwargs))
+                if isinstance(response.response, IterableBody):
+                    response.response.iter = ReleasingBody(
+                        response.response.iter, ticket.release)
+                    ticket = None
+                return response
+            finally:
+                if ticket is not None:
+                    ticket.release()
+
+        return wrapper
+
+    return decorator
@@ -1,96 +1,585 @@
-from flask import Flask, render_template, request, send_file, jsonify
-from chargeampsclient import Client
+from quart import Quart, render_template, request, send_file, jsonify, abort, Response, g
+from quart.wrappers.response import IterableBody
 from chargeampscfgparser import ChargeAmpsCfgParser
-from xlsxresultwriter import XlsxResult
-from datetime import datetime
-from utils.utils import get_or_create_encryption_key, decrypt, encrypt
+from datetime import datetime, timedelta
+from utils.utils import get_or_create_encryption_key, encrypt
+from profiler import ProfileStore, profiled, is_authorized, PROFILE_HEADER, PROFILE_QUERY_PARAM
+from admission import AdmissionController, AdmissionRejected, BULK, INTERACTIVE, ReleasingBody, admitted
+from watermarks import WatermarkStore, watermark_key
+from telemetry import RESOLUTIONS, TelemetryStore
+from events import EventBus, LiveState, MAX_CALLBACK_BYTES, STATUS_EVENT, parse_events
+from circuitbreaker import CircuitOpenError, partial_results, stale_results, track_stale
+from deadlines import DeadlineExceeded, set_deadline
+from archive import SessionArchive
+from typing import TYPE_CHECKING
+import asyncio
 import configparser
+import json
+import math
 import os
+import time
 from dotenv import load_dotenv
 
+# the API client, the writers and their dependencies (aiohttp, jwt, xlsxwriter, ...)
+# are imported by the handlers, so a worker starts without loading them
+if TYPE_CHECKING:
+    from chargeampsclient import Client
+    from tenants import TenantManager
+
 env_path = os.getenv("ENV_PATH", "/data/.env")
 load_dotenv(env_path)
 CFG_PATH = os.path.join(os.path.dirname(env_path), "cfg.ini")
+POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "32"))
+# bytes per chunk of a streamed xlsx export
+XLSX_CHUNK_SIZE = 64 * 1024
+# aiohttp (HTTP/1.1) or http2, see transport
+UPSTREAM_TRANSPORT = os.getenv("UPSTREAM_TRANSPORT", "aiohttp")
+# layout of the xlsx exports, empty uses the built-in layout
+XLSX_TEMPLATE = os.getenv(
+    "XLSX_TEMPLATE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "template_csts.xlsx"))
+# processes rendering the workbooks of an RFID bundle, 0 uses all cores
+BUNDLE_WORKERS = int(os.getenv("BUNDLE_WORKERS", "0"))
+# longest period of the telemetry and schedule queries, the hour rollups keep a month
+MAX_QUERY_HOURS = 24 * 31
+# seconds between two status polls of all charge points, 0 disables polling
+STATUS_POLL_INTERVAL = float(os.getenv("STATUS_POLL_INTERVAL", "0"))
+# seconds replaced clients wait for the requests still using them before closing
+CLIENT_DRAIN_TIMEOUT = float(os.getenv("CLIENT_DRAIN_TIMEOUT", "600"))
+# seconds of upstream requests per request, 0 disables the deadline
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "300"))
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")
+# shared secret of the callback URL, callbacks are refused if empty
+CALLBACK_TOKEN = os.getenv("CALLBACK_TOKEN")
+CALLBACK_HEADER = "X-Callback-Token"
+PROFILE_STORE = ProfileStore(
+    os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(env_path),
+                                          "profiles")),
+    int(os.getenv("PROFILE_RETENTION", "50")))
+ADMISSION = AdmissionController(
+    max_in_flight=int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "8")),
+    max_per_user=int(os.getenv("ADMISSION_MAX_PER_USER", "2")),
+    queue_size=int(os.getenv("ADMISSION_QUEUE_SIZE", "32")),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "15")),
+    interactive_reserve=int(os.getenv("ADMISSION_INTERACTIVE_RESERVE", "2")))
+# header naming the user behind a reverse proxy, e.g. X-Forwarded-For
+ADMISSION_USER_HEADER = os.getenv("ADMISSION_USER_HEADER")
+# completed months of sessions, filled by python archive.py
+SESSION_ARCHIVE = SessionArchive(
+    os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(env_path),
+                                          "archive")))
+WATERMARK_STORE = WatermarkStore(
+    os.path.join(os.path.dirname(env_path), "watermarks.json"))
+
+app = Quart(__name__)
+# exports of long periods take longer than the default of 60 seconds
+app.config["RESPONSE_TIMEOUT"] = None
+
+# one authenticated client per tenant and worker, owned by the serving lifespan
+tenant_manager = None
+shared_cache = None
+manager_lock = asyncio.Lock()
+# replaced tenant managers closing once their requests are done
+draining_managers = set()
+# measurements of all status requests of this worker
+TELEMETRY = TelemetryStore()
+status_poller = None
+# worker processes of the RFID bundles, started by the first bundle
+bundle_executor = None
+# pushed sessions and statuses of this worker, see events
+EVENT_BUS = EventBus()
+LIVE_STATE = LiveState()
+
+
+async def get_manager() -> "TenantManager":
+    """Get the tenant manager of the configured accounts
+    :return: TenantManager object"""
+    from cachestore import create_cache
+    from tenants import TenantManager
+    global tenant_manager, shared_cache
+    async with manager_lock:
+        if tenant_manager is None:
+            cfgParser = ChargeAmpsCfgParser(CFG_PATH)
+            if shared_cache is None:
+                shared_cache = create_cache(
+                    cfgParser.get_cache_data(os.path.dirname(env_path)))
+            tenant_manager = TenantManager(cfgParser.get_tenant_data(),
+                                           get_or_create_encryption_key(),
+                                           cache=shared_cache,
+                                           token_dir=os.path.dirname(env_path),
+                                           pool_size=POOL_SIZE,
+                                           telemetry=TELEMETRY,
+                                           transport=UPSTREAM_TRANSPORT)
+        return tenant_manager
+
+
+async def get_client(tenant: str | None = None) -> "Client":
+    """Get the client of a tenant, logging in on first use
+    :param tenant: name of the tenant, None for the only or the default tenant
+    :return: initialized Client object"""
+    manager = await get_manager()
+    tenant = manager.resolve(tenant)
+    if tenant not in manager.tenants:
+        abort(404)
+    # the clients stay open until the request and its streamed body are done
+    leases = g.setdefault("client_leases", {})
+    if manager not in leases:
+        leases[manager] = manager.lease()
+    return await manager.get_client(tenant)
+
+
+async def get_price(tenant: str | None = None) -> str:
+    """Get the price per kWh of a tenant
+    :param tenant: name of the tenant, None for the only or the default tenant
+    :return: price per kWh in cents"""
+    manager = await get_manager()
+    return manager.tenant_data(manager.resolve(tenant))["pricekWh"]
+
+
+async def reset_client() -> None:
+    """Replace all clients, the next request reads the config and logs in again
+    The old clients are closed once the requests using them are done."""
+    global tenant_manager
+    async with manager_lock:
+        retired, tenant_manager = tenant_manager, None
+    if retired is not None:
+        task = asyncio.create_task(retired.drain(CLIENT_DRAIN_TIMEOUT))
+        draining_managers.add(task)
+        task.add_done_callback(draining_managers.discard)
+
+
+def get_xlsx_template():
+    """Get the layout of the xlsx exports, the template is parsed once per worker
+    :return: XlsxTemplate object, None for the built-in layout"""
+    from xlsxtemplate import load_template
+    return load_template(XLSX_TEMPLATE) if XLSX_TEMPLATE else None
+
+
+@app.before_serving
+async def startup():
+    # parse the export template before the first export needs it
+    if XLSX_TEMPLATE:
+        await asyncio.to_thread(get_xlsx_template)
+    # log in (or reuse the stored token) and warm the cache before serving
+    if os.path.exists(CFG_PATH):
+        try:
+            manager = await get_manager()
+        except Exception:
+            app.logger.exception("Reading the tenants at startup failed")
+            return
+
+        async def prewarm(tenant: str) -> None:
+            try:
+                myclient = await manager.get_client(tenant)
+                await myclient.get_chargepoints()
+            except Exception:
+                # not fatal, the first request retries the login
+                app.logger.exception("Login of tenant %s at startup failed",
+                                     tenant)
+
+        await asyncio.gather(*(prewarm(tenant) for tenant in manager.tenants))
+
+    global status_poller
+    if STATUS_POLL_INTERVAL > 0:
+        status_poller = asyncio.create_task(poll_status())
+
+
+async def poll_status() -> None:
+    """Record the measurements of all charge points of all tenants"""
+    while True:
+        manager = await get_manager()
+        lease = manager.lease()
+        try:
+            for tenant in manager.tenants:
+                try:
+                    myclient = await manager.get_client(tenant)
+                    for chargePoint in await myclient.get_chargepoints():
+                        if LIVE_STATE.is_fresh(chargePoint.id):
+                            # callbacks keep this charge point up to date
+                            continue
+                        # the client appends the measurements to TELEMETRY
+                        await myclient.get_chargepoint_status(chargePoint.id)
+                except Exception:
+                    app.logger.exception("Status poll of tenant %s failed",
+                                         tenant)
+        finally:
+            lease.release()
+        await asyncio.sleep(STATUS_POLL_INTERVAL)
+
+
+@app.after_serving
+async def shutdown():
+    global shared_cache, status_poller, bundle_executor
+    if status_poller is not None:
+        status_poller.cancel()
+        await asyncio.gather(status_poller, return_exceptions=True)
+        status_poller = None
+    if bundle_executor is not None:
+        await asyncio.to_thread(bundle_executor.shutdown, cancel_futures=True)
+        bundle_executor = None
+    await reset_client()
+    await asyncio.gather(*draining_managers)
+    if shared_cache is not None:
+        await shared_cache.close()
+        shared_cache = None
+
+
+@app.before_request
+async def start_request():
+    track_stale()
+    # a disconnecting browser cancels the handler, the deadline bounds the rest
+    if REQUEST_DEADLINE > 0:
+        set_deadline(REQUEST_DEADLINE)
+
+
+@app.after_request
+async def flag_stale(response):
+    stale = stale_results()
+    if stale:
+        # served from the last known good responses during an upstream outage
+        response.headers["Warning"] = '110 - "Response is Stale"'
+        response.headers["X-Stale-Results"] = ", ".join(stale)
+    partial = partial_results()
+    if partial:
+        # e.g. a charge point of a fleet report did not answer
+        response.headers["X-Partial-Results"] = ", ".join(partial)
+    return response
+
+
+@app.after_request
+async def hold_client_leases(response):
+    leases = g.get("client_leases")
+    if leases and isinstance(response.response, IterableBody):
+        # a streamed export uses the clients until its body is sent
+        g.client_leases = {}
+
+        def release():
+            for lease in leases.values():
+                lease.release()
+
+        response.response.iter = ReleasingBody(response.response.iter, release)
+    return response
+
+
+@app.teardown_request
+async def release_client_leases(exc):
+    for lease in g.pop("client_leases", {}).values():
+        lease.release()
+
+
+@app.errorhandler(CircuitOpenError)
+async def upstream_unavailable(error):
+    retry_after = max(1, math.ceil(error.retry_at - time.monotonic()))
+    return jsonify({"error": "Charge Amps is not reachable, try again later."}), 503, {
+        "Retry-After": str(retry_after)
+    }
+
+
+@app.errorhandler(AdmissionRejected)
+async def too_many_requests(error):
+    return jsonify({"error": "Too many requests running, try again later."}), 429, {
+        "Retry-After": str(error.retry_after)
+    }
 
-app = Flask(__name__)
+
+@app.errorhandler(DeadlineExceeded)
+async def upstream_too_slow(error):
+    return jsonify({"error": "Charge Amps did not answer in time."}), 504
+
+
+async def list_tenants() -> list[str]:
+    """Get the tenants offered in the forms, empty before the first configuration"""
+    if not os.path.exists(CFG_PATH):
+        return []
+    try:
+        manager = await get_manager()
+    except KeyError:
+        # no USERDATA or TENANT section yet
+        return []
+    return manager.tenants
 
 
 @app.route("/", methods=["GET", "POST"])
+@admitted(ADMISSION, BULK, ADMISSION_USER_HEADER)
+@profiled(PROFILE_STORE, PROFILE_ADMIN_TOKEN)
 async def index():
-    global myclient
-    key = get_or_create_encryption_key()
     if request.method == "POST":
-        rfid = request.form["rfid"]
-        start_date = datetime.strptime(request.form["start_date"], "%Y-%m-%d")
-        end_date = datetime.strptime(request.form["end_date"], "%Y-%m-%d")
+        from csvresultwriter import CsvResult
+        from exportpipeline import ExportPipeline
+        from xlsxresultwriter import XlsxResult
+        form = await request.form
+        rfid = form["rfid"]
+        start_date = datetime.strptime(form["start_date"], "%Y-%m-%d")
+        end_date = datetime.strptime(form["end_date"], "%Y-%m-%d")
+        export_format = form.get("format", "xlsx")
+        tenant = form.get("tenant")
+        only_new = form.get("only_new") == "on"
         print(f"RFID: {rfid}, Start: {start_date}, End: {end_date}")
-        cfgParser = ChargeAmpsCfgParser(CFG_PATH)
-        userData = cfgParser.get_user_data()
-        general_data = cfgParser.get_general_data()
-        myclient = Client(decrypt(userData["email"], key),
-                          decrypt(userData["password"], key),
-                          userData["apiKey"], general_data["baseUrl"])
-        await myclient.init_session()
+        myclient = await get_client(tenant)
+        price = await get_price(tenant)
+        # the watermark of a tag must not depend on the format it was entered in
+        key_rfid = myclient.canonical_rfid(rfid) if rfid.strip() else None
+        if only_new and rfid.strip() and key_rfid is None:
+            return jsonify({
+                "error":
+                "Unknown RFID tag, enter it as hex to export only new sessions."
+            }), 400
+        # cards show the tag as hex, decimal or reversed decimal
+        rfid = myclient.resolve_rfid(rfid) or rfid.strip()
         chargePoints = await myclient.get_chargepoints()
         if chargePoints:
             chargePoint = chargePoints[0]
             connector_id = 1
-            charging_sessions = await myclient.get_rfid_chargingsessions(
-                charge_point_id=chargePoint.id,
-                connector_id=connector_id,
-                rfid=rfid,
-                start_time=start_date,
-                end_time=end_date)
-            result_writer = XlsxResult()
-            output = result_writer.gen_output_file(charging_sessions,
-                                                   general_data["pricekWh"])
-            await myclient.close_session()
-            return send_file(
-                output,
-                as_attachment=True,
-                download_name="charging_sessions.xlsx",
+            key = watermark_key(chargePoint.id, connector_id, key_rfid,
+                                (await get_manager()).resolve(tenant))
+            since = await WATERMARK_STORE.get(key) if only_new else None
+            pipeline = ExportPipeline(myclient,
+                                      charge_point_id=chargePoint.id,
+                                      connector_id=connector_id,
+                                      kwh_price=price,
+                                      rfid=rfid,
+                                      start_time=start_date,
+                                      end_time=end_date,
+                                      since=since,
+                                      archive=SESSION_ARCHIVE)
+
+            async def advance_watermark():
+                # only exports in this mode move the watermark, a plain export
+                # of an old range must not hide unbilled sessions
+                if only_new and pipeline.watermark is not None:
+                    await WATERMARK_STORE.advance(key, pipeline.watermark)
+
+            if export_format == "csv":
+
+                async def csv_chunks():
+                    async for chunk in CsvResult().iter_output_file(pipeline):
+                        yield chunk
+                    await advance_watermark()
+
+                return Response(csv_chunks(),
+                                mimetype="text/csv",
+                                headers={
+                                    "Content-Disposition":
+                                    "attachment; filename=charging_sessions.csv"
+                                })
+            result_writer = XlsxResult(get_xlsx_template())
+            output = await result_writer.gen_output_file_from_stream(
+                pipeline, price)
+            data = output.getvalue()
+
+            async def xlsx_chunks():
+                # like the CSV, the watermark moves once the whole file was sent
+                for offset in range(0, len(data), XLSX_CHUNK_SIZE):
+                    yield data[offset:offset + XLSX_CHUNK_SIZE]
+                await advance_watermark()
+
+            return Response(
+                xlsx_chunks(),
                 mimetype=
-                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
-    return render_template("index.html")
+                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                headers={
+                    "Content-Disposition":
+                    "attachment; filename=charging_sessions.xlsx",
+                    "Content-Length": str(len(data))
+                })
+    return await render_template("index.html", tenants=await list_tenants())
+
+
+@app.route("/rfid_report", methods=["POST"])
+@admitted(ADMISSION, BULK, ADMISSION_USER_HEADER)
+@profiled(PROFILE_STORE, PROFILE_ADMIN_TOKEN)
+async def rfid_report():
+    from rfidreport import aggregate_by_rfid
+    from xlsxresultwriter import XlsxResult
+    form = await request.form
+    month = datetime.strptime(form["month"], "%Y-%m")
+    # first day of the following month
+    next_month = (month + timedelta(days=32)).replace(day=1)
+    tenant = form.get("tenant")
+    myclient = await get_client(tenant)
+    price = await get_price(tenant)
+    charging_sessions = await myclient.get_fleet_chargingsessions(
+        start_time=month, end_time=next_month)
+    usages = aggregate_by_rfid(charging_sessions, price)
+    output = XlsxResult(get_xlsx_template()).gen_rfid_report(usages, price)
+    return await send_file(
+        output,
+        as_attachment=True,
+        attachment_filename=f"rfid_report_{month:%Y-%m}.xlsx",
+        mimetype=
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+
+@app.route("/rfid_bundle", methods=["POST"])
+@admitted(ADMISSION, BULK, ADMISSION_USER_HEADER)
+@profiled(PROFILE_STORE, PROFILE_ADMIN_TOKEN)
+async def rfid_bundle():
+    from rfidbundle import create_executor, iter_bundle
+    from rfidreport import aggregate_by_rfid
+    global bundle_executor
+    form = await request.form
+    month = datetime.strptime(form["month"], "%Y-%m")
+    # first day of the following month
+    next_month = (month + timedelta(days=32)).replace(day=1)
+    tenant = form.get("tenant")
+    myclient = await get_client(tenant)
+    price = await get_price(tenant)
+    charging_sessions = await myclient.get_fleet_chargingsessions(
+        start_time=month, end_time=next_month)
+    usages = aggregate_by_rfid(charging_sessions, price)
+    if bundle_executor is None:
+        bundle_executor = create_executor(BUNDLE_WORKERS or None)
+    return Response(iter_bundle(usages,
+                                float(price),
+                                bundle_executor,
+                                summary=form.get("summary") == "on",
+                                template_path=XLSX_TEMPLATE or None),
+                    mimetype="application/zip",
+                    headers={
+                        "Content-Disposition":
+                        f"attachment; filename=rfid_bundle_{month:%Y-%m}.zip"
+                    })
 
 
 @app.route("/get_rfid_tags", methods=["POST"])
+@admitted(ADMISSION, INTERACTIVE, ADMISSION_USER_HEADER)
+@profiled(PROFILE_STORE, PROFILE_ADMIN_TOKEN)
 async def get_rfid_tags():
-    key = get_or_create_encryption_key()
-    cfgParser = ChargeAmpsCfgParser(CFG_PATH)
-    userData = cfgParser.get_user_data()
-    general_data = cfgParser.get_general_data()
-    myclient = Client(decrypt(userData["email"], key),
-                      decrypt(userData["password"], key), userData["apiKey"],
-                      general_data["baseUrl"])
-    await myclient.init_session()
+    form = await request.form
+    myclient = await get_client(form.get("tenant"))
     chargePoints = await myclient.get_chargepoints()
     if chargePoints:
         chargePoint = chargePoints[0]
         rfid_tags = await myclient.get_registered_rfid_tags(chargePoint.id)
-        await myclient.close_session()
         return jsonify({"tags": rfid_tags})
-    await myclient.close_session()
     return jsonify({"error": "No charge points found."})
 
 
+@app.route("/lookup_rfid", methods=["POST"])
+async def lookup_rfid():
+    form = await request.form
+    myclient = await get_client(form.get("tenant"))
+    # answered from the tags of the login and of all sessions loaded so far
+    tag = myclient.describe_rfid(form["rfid"])
+    if tag is None:
+        return jsonify({"error": "Unknown RFID tag."}), 404
+    return jsonify(tag)
+
+
+def hours_arg() -> float:
+    """Read the period of a telemetry or schedule query
+    :return: hours from the hours query parameter (default: 24), at most MAX_QUERY_HOURS"""
+    try:
+        hours = float(request.args.get("hours", "24"))
+    except ValueError:
+        abort(400)
+    if not math.isfinite(hours) or hours <= 0:
+        abort(400)
+    return min(hours, MAX_QUERY_HOURS)
+
+
+@app.route("/telemetry/<charge_point_id>/<int:connector_id>", methods=["GET"])
+async def get_telemetry(charge_point_id, connector_id):
+    hours = hours_arg()
+    resolution = request.args.get("resolution", "minute")
+    if resolution not in RESOLUTIONS:
+        abort(400)
+    end_time = datetime.now()
+    start_time = end_time - timedelta(hours=hours)
+    phases = TELEMETRY.phases(charge_point_id, connector_id)
+    return jsonify({
+        "energyWh":
+        TELEMETRY.energy_wh(charge_point_id, connector_id, start_time,
+                            end_time),
+        "peakCurrent":
+        TELEMETRY.peak_current(charge_point_id, connector_id, start_time,
+                               end_time),
+        "curves": {
+            phase: TELEMETRY.curve(charge_point_id, connector_id, phase,
+                                   start_time, end_time, resolution)
+            for phase in phases
+        }
+    })
+
+
+@app.route("/schedule/<charge_point_id>/<int:connector_id>", methods=["GET"])
+async def get_schedule(charge_point_id, connector_id):
+    hours = hours_arg()
+    myclient = await get_client(request.args.get("tenant"))
+    index = await myclient.get_schedule_index([charge_point_id])
+    now = datetime.now().astimezone()
+    next_transition = index.next_transition(charge_point_id, connector_id,
+                                            now)
+    return jsonify({
+        "allowed":
+        index.is_allowed(charge_point_id, connector_id, now),
+        "nextTransition":
+        next_transition.isoformat() if next_transition else None,
+        "windows": [[start.isoformat(), end.isoformat()]
+                    for start, end in index.windows(
+                        charge_point_id, connector_id, now, now +
+                        timedelta(hours=hours))]
+    })
+
+
+@app.route("/callbacks", methods=["POST"])
+async def receive_callback():
+    token = request.headers.get(CALLBACK_HEADER) or request.args.get("token")
+    if not is_authorized(token, CALLBACK_TOKEN):
+        abort(403)
+    if (request.content_length or 0) > MAX_CALLBACK_BYTES:
+        abort(413)
+    # a chunked body has no content length, the limit holds while reading
+    body = bytearray()
+    async for chunk in request.body:
+        body += chunk
+        if len(body) > MAX_CALLBACK_BYTES:
+            abort(413)
+    try:
+        events = parse_events(json.loads(body))
+    except ValueError as exc:
+        # json.JSONDecodeError is a ValueError as well
+        return jsonify({"error": str(exc)}), 400
+    for event in events:
+        LIVE_STATE.apply(event)
+        if event.kind == STATUS_EVENT:
+            TELEMETRY.record_connector_status(event.data, event.received)
+        EVENT_BUS.publish(event)
+    return jsonify({"accepted": len(events)})
+
+
+@app.route("/profiles/<request_id>", methods=["GET"])
+async def get_profile(request_id):
+    token = request.headers.get(PROFILE_HEADER) or request.args.get(
+        PROFILE_QUERY_PARAM)
+    if not is_authorized(token, PROFILE_ADMIN_TOKEN):
+        abort(403)
+    collapsed = PROFILE_STORE.load(request_id)
+    if collapsed is None:
+        abort(404)
+    return Response(collapsed, mimetype="text/plain")
+
+
 @app.route("/config", methods=["GET"])
-def show_config_form():
-    return render_template("config.html")
+async def show_config_form():
+    return await render_template("config.html")
 
 
 @app.route("/generate_cfg", methods=["POST"])
-def generate_cfg():
-    email = request.form["email"]
-    password = request.form["password"]
-    api_key = request.form["api_key"]
+async def generate_cfg():
+    form = await request.form
+    email = form["email"]
+    password = form["password"]
+    api_key = form["api_key"]
 
     key = get_or_create_encryption_key()
     encrypted_email = encrypt(email, key)
     encrypted_password = encrypt(password, key)
 
+    # keep optional sections like CACHE
     config = configparser.ConfigParser()
+    config.read(CFG_PATH)
     config["USERDATA"] = {
         "email": encrypted_email,
         "password": encrypted_password,
@@ -104,6 +593,9 @@ def generate_cfg():
     with open(CFG_PATH, "w") as configfile:
         config.write(configfile)
 
+    # log in with the new credentials on the next request
+    await reset_client()
+
     return "✅ cfg.ini was created successfully!"
 
 
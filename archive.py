@@ -0,0 +1,669 @@
+"""
+Archive of completed charging sessions.
+Completed sessions are compacted into one columnar file per charge point and month of
+their start time. Readers memory map only the partitions of the requested charge
+points and months and decode only the requested columns of the requested rows, so
+analytics over years and re-exports of old months neither load everything nor ask
+the API again.
+
+The files use a small own layout instead of Arrow/Parquet, so the archive needs no
+extra dependency:
+
+    magic | header length (uint32) | JSON header | column blocks, 8 byte aligned
+
+Numbers and timestamps (microseconds since the epoch) are little endian int64/float64
+arrays, strings are int64 offsets into a UTF-8 block with an optional null mask.
+Rows are sorted by start time, a time range is found by bisection.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import mmap
+import os
+import re
+import sys
+import tempfile
+
+from array import array
+from collections.abc import Iterator
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING
+
+# dataclasses_json is loaded with the data classes, only when sessions are built
+if TYPE_CHECKING:
+    from chargeampsdata import ChargingSession
+
+MAGIC = b"CASARC01"
+FILE_SUFFIX = ".cols"
+DEFAULT_PARALLEL = 4
+NULL_TIME = -2**63
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# name and type of the stored ChargingSession fields: int64, float64, string,
+# timestamp; charge_point_id is the partition key
+COLUMNS = (
+    ("id", "q"),
+    ("connector_id", "q"),
+    ("user_id", "s"),
+    ("rfid", "s"),
+    ("rfidDec", "s"),
+    ("rfidDecReverse", "s"),
+    ("organisationId", "s"),
+    ("session_type", "s"),
+    ("total_consumption_kwh", "d"),
+    ("externalTransactionId", "s"),
+    ("externalId", "s"),
+    ("start_time", "t"),
+    ("end_time", "t"),
+)
+COLUMN_NAMES = tuple(name for name, _ in COLUMNS)
+_MONTH_FILE = re.compile(r"^(\d{4})-(\d{2})" + re.escape(FILE_SUFFIX) + "$")
+_INVALID_NAME_CHARS = re.compile(r"[^A-Za-z0-9._-]+")
+_BIG_ENDIAN = sys.byteorder == "big"
+
+_logger = logging.getLogger(__name__)
+
+
+def month_of(value: datetime) -> datetime:
+    """Get the first moment of the month of a time
+    :param value: datetime object
+    :return: naive datetime of the first day of the month"""
+    return datetime(value.year, value.month, 1)
+
+
+def next_month(month: datetime) -> datetime:
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def months(start: datetime, end: datetime) -> list[datetime]:
+    """Get the months overlapping a time range
+    :param start: start of the range
+    :param end: end of the range, exclusive
+    :return: list of naive datetimes of the first days"""
+    result = []
+    month = month_of(start)
+    while month < end.replace(tzinfo=None):
+        result.append(month)
+        month = next_month(month)
+    return result
+
+
+def to_micros(value: datetime | None) -> int:
+    """Convert a time to microseconds since the epoch, naive times count as UTC"""
+    if value is None:
+        return NULL_TIME
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(value: int, aware: bool) -> datetime | None:
+    if value == NULL_TIME:
+        return None
+    value = EPOCH + timedelta(microseconds=value)
+    return value if aware else value.replace(tzinfo=None)
+
+
+def _pack(kind: str, values: list) -> bytes:
+    numbers = array(kind, values)
+    if _BIG_ENDIAN:
+        numbers.byteswap()
+    return numbers.tobytes()
+
+
+def write_partition(path: str, charge_point_id: str,
+                    sessions: list["ChargingSession"]) -> None:
+    """Write the sessions of a partition, an existing file is replaced atomically
+    :param path: path of the partition file
+    :param charge_point_id: ID of the charge point
+    :param sessions: list of ChargingSession objects"""
+    sessions = sorted(sessions,
+                      key=lambda session:
+                      (to_micros(session.start_time), session.id))
+    blocks = []
+    size = 0
+
+    def add(data: bytes) -> list[int]:
+        nonlocal size
+        padding = -size % 8
+        blocks.append(b"\0" * padding + data)
+        size += padding
+        block = [size, len(data)]
+        size += len(data)
+        return block
+
+    columns = {}
+    for name, kind in COLUMNS:
+        values = [getattr(session, name) for session in sessions]
+        if kind in ("q", "d"):
+            columns[name] = {"type": kind, "data": add(_pack(kind, values))}
+        elif kind == "t":
+            columns[name] = {
+                "type": kind,
+                "aware": any(value is not None and value.tzinfo is not None
+                             for value in values),
+                "data": add(_pack("q", [to_micros(value) for value in values]))
+            }
+        else:
+            encoded = [(value or "").encode() for value in values]
+            offsets = [0]
+            for value in encoded:
+                offsets.append(offsets[-1] + len(value))
+            columns[name] = {
+                "type": kind,
+                "offsets": add(_pack("q", offsets)),
+                "data": add(b"".join(encoded))
+            }
+            if None in values:
+                columns[name]["nulls"] = add(
+                    bytes(value is None for value in values))
+    header = json.dumps({
+        "chargePointId": charge_point_id,
+        "rows": len(sessions),
+        # sessions of earlier months overlapping a range are found without reading
+        "lastEnd": max((to_micros(session.end_time) for session in sessions
+                        if session.end_time is not None),
+                       default=NULL_TIME),
+        "columns": columns
+    }).encode()
+    prefix = MAGIC + len(header).to_bytes(4, "little") + header
+    prefix += b"\0" * (-len(prefix) % 8)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(prefix)
+            f.writelines(blocks)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class Partition:
+    """
+    Memory mapped partition file, only the pages of the read columns are loaded"""
+
+    def __init__(self, path: str):
+        """
+        Open a partition file, close it when done
+        :param path: path of the partition file
+        :raises ValueError: if the file is no partition file"""
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+        if self._buffer[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is no session archive file")
+        size = int.from_bytes(self._buffer[len(MAGIC):len(MAGIC) + 4],
+                              "little")
+        start = len(MAGIC) + 4
+        header = json.loads(bytes(self._buffer[start:start + size]))
+        self._base = start + size + (-(start + size) % 8)
+        self.charge_point_id = header["chargePointId"]
+        self.rows = header["rows"]
+        self._columns = header["columns"]
+        self._last_end = header.get("lastEnd")
+
+    def __enter__(self) -> "Partition":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._buffer.release()
+        self._mmap.close()
+
+    def _block(self, block: list[int]) -> memoryview:
+        offset, length = block
+        return self._buffer[self._base + offset:self._base + offset + length]
+
+    def _numbers(self, block: list[int], kind: str, lo: int,
+                 hi: int) -> list:
+        with self._block(block) as raw:
+            if _BIG_ENDIAN:
+                numbers = array(kind, raw[lo * 8:hi * 8])
+                numbers.byteswap()
+                return numbers.tolist()
+            with raw.cast(kind) as numbers:
+                return numbers[lo:hi].tolist()
+
+    def last_end(self) -> int:
+        """Get the latest end time of the sessions
+        :return: microseconds since the epoch, NULL_TIME if there are no sessions"""
+        if self._last_end is None:
+            ends = self._numbers(self._columns["end_time"]["data"], "q", 0,
+                                 self.rows)
+            self._last_end = max(ends, default=NULL_TIME)
+        return self._last_end
+
+    def overlapping_rows(self, start: datetime, end: datetime) -> list[int]:
+        """Get the rows of the sessions overlapping a time range, like the API both
+        borders are included
+        :param start: start of the range
+        :param end: end of the range
+        :return: sorted list of row indices"""
+        begin = to_micros(start)
+        if self.rows == 0 or self.last_end() < begin:
+            return []
+        starts = self._numbers(self._columns["start_time"]["data"], "q", 0,
+                               self.rows)
+        hi = bisect.bisect_right(starts, to_micros(end))
+        ends = self._numbers(self._columns["end_time"]["data"], "q", 0, hi)
+        return [row for row, value in enumerate(ends) if value >= begin]
+
+    def row_range(self, start: datetime | None,
+                  end: datetime | None) -> tuple[int, int]:
+        """Get the rows starting in a time range
+        :param start: start of the range, None for the first row
+        :param end: end of the range, exclusive, None for the last row
+        :return: (first row, end row)"""
+        if start is None and end is None:
+            return 0, self.rows
+        starts = self._numbers(self._columns["start_time"]["data"], "q", 0,
+                               self.rows)
+        lo = 0 if start is None else bisect.bisect_left(starts, to_micros(start))
+        hi = self.rows if end is None else bisect.bisect_left(
+            starts, to_micros(end))
+        return lo, max(lo, hi)
+
+    def values(self, name: str, lo: int = 0, hi: int | None = None) -> list:
+        """Decode a column
+        :param name: name of the column, see COLUMN_NAMES
+        :param lo: first row
+        :param hi: end row, None for the last row
+        :return: list of values"""
+        hi = self.rows if hi is None else hi
+        column = self._columns[name]
+        kind = column["type"]
+        if kind in ("q", "d"):
+            return self._numbers(column["data"], kind, lo, hi)
+        if kind == "t":
+            return [
+                from_micros(value, column["aware"])
+                for value in self._numbers(column["data"], "q", lo, hi)
+            ]
+        offsets = self._numbers(column["offsets"], "q", lo, hi + 1)
+        with self._block(column["data"]) as data:
+            text = bytes(data[offsets[0]:offsets[-1]])
+        first = offsets[0]
+        values = [
+            text[begin - first:end - first].decode()
+            for begin, end in zip(offsets, offsets[1:])
+        ]
+        if "nulls" in column:
+            with self._block(column["nulls"]) as nulls:
+                for row, null in enumerate(nulls[lo:hi]):
+                    if null:
+                        values[row] = None
+        return values
+
+
+class SessionArchive:
+    """
+    Month partitioned columnar archive of completed charging sessions"""
+
+    def __init__(self, root: str):
+        """
+        Session archive
+        :param root: directory of the archive, one subdirectory per charge point"""
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        self._root = root
+
+    def _directory(self, charge_point_id: str) -> str:
+        return os.path.join(
+            self._root, _INVALID_NAME_CHARS.sub("_", charge_point_id))
+
+    def path(self, charge_point_id: str, month: datetime) -> str:
+        """Get the file of a partition
+        :param charge_point_id: ID of the charge point
+        :param month: any time in the month
+        :return: path of the partition file"""
+        return os.path.join(self._directory(charge_point_id),
+                            f"{month:%Y-%m}{FILE_SUFFIX}")
+
+    def charge_points(self) -> list[str]:
+        """Get the charge points with archived months
+        :return: list of charge point IDs"""
+        charge_point_ids = []
+        if not os.path.isdir(self._root):
+            return charge_point_ids
+        for name in sorted(os.listdir(self._root)):
+            for month in self._months(os.path.join(self._root, name))[:1]:
+                with Partition(
+                        os.path.join(self._root, name,
+                                     f"{month:%Y-%m}{FILE_SUFFIX}")) as part:
+                    charge_point_ids.append(part.charge_point_id)
+        return charge_point_ids
+
+    @staticmethod
+    def _months(directory: str) -> list[datetime]:
+        if not os.path.isdir(directory):
+            return []
+        result = []
+        for name in os.listdir(directory):
+            match = _MONTH_FILE.match(name)
+            if match:
+                result.append(datetime(int(match[1]), int(match[2]), 1))
+        return sorted(result)
+
+    def archived_months(self, charge_point_id: str) -> list[datetime]:
+        """Get the archived months of a charge point
+        :param charge_point_id: ID of the charge point
+        :return: sorted list of the first days of the months"""
+        return self._months(self._directory(charge_point_id))
+
+    def covers(self, charge_point_id: str, start: datetime | None,
+               end: datetime | None) -> bool:
+        """Check if all months of a time range and the month before are archived
+        Sessions overlapping the start of the range may have started in the month
+        before, only sessions running for more than a month are not looked for in
+        older months that are not archived.
+        :param charge_point_id: ID of the charge point
+        :param start: start of the range
+        :param end: end of the range, exclusive
+        :return: True if the range can be read from the archive"""
+        if start is None or end is None:
+            return False
+        archived = set(self.archived_months(charge_point_id))
+        previous = month_of(month_of(start) - timedelta(days=1))
+        return all(month in archived
+                   for month in [previous] + months(start, end))
+
+    def partitions(self,
+                   charge_point_ids: list[str] | None = None,
+                   start: datetime | None = None,
+                   end: datetime | None = None) -> list[str]:
+        """Get the partition files overlapping a time range
+        :param charge_point_ids: IDs of the charge points, default is all
+        :param start: start of the range, None for all months before end
+        :param end: end of the range, exclusive, None for all months after start
+        :return: list of paths"""
+        if charge_point_ids is None:
+            charge_point_ids = self.charge_points()
+        paths = []
+        for charge_point_id in charge_point_ids:
+            for month in self.archived_months(charge_point_id):
+                if start is not None and next_month(month) <= start.replace(
+                        tzinfo=None):
+                    continue
+                if end is not None and month >= end.replace(tzinfo=None):
+                    continue
+                paths.append(self.path(charge_point_id, month))
+        return paths
+
+    def scan(
+        self,
+        charge_point_ids: list[str] | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+        columns: tuple[str, ...] = COLUMN_NAMES,
+        connector_id: int | None = None
+    ) -> Iterator[tuple[str, dict[str, list]]]:
+        """Read columns of the sessions starting in a time range
+        Only the partitions of the range and only the given columns are read.
+        :param charge_point_ids: IDs of the charge points, default is all
+        :param start: start of the range, None for the beginning
+        :param end: end of the range, exclusive, None for the end
+        :param columns: names of the columns, see COLUMN_NAMES
+        :param connector_id: read only the sessions of this connector
+        :return: iterator over (charge point ID, dict of value lists by column) per
+            partition, in the order of the partitions"""
+        for path in self.partitions(charge_point_ids, start, end):
+            with Partition(path) as part:
+                lo, hi = part.row_range(start, end)
+                if lo == hi:
+                    continue
+                rows = None
+                if connector_id is not None:
+                    rows = [
+                        row for row, value in enumerate(
+                            part.values("connector_id", lo, hi))
+                        if value == connector_id
+                    ]
+                    if not rows:
+                        continue
+                result = {}
+                for name in columns:
+                    values = part.values(name, lo, hi)
+                    result[name] = values if rows is None else [
+                        values[row] for row in rows
+                    ]
+                yield part.charge_point_id, result
+
+    def sessions(self,
+                 charge_point_id: str,
+                 start: datetime | None = None,
+                 end: datetime | None = None,
+                 connector_id: int | None = None
+                 ) -> Iterator["ChargingSession"]:
+        """Read the sessions of a charge point starting in a time range
+        :param charge_point_id: ID of the charge point
+        :param start: start of the range, None for the beginning
+        :param end: end of the range, exclusive, None for the end
+        :param connector_id: read only the sessions of this connector
+        :return: iterator over ChargingSession objects sorted by start time"""
+        from chargeampsdata import ChargingSession
+
+        for charge_point_id, columns in self.scan([charge_point_id], start,
+                                                  end, COLUMN_NAMES,
+                                                  connector_id):
+            for values in zip(*columns.values()):
+                yield ChargingSession(charge_point_id=charge_point_id,
+                                      **dict(zip(columns, values)))
+
+    def overlapping(self,
+                    charge_point_id: str,
+                    start: datetime,
+                    end: datetime,
+                    connector_id: int | None = None
+                    ) -> list["ChargingSession"]:
+        """Read the sessions of a charge point overlapping a time range like the API
+        Unlike sessions, this includes the sessions that started before the range and
+        ended in it. Months whose sessions all ended before the range are not read.
+        :param charge_point_id: ID of the charge point
+        :param start: start of the range
+        :param end: end of the range
+        :param connector_id: read only the sessions of this connector
+        :return: list of ChargingSession objects sorted by start time"""
+        from chargeampsdata import ChargingSession
+
+        result = []
+        for month in self.archived_months(charge_point_id):
+            if month > end.replace(tzinfo=None):
+                break
+            with Partition(self.path(charge_point_id, month)) as part:
+                rows = part.overlapping_rows(start, end)
+                if not rows:
+                    continue
+                lo, hi = rows[0], rows[-1] + 1
+                columns = {
+                    name: part.values(name, lo, hi)
+                    for name in COLUMN_NAMES
+                }
+            for row in rows:
+                values = {
+                    name: column[row - lo]
+                    for name, column in columns.items()
+                }
+                if connector_id is None or values["connector_id"] == connector_id:
+                    result.append(
+                        ChargingSession(charge_point_id=charge_point_id,
+                                        **values))
+        return result
+
+    def write_month(self, charge_point_id: str, month: datetime,
+                    sessions: list["ChargingSession"]) -> int:
+        """Replace a partition with the completed sessions starting in its month
+        An empty partition marks a month without sessions as archived.
+        :param charge_point_id: ID of the charge point
+        :param month: any time in the month
+        :param sessions: list of ChargingSession objects, others are skipped
+        :return: number of archived sessions"""
+        month = month_of(month)
+        sessions = [
+            session for session in sessions
+            if session.charge_point_id == charge_point_id
+            and session.start_time is not None and session.end_time is not None
+            and month_of(session.start_time) == month
+        ]
+        write_partition(self.path(charge_point_id, month), charge_point_id,
+                        sessions)
+        return len(sessions)
+
+    def append(self, sessions: list["ChargingSession"]) -> int:
+        """Merge completed sessions into their partitions, newer copies win
+        :param sessions: list of ChargingSession objects, running ones are skipped
+        :return: number of written partitions"""
+        groups = {}
+        for session in sessions:
+            if session.start_time is None or session.end_time is None:
+                continue
+            key = (session.charge_point_id, month_of(session.start_time))
+            groups.setdefault(key, {})[session.id] = session
+        for (charge_point_id, month), group in groups.items():
+            merged = {
+                session.id: session
+                for session in self.sessions(charge_point_id, month,
+                                             next_month(month))
+            } if month in self.archived_months(charge_point_id) else {}
+            merged.update(group)
+            write_partition(self.path(charge_point_id, month),
+                            charge_point_id, list(merged.values()))
+        return len(groups)
+
+
+async def archive_months(client,
+                         archive: SessionArchive,
+                         first_month: datetime,
+                         last_month: datetime,
+                         charge_point_ids: list[str] | None = None,
+                         refresh: bool = False,
+                         parallel: int = DEFAULT_PARALLEL,
+                         now: datetime | None = None) -> dict[str, int]:
+    """Fetch completed months from the API into the archive
+    Months still receiving sessions are skipped, archived ones unless refresh is set.
+    :param client: initialized Client object
+    :param archive: SessionArchive object
+    :param first_month: any time in the first month
+    :param last_month: any time in the last month
+    :param charge_point_ids: IDs of the charge points, default is all owned
+    :param refresh: fetch archived months again
+    :param parallel: charge points fetched at the same time
+    :param now: current time, defaults to now
+    :return: number of archived months by charge point ID"""
+    from chargeampsclient import COMPLETED_SESSIONS_MARGIN
+
+    now = now or datetime.now()
+    if charge_point_ids is None:
+        charge_point_ids = [
+            charge_point.id for charge_point in await client.get_chargepoints()
+        ]
+    wanted = [
+        month for month in months(first_month, next_month(month_of(last_month)))
+        if next_month(month) < now - COMPLETED_SESSIONS_MARGIN
+    ]
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def archive_charge_point(charge_point_id: str) -> int:
+        archived = set(archive.archived_months(charge_point_id))
+        count = 0
+        async with semaphore:
+            for month in wanted:
+                if month in archived and not refresh:
+                    continue
+                sessions = await client.get_chargingsessions(
+                    charge_point_id, month, next_month(month))
+                rows = await asyncio.to_thread(archive.write_month,
+                                               charge_point_id, month,
+                                               sessions)
+                _logger.info("Archived %d sessions of %s in %s", rows,
+                             charge_point_id, f"{month:%Y-%m}")
+                count += 1
+        return count
+
+    counts = await asyncio.gather(*(archive_charge_point(charge_point_id)
+                                    for charge_point_id in charge_point_ids))
+    return dict(zip(charge_point_ids, counts))
+
+
+async def main(argv: list[str] | None = None) -> int:
+    """Run the archive command line
+    :param argv: command line arguments
+    :return: exit code"""
+    import argparse
+
+    from dotenv import load_dotenv
+
+    env_path = os.getenv("ENV_PATH", "/data/.env")
+    parser = argparse.ArgumentParser(
+        description="Archive completed months of charging sessions.")
+    parser.add_argument("--from",
+                        dest="first_month",
+                        required=True,
+                        type=lambda value: datetime.strptime(value, "%Y-%m"),
+                        help="first month, YYYY-MM")
+    parser.add_argument("--to",
+                        dest="last_month",
+                        type=lambda value: datetime.strptime(value, "%Y-%m"),
+                        help="last month, YYYY-MM, default is the last completed")
+    parser.add_argument("--charge-point",
+                        action="append",
+                        dest="charge_point_ids",
+                        help="charge point ID, default is all owned")
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help="fetch archived months again")
+    parser.add_argument("--archive-dir",
+                        default=os.getenv(
+                            "ARCHIVE_DIR",
+                            os.path.join(os.path.dirname(env_path),
+                                         "archive")),
+                        help="directory of the archive, shared with the web app")
+    parser.add_argument("--cfg",
+                        default=os.path.join(os.path.dirname(env_path),
+                                             "cfg.ini"),
+                        help="path of cfg.ini")
+    parser.add_argument("--tenant",
+                        help="account of a TENANT:<name> section, default is the only one")
+    args = parser.parse_args(argv)
+
+    load_dotenv(env_path)
+    from cachestore import create_cache
+    from chargeampscfgparser import ChargeAmpsCfgParser
+    from tenants import TenantManager
+    from utils.utils import get_or_create_encryption_key
+
+    key = get_or_create_encryption_key()
+    cfgParser = ChargeAmpsCfgParser(args.cfg)
+    tenants = cfgParser.get_tenant_data()
+    cache = create_cache(cfgParser.get_cache_data(os.path.dirname(env_path)))
+    manager = TenantManager(tenants,
+                            key,
+                            cache=cache,
+                            token_dir=os.path.dirname(env_path))
+    try:
+        tenant = manager.resolve(args.tenant)
+        if tenant not in tenants:
+            parser.error(f"unknown tenant {tenant}, configured are "
+                         f"{', '.join(tenants)}")
+        client = await manager.get_client(tenant)
+        counts = await archive_months(client,
+                                      SessionArchive(args.archive_dir),
+                                      args.first_month, args.last_month
+                                      or datetime.now(), args.charge_point_ids,
+                                      args.refresh)
+    finally:
+        await manager.close()
+        await cache.close()
+    for charge_point_id, count in counts.items():
+        print(f"{charge_point_id}: {count} months archived")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,336 @@
+"""
+Headless batch export for cron jobs.
+Runs a manifest of export jobs concurrently with one shared, logged in client and
+writes one xlsx or csv file per job, no web server needed.
+
+Manifest (JSON list of jobs):
+
+    [
+        {"rfid": "04A1B2C3", "start": "2025-01-01", "end": "2025-02-01", "format": "xlsx"},
+        {"charge_point_id": "2012345678M", "connector_id": 2, "start": "2025-01-01",
+         "end": "2025-02-01", "format": "csv", "name": "garage-january"},
+        {"rfid": "04A1B2C3", "start": "2025-01-01", "end": "2099-01-01", "only_new": true}
+    ]
+
+charge_point_id defaults to the first charge point, connector_id to 1, rfid to all
+tags and format to xlsx. Jobs with only_new export the sessions that ended since the
+last only_new run of the same charger, connector and tag (start is used for the
+first run), see watermarks.
+
+Usage:
+
+    python batchexport.py manifest.json --output-dir exports --workers 4
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+from collections.abc import AsyncIterable, AsyncIterator
+from dataclasses import dataclass
+from datetime import datetime
+
+from chargeampscfgparser import ChargeAmpsCfgParser, DEFAULT_TENANT
+from watermarks import WatermarkStore, watermark_key
+from xlsxtemplate import TEMPLATE_PATH, load_template
+
+DEFAULT_WORKERS = 4
+EXPORT_FORMATS = ("xlsx", "csv")
+INVALID_NAME_CHARS = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+@dataclass(frozen=True)
+class ExportJob:
+    """Class representing a single export of a manifest."""
+    name: str
+    start_time: datetime
+    end_time: datetime
+    export_format: str = "xlsx"
+    charge_point_id: str | None = None
+    connector_id: int = 1
+    rfid: str | None = None
+    only_new: bool = False
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ExportJob":
+        """Create a job from a manifest entry
+        :param data: manifest entry
+        :return: ExportJob object"""
+        export_format = data.get("format", "xlsx").lower()
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {export_format}")
+        start_time = datetime.strptime(data["start"], "%Y-%m-%d")
+        end_time = datetime.strptime(data["end"], "%Y-%m-%d")
+        rfid = data.get("rfid") or None
+        name = data.get("name") or (f"{rfid or 'all'}_{start_time:%Y-%m-%d}"
+                                    f"_{end_time:%Y-%m-%d}")
+        return cls(name=INVALID_NAME_CHARS.sub("_", name),
+                   start_time=start_time,
+                   end_time=end_time,
+                   export_format=export_format,
+                   charge_point_id=data.get("charge_point_id"),
+                   connector_id=int(data.get("connector_id", 1)),
+                   rfid=rfid,
+                   only_new=bool(data.get("only_new", False)))
+
+
+@dataclass(frozen=True)
+class JobResult:
+    """Class representing the outcome of an export job."""
+    job: ExportJob
+    path: str | None
+    rows: int
+    seconds: float
+    error: str | None = None
+
+
+def load_manifest(path: str) -> list[ExportJob]:
+    """Read the jobs of a manifest file
+    :param path: path of the JSON manifest
+    :return: list of ExportJob objects"""
+    with open(path, "r") as f:
+        entries = json.load(f)
+    jobs = [ExportJob.from_dict(entry) for entry in entries]
+    files = [f"{job.name}.{job.export_format}" for job in jobs]
+    duplicates = sorted({name for name in files if files.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate output files {', '.join(duplicates)}")
+    return jobs
+
+
+class _RowCounter:
+    """Counts the sessions passing through to the writer"""
+
+    def __init__(self, priced_sessions: AsyncIterable):
+        self.rows = 0
+        self._priced_sessions = priced_sessions
+
+    async def __aiter__(self) -> AsyncIterator:
+        async for priced in self._priced_sessions:
+            self.rows += 1
+            yield priced
+
+
+async def run_job(client,
+                  job: ExportJob,
+                  output_dir: str,
+                  kwh_price: float,
+                  watermarks: WatermarkStore | None = None,
+                  template=None,
+                  tenant: str = DEFAULT_TENANT) -> JobResult:
+    """Export a single job to the output directory
+    :param client: initialized Client object
+    :param job: ExportJob object
+    :param output_dir: directory of the export files
+    :param kwh_price: price per kWh in cents
+    :param watermarks: store of the only_new jobs
+    :param template: XlsxTemplate of the xlsx layout, None for the built-in layout
+    :param tenant: name of the tenant of the client, part of the watermark keys
+    :return: JobResult object"""
+    from exportpipeline import ExportPipeline
+
+    started = time.perf_counter()
+    charge_point_id = job.charge_point_id
+    if charge_point_id is None:
+        charge_points = await client.get_chargepoints()
+        if not charge_points:
+            raise ValueError("No charge points found.")
+        charge_point_id = charge_points[0].id
+    since = None
+    if job.only_new:
+        if watermarks is None:
+            raise ValueError("only_new needs a watermark store")
+        # the same key as the web app, whatever format the manifest uses
+        key_rfid = client.canonical_rfid(job.rfid) if job.rfid else None
+        if job.rfid and key_rfid is None:
+            raise ValueError(
+                f"Unknown RFID tag {job.rfid}, only_new needs it as hex")
+        key = watermark_key(charge_point_id, job.connector_id, key_rfid,
+                            tenant)
+        since = await watermarks.get(key)
+    pipeline = ExportPipeline(client,
+                              charge_point_id=charge_point_id,
+                              connector_id=job.connector_id,
+                              kwh_price=kwh_price,
+                              rfid=job.rfid,
+                              start_time=job.start_time,
+                              end_time=job.end_time,
+                              since=since)
+    counter = _RowCounter(pipeline)
+    path = os.path.join(output_dir, f"{job.name}.{job.export_format}")
+    # write to a temporary file, a failed job leaves no partial export behind
+    partial = path + ".part"
+    try:
+        if job.export_format == "csv":
+            from csvresultwriter import CsvResult
+            with open(partial, "wb") as f:
+                async for chunk in CsvResult().iter_output_file(counter):
+                    f.write(chunk)
+        else:
+            from xlsxresultwriter import XlsxResult
+            output = await XlsxResult(template).gen_output_file_from_stream(
+                counter, kwh_price)
+            with open(partial, "wb") as f:
+                f.write(output.getbuffer())
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    if job.only_new and pipeline.watermark is not None:
+        await watermarks.advance(key, pipeline.watermark)
+    return JobResult(job=job,
+                     path=path,
+                     rows=counter.rows,
+                     seconds=time.perf_counter() - started)
+
+
+async def run_batch(client,
+                    jobs: list[ExportJob],
+                    output_dir: str,
+                    kwh_price: float,
+                    workers: int = DEFAULT_WORKERS,
+                    watermarks: WatermarkStore | None = None,
+                    template=None,
+                    tenant: str = DEFAULT_TENANT) -> list[JobResult]:
+    """Run export jobs concurrently, a failing job does not stop the others
+    An only_new job of the same tag as an earlier one fails, both would export the
+    same sessions.
+    :param client: initialized Client object
+    :param jobs: list of ExportJob objects
+    :param output_dir: directory of the export files
+    :param kwh_price: price per kWh in cents
+    :param workers: maximum number of jobs running at the same time
+    :param watermarks: store of the only_new jobs
+    :param template: XlsxTemplate of the xlsx layout, None for the built-in layout
+    :param tenant: name of the tenant of the client, part of the watermark keys
+    :return: list of JobResult objects in manifest order"""
+    logger = logging.getLogger(__name__)
+    os.makedirs(output_dir, exist_ok=True)
+    semaphore = asyncio.Semaphore(workers)
+    # the tag in the form of the watermark keys, see run_job
+    incremental = set()
+    duplicates = set()
+    for index, job in enumerate(jobs):
+        if not job.only_new:
+            continue
+        rfid = job.rfid and (client.canonical_rfid(job.rfid) or job.rfid)
+        key = (job.charge_point_id, job.connector_id, rfid)
+        if key in incremental:
+            duplicates.add(index)
+        incremental.add(key)
+
+    async def run_guarded(index: int, job: ExportJob) -> JobResult:
+        if index in duplicates:
+            return JobResult(job=job,
+                             path=None,
+                             rows=0,
+                             seconds=0.0,
+                             error="Duplicate only_new job of the same tag")
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                return await run_job(client, job, output_dir, kwh_price,
+                                     watermarks, template, tenant)
+            except Exception as exc:
+                logger.exception("Export %s failed", job.name)
+                return JobResult(job=job,
+                                 path=None,
+                                 rows=0,
+                                 seconds=time.perf_counter() - started,
+                                 error=str(exc) or exc.__class__.__name__)
+
+    return await asyncio.gather(
+        *(run_guarded(index, job) for index, job in enumerate(jobs)))
+
+
+def format_report(results: list[JobResult], seconds: float) -> str:
+    """Format the per job timings
+    :param results: list of JobResult objects
+    :param seconds: wall time of the whole batch
+    :return: report text"""
+    width = max([len(result.job.name) for result in results] + [3])
+    lines = [f"{'job':<{width}}  {'rows':>6}  {'seconds':>8}  result"]
+    for result in results:
+        outcome = result.path if result.error is None else f"FAILED: {result.error}"
+        lines.append(f"{result.job.name:<{width}}  {result.rows:>6}  "
+                     f"{result.seconds:>8.2f}  {outcome}")
+    failed = sum(1 for result in results if result.error is not None)
+    lines.append(f"{len(results)} jobs, {failed} failed, {seconds:.2f} s")
+    return "\n".join(lines)
+
+
+async def main(argv: list[str] | None = None) -> int:
+    """Run the batch export command line
+    :param argv: command line arguments
+    :return: exit code, 1 if a job failed"""
+    from dotenv import load_dotenv
+
+    env_path = os.getenv("ENV_PATH", "/data/.env")
+    parser = argparse.ArgumentParser(
+        description="Export charging sessions for a manifest of jobs.")
+    parser.add_argument("manifest", help="JSON manifest of export jobs")
+    parser.add_argument("--output-dir",
+                        default="exports",
+                        help="directory of the export files")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=DEFAULT_WORKERS,
+                        help="number of jobs running at the same time")
+    parser.add_argument("--cfg",
+                        default=os.path.join(os.path.dirname(env_path),
+                                             "cfg.ini"),
+                        help="path of cfg.ini")
+    parser.add_argument("--tenant",
+                        help="account of a TENANT:<name> section, default is the only one")
+    parser.add_argument("--watermarks",
+                        default=os.path.join(os.path.dirname(env_path),
+                                             "watermarks.json"),
+                        help="watermark file of only_new jobs, shared with the web app")
+    parser.add_argument("--template",
+                        default=os.getenv("XLSX_TEMPLATE", TEMPLATE_PATH),
+                        help="xlsx template of the layout, empty for the built-in one")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    load_dotenv(env_path)
+    from cachestore import create_cache
+    from tenants import TenantManager
+    from utils.utils import get_or_create_encryption_key
+
+    jobs = load_manifest(args.manifest)
+    key = get_or_create_encryption_key()
+    cfgParser = ChargeAmpsCfgParser(args.cfg)
+    tenants = cfgParser.get_tenant_data()
+    # share the login with the web workers if a shared cache is configured
+    cache = create_cache(cfgParser.get_cache_data(os.path.dirname(env_path)))
+    manager = TenantManager(tenants,
+                            key,
+                            cache=cache,
+                            token_dir=os.path.dirname(env_path))
+    started = time.perf_counter()
+    try:
+        tenant = manager.resolve(args.tenant)
+        if tenant not in tenants:
+            parser.error(f"unknown tenant {tenant}, configured are "
+                         f"{', '.join(tenants)}")
+        client = await manager.get_client(tenant)
+        results = await run_batch(
+            client, jobs, args.output_dir, tenants[tenant]["pricekWh"],
+            args.workers, WatermarkStore(args.watermarks),
+            load_template(args.template) if args.template else None, tenant)
+    finally:
+        await manager.close()
+        await cache.close()
+    print(format_report(results, time.perf_counter() - started))
+    return 1 if any(result.error is not None for result in results) else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main()))
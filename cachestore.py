@@ -0,0 +1,355 @@
+"""
+Cache backends for tokens and API responses.
+The memory backend is private to a process. The SQLite and Redis backends are shared
+by all hypercorn workers, so the workers share one login and one warm cache.
+All backends store bytes with an optional time to live.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_MMAP_SIZE = 64 * 1024 * 1024
+MEMORY_CACHE_MAX_ENTRIES = 10000
+MEMORY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# seconds between the removals of all expired entries
+EXPIRY_SWEEP_INTERVAL = 60
+
+
+class MemoryCache:
+    """
+    Process local cache"""
+
+    def __init__(self,
+                 max_entries: int = MEMORY_CACHE_MAX_ENTRIES,
+                 max_bytes: int = MEMORY_CACHE_MAX_BYTES):
+        """
+        Process local cache, the least recently used values are dropped when it is full
+        :param max_entries: maximum number of values
+        :param max_bytes: maximum size of the keys and values"""
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._next_sweep = time.time() + EXPIRY_SWEEP_INTERVAL
+
+    def _remove(self, key: str) -> None:
+        """Remove a value if it exists"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(key) + len(entry[0])
+
+    def _live(self, key: str) -> bytes | None:
+        """Get a value unless it is expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _sweep(self, now: float) -> None:
+        """Remove the expired values, also those never read again"""
+        self._next_sweep = now + EXPIRY_SWEEP_INTERVAL
+        expired = [
+            key for key, (_, expires) in self._entries.items()
+            if expires is not None and expires <= now
+        ]
+        for key in expired:
+            self._remove(key)
+
+    async def get(self, key: str) -> bytes | None:
+        """Get a value
+        :param key: key of the value
+        :return: stored value or None"""
+        return self._live(key)
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        """Store a value
+        :param key: key of the value
+        :param value: value to store
+        :param ttl: time to live in seconds, None for no expiry"""
+        now = time.time()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        self._remove(key)
+        self._entries[key] = (value, now + ttl if ttl else None)
+        self._bytes += len(key) + len(value)
+        while self._entries and (len(self._entries) > self._max_entries
+                                 or self._bytes > self._max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    async def add(self, key: str, value: bytes, ttl: float | None = None) -> bool:
+        """Store a value only if the key does not exist
+        :param key: key of the value
+        :param value: value to store
+        :param ttl: time to live in seconds, None for no expiry
+        :return: True if the value was stored"""
+        if self._live(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key: str) -> None:
+        """Delete a value
+        :param key: key of the value"""
+        self._remove(key)
+
+    async def close(self) -> None:
+        """Release resources"""
+        self._entries.clear()
+        self._bytes = 0
+
+
+class SqliteCache:
+    """
+    Cache in a SQLite file shared by all processes on a host"""
+
+    def __init__(self, path: str):
+        """
+        Cache in a SQLite file
+        :param path: path of the database file"""
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path,
+                                   timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        self._db.execute("CREATE TABLE IF NOT EXISTS cache ("
+                         "key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+        self._next_sweep = time.time() + EXPIRY_SWEEP_INTERVAL
+
+    def _execute(self, sql: str, params: tuple = ()) -> tuple | None:
+        """Execute a statement, sqlite serializes writers across processes
+        :return: first row of the result"""
+        with self._lock:
+            return self._db.execute(sql, params).fetchone()
+
+    async def get(self, key: str) -> bytes | None:
+        """Get a value
+        :param key: key of the value
+        :return: stored value or None"""
+        row = await asyncio.to_thread(
+            self._execute, "SELECT value FROM cache WHERE key = ? "
+            "AND (expires IS NULL OR expires > ?)", (key, time.time()))
+        return row[0] if row else None
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        """Store a value
+        :param key: key of the value
+        :param value: value to store
+        :param ttl: time to live in seconds, None for no expiry"""
+        now = time.time()
+        if now >= self._next_sweep:
+            # expired values are only skipped by get, remove them from time to time
+            self._next_sweep = now + EXPIRY_SWEEP_INTERVAL
+            await asyncio.to_thread(self._execute,
+                                    "DELETE FROM cache WHERE expires <= ?",
+                                    (now, ))
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, value, now + ttl if ttl else None))
+
+    async def add(self, key: str, value: bytes, ttl: float | None = None) -> bool:
+        """Store a value only if the key does not exist
+        :param key: key of the value
+        :param value: value to store
+        :param ttl: time to live in seconds, None for no expiry
+        :return: True if the value was stored"""
+
+        def add_atomic() -> bool:
+            now = time.time()
+            with self._lock:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    self._db.execute(
+                        "DELETE FROM cache WHERE key = ? AND expires <= ?",
+                        (key, now))
+                    cursor = self._db.execute(
+                        "INSERT OR IGNORE INTO cache (key, value, expires) "
+                        "VALUES (?, ?, ?)",
+                        (key, value, now + ttl if ttl else None))
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+                return cursor.rowcount == 1
+
+        return await asyncio.to_thread(add_atomic)
+
+    async def delete(self, key: str) -> None:
+        """Delete a value
+        :param key: key of the value"""
+        await asyncio.to_thread(self._execute,
+                                "DELETE FROM cache WHERE key = ?", (key, ))
+
+    async def close(self) -> None:
+        """Release resources"""
+        with self._lock:
+            self._db.close()
+
+
+class RedisCache:
+    """
+    Cache in a server speaking the Redis protocol (Redis, Valkey, KeyDB, ...)"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379, db: int = 0):
+        """
+        Cache in a Redis protocol server
+        :param host: host of the server
+        :param port: port of the server
+        :param db: database number"""
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        self._host = host
+        self._port = port
+        self._db = db
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisCache":
+        """Create a cache from a redis://host:port/db URL"""
+        parsed = urlparse(url)
+        db = parsed.path.lstrip("/")
+        return cls(parsed.hostname or "127.0.0.1", parsed.port or 6379,
+                   int(db) if db else 0)
+
+    async def _connect(self) -> None:
+        """Open the connection and select the database"""
+        self._reader, self._writer = await asyncio.open_connection(
+            self._host, self._port)
+        if self._db:
+            await self._roundtrip("SELECT", str(self._db))
+
+    async def _roundtrip(self, *args) -> object:
+        """Send a command and read its reply"""
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        self._writer.write(b"".join(parts))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def _read_reply(self) -> object:
+        """Read a single RESP reply"""
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RuntimeError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"Unexpected reply {line!r}")
+
+    def _reset(self) -> None:
+        """Close the connection, the next command opens a new one"""
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    async def _command(self, *args) -> object:
+        """Run a command, reconnecting once after a dropped connection"""
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    return await self._roundtrip(*args)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    self._reset()
+                    if attempt:
+                        raise
+                except BaseException:
+                    # e.g. cancelled by a deadline, an unread reply or a connection
+                    # not switched to the database yet would confuse the next command
+                    self._reset()
+                    raise
+
+    async def get(self, key: str) -> bytes | None:
+        """Get a value
+        :param key: key of the value
+        :return: stored value or None"""
+        return await self._command("GET", key)
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        """Store a value
+        :param key: key of the value
+        :param value: value to store
+        :param ttl: time to live in seconds, None for no expiry"""
+        if ttl:
+            await self._command("SET", key, value, "PX", int(ttl * 1000))
+        else:
+            await self._command("SET", key, value)
+
+    async def add(self, key: str, value: bytes, ttl: float | None = None) -> bool:
+        """Store a value only if the key does not exist
+        :param key: key of the value
+        :param value: value to store
+        :param ttl: time to live in seconds, None for no expiry
+        :return: True if the value was stored"""
+        if ttl:
+            reply = await self._command("SET", key, value, "PX",
+                                        int(ttl * 1000), "NX")
+        else:
+            reply = await self._command("SET", key, value, "NX")
+        return reply == "OK"
+
+    async def delete(self, key: str) -> None:
+        """Delete a value
+        :param key: key of the value"""
+        await self._command("DEL", key)
+
+    async def close(self) -> None:
+        """Release resources"""
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+
+def create_cache(cache_data: dict):
+    """Create the cache backend configured in the CACHE section
+    :param cache_data: dict with backend, path and url
+    :return: cache backend"""
+    backend = (cache_data.get("backend") or "memory").lower()
+    if backend == "sqlite":
+        return SqliteCache(cache_data["path"])
+    if backend == "redis":
+        return RedisCache.from_url(cache_data["url"])
+    if backend == "memory":
+        return MemoryCache()
+    raise ValueError(f"Unknown cache backend {backend}")
@@ -1,4 +1,9 @@
 import configparser
+import os
+
+TENANT_SECTION_PREFIX = "TENANT:"
+DEFAULT_TENANT = "default"
+DEFAULT_TENANT_CONCURRENCY = 4
 
 
 class ChargeAmpsCfgParser:
@@ -35,3 +40,48 @@ class ChargeAmpsCfgParser:
             "baseUrl": self.__config["GENERAL"]["baseUrl"],
             "pricekWh": self.__config["GENERAL"]["pricekWh"]
         }
+
+    def get_cache_data(self, data_dir: str = "") -> dict:
+        """Get the cache settings from the optional CACHE section.
+        Args:
+            data_dir (str): Directory for the default SQLite cache file.
+        Returns:
+            dict: Dictionary containing cache data (backend, path, url).
+        """
+        section = self.__config["CACHE"] if self.__config.has_section(
+            "CACHE") else {}
+        return {
+            "backend": section.get("backend", "memory"),
+            "path": section.get("path", os.path.join(data_dir, "cache.sqlite")),
+            "url": section.get("url", "redis://127.0.0.1:6379/0")
+        }
+
+    def get_tenant_data(self) -> dict:
+        """Get the accounts of the optional TENANT:<name> sections.
+        Without such sections the USERDATA account is the only tenant "default".
+        baseUrl and pricekWh default to the GENERAL section.
+        Returns:
+            dict: Dictionary of tenant name to account data (email, password, apiKey,
+            baseUrl, pricekWh, maxConcurrency).
+        """
+        general_data = self.get_general_data()
+        sections = {
+            name[len(TENANT_SECTION_PREFIX):]: self.__config[name]
+            for name in self.__config.sections()
+            if name.startswith(TENANT_SECTION_PREFIX)
+        }
+        if not sections:
+            sections = {DEFAULT_TENANT: self.__config["USERDATA"]}
+        return {
+            tenant: {
+                "email": section["email"],
+                "password": section["password"],
+                "apiKey": section["apiKey"],
+                "baseUrl": section.get("baseUrl", general_data["baseUrl"]),
+                "pricekWh": section.get("pricekWh", general_data["pricekWh"]),
+                "maxConcurrency": int(
+                    section.get("maxConcurrency",
+                                str(DEFAULT_TENANT_CONCURRENCY)))
+            }
+            for tenant, section in sections.items()
+        }
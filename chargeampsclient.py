@@ -2,16 +2,35 @@
 Python client class for charge amps.
 This module holds the connection to the cloud backend and refreshes the connection when needed.
 """
-from aiohttp import ClientResponse, ClientSession
-from aiohttp.web import HTTPException
-
+import asyncio
+import contextlib
+import hashlib
+import json
 import logging
+import os
 import time
-import jwt
 
-from datetime import datetime
+from collections.abc import AsyncIterator, Iterator
+from typing import TYPE_CHECKING
+from datetime import datetime, timedelta
 from urllib.parse import urljoin
 
+from cachestore import MemoryCache
+from circuitbreaker import (BreakerRegistry, CircuitOpenError,
+                            is_upstream_failure, mark_partial, mark_stale)
+from deadlines import budgeted, detached, enforce
+from jsonstream import JsonArrayDecoder, iter_json_array
+from rfidindex import RfidIndex, UNUSED_RFID_SLOT, matches
+from scheduleindex import ScheduleIndex
+from transport import AIOHTTP, create_transport
+from utils.utils import encrypt, decrypt
+
+# aiohttp (or httpx), jwt and cryptography are imported on first use, see
+# init_session, _apply_token and _load_token
+if TYPE_CHECKING:
+    # the responses of the http2 transport offer the same interface
+    from aiohttp import ClientResponse
+
 from chargeampsdata import (
     UserStatus, ChargePointConnector, ChargePoint, ChargingSession,
     ChargePointSettings, ChargePointConnectorSettings, ChargePointPartner,
@@ -21,7 +40,20 @@ from chargeampsdata import (
 
 API_BASE_URL = "https://eapi.charge.space"
 API_VERSION = "v5"
-UNUSED_RFID_SLOT = "00000000000000"
+STREAM_CHUNK_SIZE = 64 * 1024
+# a token shared by another worker is only adopted if it is valid for this long
+TOKEN_REFRESH_MARGIN = 30
+LOGIN_LOCK_TTL = 30
+LOGIN_WAIT_TIMEOUT = 10
+CHARGEPOINTS_CACHE_TTL = 300
+COMPLETED_SESSIONS_CACHE_TTL = 24 * 3600
+# session lists ending before now - margin are considered final
+COMPLETED_SESSIONS_MARGIN = timedelta(days=1)
+# last known good responses served while the upstream is down, see circuitbreaker
+STALE_CACHE_TTL = 7 * 24 * 3600
+CONNECT_TIMEOUT = 10
+# no total timeout, long session lists stream for minutes
+READ_TIMEOUT = 30
 
 
 class User:
@@ -68,42 +100,80 @@ class User:
 
 class Client:
     """
-    Client class for charge amps API"""
-
-    def __init__(self, email: str, password: str, apiKey: str, api_url: str):
+    Client class for charge amps API
+    Every request method takes an optional timeout in seconds, see deadlines.budgeted"""
+
+    def __init__(self,
+                 email: str,
+                 password: str,
+                 apiKey: str,
+                 api_url: str,
+                 cache=None,
+                 token_key: bytes | None = None,
+                 token_file: str | None = None,
+                 connector=None,
+                 limiter=None,
+                 telemetry=None,
+                 transport: str = AIOHTTP):
         """
         Client class for charge amps API
         :param email: email address of the user
         :param password: password of the user
         :param apiKey: API key of the user
-        :param api_url: API URL of the charge amps backend"""
+        :param api_url: API URL of the charge amps backend
+        :param cache: cache backend for token and responses, see cachestore
+        :param token_key: Fernet key encrypting the stored token
+        :param token_file: file persisting the token across restarts
+        :param connector: aiohttp connector shared with other clients, see tenants
+        :param limiter: async context manager granting a slot per upstream request
+        :param telemetry: TelemetryStore recording the measurements of every status poll
+        :param transport: HTTP transport, aiohttp or http2, see transport"""
         self._logger = logging.getLogger(__name__).getChild(
             self.__class__.__name__)
+        self._telemetry = telemetry
         self._user = User(username=email, password=password, apiKey=apiKey)
-        self._session = Session(api_url, self._user)
+        self._session = Session(api_url,
+                                self._user,
+                                cache,
+                                token_key=token_key,
+                                token_file=token_file,
+                                connector=connector,
+                                limiter=limiter,
+                                transport=transport)
+        self._schedule_index = ScheduleIndex()
         return None
 
+    @budgeted
     async def init_session(self) -> None:
         """Initialize session"""
         await self._session.init_session()
         self._user.update_user_info(self._session.get_user_info())
+        for tag in self._user._rfidTags or []:
+            self._session._rfid_index.add(tag["rfid"], tag.get("rfidDec"),
+                                          tag.get("rfidDecReverse"))
 
     async def close_session(self) -> None:
         """Close session"""
         await self._session.shutdown()
 
+    @budgeted
     async def get_chargepoints(self) -> list[ChargePoint]:
         """Get all owned chargepoints
        :return: list of ChargePoint objects"""
         return await self._session.get_chargepoints()
 
+    @budgeted
     async def get_chargepoint_status(
             self, charge_point_id: str) -> ChargePointStatus:
         """Get charge point status
         :param charge_point_id: ID of the charge point
         :return: ChargePointStatus object"""
-        return await self._session.get_chargepoint_status(charge_point_id)
+        status = await self._session.get_chargepoint_status(charge_point_id)
+        if self._telemetry is not None:
+            self._telemetry.record_status(status)
+        return status
 
+    @budgeted
     async def get_connector_chargingsessions(
             self,
             charge_point_id: str,
@@ -122,6 +192,7 @@ class Client:
             start_time=start_time,
             end_time=end_time)
 
+    @budgeted
     async def get_chargingsessions(
             self,
             charge_point_id: str,
@@ -137,6 +208,7 @@ class Client:
             start_time=start_time,
             end_time=end_time)
 
+    @budgeted
     async def get_specific_chargingsession(
             self,
             charge_point_id: str,
@@ -155,6 +227,7 @@ class Client:
             start_time=start_time,
             end_time=end_time)
 
+    @budgeted
     async def get_rfid_chargingsessions(
             self,
             charge_point_id: str,
@@ -165,7 +238,7 @@ class Client:
         """Get all charging sessions of a specific connector
         :param charge_point_id: ID of the charge point
         :param connector_id: ID of the connector
-        :param rfid: RFID tag of the user
+        :param rfid: RFID tag of the user as hex, decimal or reversed decimal
         :param start_time: start time of the charging session
         :param end_time: end time of the charging session
         :return: list of ChargingSession objects"""
@@ -176,6 +249,112 @@ class Client:
             start_time=start_time,
             end_time=end_time)
 
+    @budgeted
+    async def get_fleet_chargingsessions(
+            self,
+            start_time: datetime | None = None,
+            end_time: datetime | None = None) -> list[ChargingSession]:
+        """Get the charging sessions of all connectors of all owned chargepoints.
+        Every connector is fetched exactly once, all connectors concurrently.
+        Connectors the upstream fails to answer are left out, logged and reported with
+        circuitbreaker.mark_partial, the request only fails if all of them fail.
+        :param start_time: start time of the charging session
+        :param end_time: end time of the charging session
+        :return: list of ChargingSession objects"""
+        charge_points = await self.get_chargepoints()
+        connectors = [
+            connector for charge_point in charge_points
+            for connector in charge_point.connectors
+        ]
+        results = await asyncio.gather(*[
+            self.get_connector_chargingsessions(
+                charge_point_id=connector.charge_point_id,
+                connector_id=connector.connector_id,
+                start_time=start_time,
+                end_time=end_time) for connector in connectors
+        ], return_exceptions=True)
+        failed = [
+            result for result in results if isinstance(result, BaseException)
+        ]
+        for exc in failed:
+            # a bug or a passed deadline fails the whole request
+            if not (isinstance(exc, CircuitOpenError)
+                    or is_upstream_failure(exc)):
+                raise exc
+        if failed and len(failed) == len(results):
+            raise failed[0]
+        sessions = []
+        for connector, result in zip(connectors, results):
+            if isinstance(result, BaseException):
+                self._logger.warning(
+                    "Sessions of connector %s of %s left out: %s",
+                    connector.connector_id, connector.charge_point_id, result)
+                mark_partial(f"sessions of {connector.charge_point_id}")
+                continue
+            sessions.extend(result)
+        return sessions
+
+    @budgeted
+    def iter_connector_chargingsessions(
+            self,
+            charge_point_id: str,
+            connector_id: int,
+            start_time: datetime | None = None,
+            end_time: datetime | None = None
+    ) -> AsyncIterator[ChargingSession]:
+        """Stream all charging sessions of a specific connector
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param start_time: start time of the charging session
+        :param end_time: end time of the charging session
+        :return: async iterator over ChargingSession objects"""
+        return self._session.iter_connector_chargingsessions(
+            charge_point_id=charge_point_id,
+            connector_id=connector_id,
+            start_time=start_time,
+            end_time=end_time)
+
+    @budgeted
+    def iter_chargingsessions(
+            self,
+            charge_point_id: str,
+            start_time: datetime | None = None,
+            end_time: datetime | None = None
+    ) -> AsyncIterator[ChargingSession]:
+        """Stream all charging sessions of a charge point
+        :param charge_point_id: ID of the charge point
+        :param start_time: start time of the charging session
+        :param end_time: end time of the charging session
+        :return: async iterator over ChargingSession objects"""
+        return self._session.iter_chargingsessions(
+            charge_point_id=charge_point_id,
+            start_time=start_time,
+            end_time=end_time)
+
+    @budgeted
+    def iter_rfid_chargingsessions(
+            self,
+            charge_point_id: str,
+            connector_id: int,
+            rfid: str,
+            start_time: datetime | None = None,
+            end_time: datetime | None = None
+    ) -> AsyncIterator[ChargingSession]:
+        """Stream all charging sessions of a specific connector and RFID tag
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param rfid: RFID tag of the user as hex, decimal or reversed decimal
+        :param start_time: start time of the charging session
+        :param end_time: end time of the charging session
+        :return: async iterator over ChargingSession objects"""
+        return self._session.iter_rfid_chargingsessions(
+            charge_point_id=charge_point_id,
+            connector_id=connector_id,
+            rfid=rfid,
+            start_time=start_time,
+            end_time=end_time)
+
+    @budgeted
     async def get_chargepoint_connector_settings(
             self, charge_point_id: str,
             connector_id: int) -> ChargePointConnectorSettings:
@@ -186,6 +365,15 @@ class Client:
         return await self._session.get_chargepoint_connector_settings(
             charge_point_id=charge_point_id, connector_id=connector_id)
 
+    @budgeted
+    async def set_chargepoint_connector_settings(
+            self, settings: ChargePointConnectorSettings) -> None:
+        """Set connector settings, e.g. the max_current of load balancing
+        :param settings: ChargePointConnectorSettings object
+        :return: None"""
+        await self._session.set_chargepoint_connector_settings(settings)
+
+    @budgeted
     async def get_chargepoint_settings(
             self, charge_point_id: str) -> ChargePointSettings:
         """Get chargepoint settings
@@ -194,6 +382,7 @@ class Client:
         return await self._session.get_chargepoint_settings(
             charge_point_id=charge_point_id)
 
+    @budgeted
     async def get_chargepoint_partner(
             self, charge_point_id: str) -> ChargePointPartner:
         """Get chargepoint partner
@@ -202,6 +391,7 @@ class Client:
         return await self._session.get_chargepoint_partner(
             charge_point_id=charge_point_id)
 
+    @budgeted
     async def get_chargepoint_override_status(
             self, charge_point_id: str) -> ChargePointScheduleOverrideStatus:
         """Get chargepoint override status
@@ -210,14 +400,34 @@ class Client:
         return await self._session.get_chargepoint_override_status(
             charge_point_id=charge_point_id)
 
+    @budgeted
     async def get_chargepoint_schedules(
             self, charge_point_id: str) -> list[ChargePointSchedule]:
         """Get chargepoint schedules
         :param charge_point_id: ID of the charge point
         :return: list of ChargePointSchedule objects"""
-        return await self._session.get_chargepoint_schedules(
+        schedules = await self._session.get_chargepoint_schedules(
             charge_point_id=charge_point_id)
+        self._schedule_index.refresh(charge_point_id, schedules)
+        return schedules
 
+    @budgeted
+    async def get_schedule_index(
+            self,
+            charge_point_ids: list[str] | None = None) -> ScheduleIndex:
+        """Load the schedules of charge points into the schedule index
+        Charge points loaded before are only compiled again if their schedules changed.
+        :param charge_point_ids: IDs of the charge points, default is all owned
+        :return: ScheduleIndex object"""
+        if charge_point_ids is None:
+            charge_point_ids = [
+                charge_point.id for charge_point in await self.get_chargepoints()
+            ]
+        await asyncio.gather(*(self.get_chargepoint_schedules(charge_point_id)
+                               for charge_point_id in charge_point_ids))
+        return self._schedule_index
+
+    @budgeted
     async def get_chargepoint_schedule(
             self, charge_point_id: str,
             schedule_id: int) -> ChargePointSchedule:
@@ -228,12 +438,45 @@ class Client:
         return await self._session.get_chargepoint_schedule(
             charge_point_id=charge_point_id, schedule_id=schedule_id)
 
+    @budgeted
+    async def create_schedule(self, charge_point_id: str,
+                              chrg_schedule: ChargePointSchedule) -> None:
+        """Create a charge schedule. For CAPI charger only
+        :param charge_point_id: ID of the charge point
+        :param chrg_schedule: ChargePointSchedule object
+        :return: None"""
+        # the index is compiled again on the next get_chargepoint_schedules
+        self._schedule_index.remove(charge_point_id)
+        await self._session.create_schedule(charge_point_id, chrg_schedule)
+
+    @budgeted
+    async def update_schedule(self, charge_point_id: str,
+                              chrg_schedule: ChargePointSchedule) -> None:
+        """Update a charge schedule. For CAPI charger only
+        :param charge_point_id: ID of the charge point
+        :param chrg_schedule: ChargePointSchedule object
+        :return: None"""
+        self._schedule_index.remove(charge_point_id)
+        await self._session.update_schedule(charge_point_id, chrg_schedule)
+
+    @budgeted
+    async def delete_schedule(self, charge_point_id: str,
+                              schedule_id: int) -> None:
+        """Delete a charge schedule. For CAPI charger only
+        :param charge_point_id: ID of the charge point
+        :param schedule_id: ID of the schedule
+        :return: None"""
+        self._schedule_index.remove(charge_point_id)
+        await self._session.delete_schedule(charge_point_id, schedule_id)
+
+    @budgeted
     async def get_user(self, user_id: str) -> ChargeAmpsUser:
         """Get user information
         :param user_id: ID of the user
         :return: ChargeAmpsUser object"""
         return await self._session.get_user(user_id=user_id)
 
+    @budgeted
     async def get_registered_rfid_tags(self, charge_point_id: str) -> list:
         """Get all registered RFID tags for a specific charge point.
         :param charge_point_id: ID of the charge point
@@ -241,16 +484,64 @@ class Client:
         return await self._session.get_registered_rfid_tags(
             charge_point_id=charge_point_id)
 
+    @budgeted
+    async def enable_callbacks(self, charge_point_ids: list[str]) -> None:
+        """Let charge amps push sessions and statuses of charge points, see events
+        :param charge_point_ids: IDs of the charge points
+        :return: None"""
+        await self._session.enable(ChargePointIds(charge_point_ids))
+
+    @budgeted
+    async def disable_callbacks(self, charge_point_ids: list[str]) -> None:
+        """Stop the callbacks of charge points
+        :param charge_point_ids: IDs of the charge points
+        :return: None"""
+        await self._session.disable(ChargePointIds(charge_point_ids))
+
+    def resolve_rfid(self, rfid: str) -> str | None:
+        """Resolve an RFID tag printed in any format, see rfidindex
+        :param rfid: hex, decimal or reversed decimal tag
+        :return: canonical hex tag or None if no session or login returned it yet"""
+        return self._session._rfid_index.resolve(rfid)
+
+    def canonical_rfid(self, rfid: str) -> str | None:
+        """Get the canonical hex tag of an RFID tag printed in any format for keys
+        that must not depend on the sessions loaded so far, see rfidindex
+        :param rfid: hex, decimal or reversed decimal tag
+        :return: canonical hex tag or None if the tag is not hex and unknown yet"""
+        return self._session._rfid_index.canonical(rfid)
+
+    def describe_rfid(self, rfid: str) -> dict | None:
+        """Get all representations of an RFID tag printed in any format
+        :param rfid: hex, decimal or reversed decimal tag
+        :return: dict with rfid, rfidDec and rfidDecReverse or None if unknown"""
+        return self._session._rfid_index.describe(rfid)
+
 
 class Session:
     """
-    Session class for charge amps API"""
-
-    def __init__(self, api_url: str, user: User):
+    Session class for charge amps API
+    Every request method takes an optional timeout in seconds, see deadlines.budgeted"""
+
+    def __init__(self,
+                 api_url: str,
+                 user: User,
+                 cache=None,
+                 token_key: bytes | None = None,
+                 token_file: str | None = None,
+                 connector=None,
+                 limiter=None,
+                 transport: str = AIOHTTP):
         """
         Session class for charge amps API
         :param api_url: API URL of the charge amps backend
-        :param user: User object for authentication"""
+        :param user: User object for authentication
+        :param cache: cache backend for token and responses, defaults to a MemoryCache
+        :param token_key: Fernet key encrypting the stored token
+        :param token_file: file persisting the token across restarts
+        :param connector: aiohttp connector shared with other sessions, not closed on shutdown
+        :param limiter: async context manager granting a slot per upstream request
+        :param transport: HTTP transport, aiohttp or http2, see transport"""
         self._logger = logging.getLogger(__name__).getChild(
             self.__class__.__name__)
         self._token = None
@@ -261,16 +552,41 @@ class Session:
         self._ssl = False
         self._token_expire = 0
         self._user = user
-        self._csession = None
+        self._transport_name = transport
+        self._transport = None
+        self._token_lock = asyncio.Lock()
+        self._cache = cache or MemoryCache()
+        self._token_key = token_key
+        self._token_file = token_file
+        self._connector = connector
+        self._limiter = limiter or contextlib.nullcontext()
+        # tags of all sessions seen so far, filled without extra requests
+        self._rfid_index = RfidIndex()
+        self._cache_prefix = hashlib.sha256(
+            f"{self._base_url}|{user._email}".encode()).hexdigest()[:16]
+        self._breakers = BreakerRegistry()
+        # background refreshes of stale responses by cache key
+        self._revalidations = {}
 
     async def shutdown(self) -> None:
         """Close the session and release resources."""
-        await self._csession.close()
+        for task in self._revalidations.values():
+            task.cancel()
+        await asyncio.gather(*self._revalidations.values(),
+                             return_exceptions=True)
+        await self._transport.close()
 
+    @budgeted
     async def init_session(self) -> None:
         """Initialize session"""
-        self._csession = ClientSession(raise_for_status=True)
-        await self._get_token()
+        self._transport = create_transport(self._transport_name,
+                                           self._base_url,
+                                           ssl=self._ssl,
+                                           connector=self._connector,
+                                           connect_timeout=CONNECT_TIMEOUT,
+                                           read_timeout=READ_TIMEOUT)
+        async with enforce():
+            await self._get_token()
         return None
 
     def get_user_info(self) -> dict:
@@ -283,7 +599,120 @@ class Session:
         """Get token from the server"""
         if self._token_expire > time.time():
             return
+        # concurrent requests share the session, only one of them logs in
+        async with self._token_lock:
+            if self._token_expire > time.time():
+                return
+            if await self._load_shared_token():
+                return
+            lock_key = self._cache_key("login-lock")
+            locked = await self._cache.add(lock_key,
+                                           str(os.getpid()).encode(),
+                                           LOGIN_LOCK_TTL)
+            if not locked:
+                # another worker is logging in, wait for its token
+                self._logger.debug("Waiting for login of another worker")
+                deadline = time.time() + LOGIN_WAIT_TIMEOUT
+                while time.time() < deadline:
+                    await asyncio.sleep(0.2)
+                    if await self._load_shared_token():
+                        return
+            try:
+                await self._renew_token()
+                if self._token is not None:
+                    await self._store_token(self.__lastresponse)
+            finally:
+                if locked:
+                    await self._cache.delete(lock_key)
+
+    def _cache_key(self, *parts: str) -> str:
+        """Cache key scoped to the API URL and user of this session"""
+        return f"chargeamps:{self._cache_prefix}:" + "|".join(parts)
+
+    async def _store_token(self, response_payload: dict) -> None:
+        """Store the token for other workers and the next start
+        :param response_payload: decoded response of the auth endpoint"""
+        data = json.dumps({
+            "scope": self._cache_prefix,
+            "response": response_payload
+        })
+        if self._token_key:
+            data = encrypt(data, self._token_key)
+        await self._cache.set(self._cache_key("token"), data.encode())
+        if self._token_file:
+            await asyncio.to_thread(self._write_token_file, data.encode())
+
+    def _write_token_file(self, data: bytes) -> None:
+        """Atomically replace the token file, readable by the owner only"""
+        tmp_path = f"{self._token_file}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._token_file)
+
+    def _read_token_file(self) -> bytes | None:
+        """Read the token file"""
+        try:
+            with open(self._token_file, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def _load_token(self) -> dict | None:
+        """Load the stored token from the cache or the token file
+        :return: decoded response of the auth endpoint or None"""
+        key = self._cache_key("token")
+        data = await self._cache.get(key)
+        if data is None and self._token_file:
+            data = await asyncio.to_thread(self._read_token_file)
+            if data:
+                await self._cache.set(key, data)
+        if not data:
+            return None
+        if self._token_key:
+            from cryptography.fernet import InvalidToken
+            try:
+                data = decrypt(data.decode(), self._token_key)
+            except InvalidToken:
+                self._logger.warning("Stored token can not be decrypted")
+                return None
+        stored = json.loads(data)
+        # the token file may still hold the token of other credentials
+        if stored.get("scope") != self._cache_prefix:
+            return None
+        return stored["response"]
+
+    async def _load_shared_token(self) -> bool:
+        """Adopt the token stored by another worker or a previous run
+        :return: True if the adopted token is still valid"""
+        response_payload = await self._load_token()
+        if response_payload is None:
+            return False
+        if response_payload["token"] != self._token:
+            self._apply_token(response_payload)
+        return self._token_expire > time.time() + TOKEN_REFRESH_MARGIN
+
+    def _apply_token(self, response_payload: dict) -> None:
+        """Use the token of a login or refresh response
+        :param response_payload: decoded response of the auth endpoint"""
+        if "user" not in response_payload and "user" in self.__lastresponse:
+            response_payload = {
+                **response_payload, "user": self.__lastresponse["user"]
+            }
+        self.__lastresponse = response_payload
+
+        self._token = response_payload["token"]
+        self._refreshToken = response_payload["refreshToken"]
+
+        import jwt
+        token_payload = jwt.decode(self._token,
+                                   options={"verify_signature": False})
+        self._token_expire = token_payload.get("exp", 0)
+
+        self._headers["Authorization"] = f"Bearer {self._token}"
 
+    async def _renew_token(self) -> None:
+        """Refresh the token or log in again"""
         if self._token is None:
             self._logger.info("Token not found")
         elif self._token_expire > 0:
@@ -294,7 +723,8 @@ class Session:
         if self._refreshToken:
             try:
                 self._logger.info("Found refresh token, try refresh")
-                response = await self._csession.post(
+                response = await self._transport.request(
+                    "POST",
                     urljoin(self._base_url,
                             f"/api/{API_VERSION}/auth/refreshToken"),
                     ssl=self._ssl,
@@ -305,7 +735,7 @@ class Session:
                     },
                 )
                 self._logger.debug("Refresh successful")
-            except HTTPException:
+            except self._transport.status_error:
                 self._logger.warning("Token refresh failed")
                 self._token = None
                 self._refreshToken = None
@@ -315,7 +745,8 @@ class Session:
         if self._token is None:
             try:
                 self._logger.debug("Try login")
-                response = await self._csession.post(
+                response = await self._transport.request(
+                    "POST",
                     urljoin(self._base_url, f"/api/{API_VERSION}/auth/login"),
                     ssl=self._ssl,
                     headers={"apiKey": self._user._apiKey},
@@ -325,7 +756,7 @@ class Session:
                     },
                 )
                 self._logger.debug("Login successful")
-            except HTTPException as exc:
+            except self._transport.status_error as exc:
                 self._logger.error("Login failed")
                 self._token = None
                 self._refreshToken = None
@@ -337,86 +768,180 @@ class Session:
             return
 
         response_payload = await response.json()
-        self.__lastresponse = response_payload
-
-        self._token = response_payload["token"]
-        self._refreshToken = response_payload["refreshToken"]
-
-        token_payload = jwt.decode(self._token,
-                                   options={"verify_signature": False})
-        self._token_expire = token_payload.get("exp", 0)
-
-        self._headers["Authorization"] = f"Bearer {self._token}"
+        self._apply_token(response_payload)
+
+    async def _get_cached(self,
+                          path: str,
+                          ttl: float,
+                          name: str = "response",
+                          **kwargs) -> bytes:
+        """Get request answered from the response cache if possible
+        If the upstream fails, the last known good response is served as stale and
+        refreshed in the background.
+        :param path: path of the request
+        :param ttl: time to live of the cached response in seconds
+        :param name: name of the result reported by circuitbreaker.stale_results
+        :param kwargs: additional parameters for the request
+        :return: raw response body"""
+        key = self._cache_key(
+            "GET", path, json.dumps(kwargs.get("params"), sort_keys=True))
+        data = await self._cache.get(key)
+        if data is not None:
+            return data
+
+        async def fetch() -> bytes:
+            response = await self._get(path, **kwargs)
+            data = await response.read()
+            await self._cache.set(key, data, ttl)
+            await self._cache.set(key + "|stale", data, STALE_CACHE_TTL)
+            return data
+
+        try:
+            return await fetch()
+        except Exception as exc:
+            if not (isinstance(exc, CircuitOpenError)
+                    or is_upstream_failure(exc)):
+                raise
+            data = await self._cache.get(key + "|stale")
+            if data is None:
+                raise
+            self._logger.warning("Serving stale %s: %s", name, exc)
+            mark_stale(name)
+            self._revalidate(key, "GET", path, fetch)
+            return data
+
+    def _revalidate(self, key: str, method: str, path: str, fetch) -> None:
+        """Refresh a stale response once the breaker of its endpoint lets a probe through
+        :param key: cache key of the response, one refresh per key
+        :param method: HTTP method of the request
+        :param path: path of the request
+        :param fetch: coroutine function requesting and caching the response"""
+        if key in self._revalidations:
+            return
+        breaker = self._breakers.get(method, path)
 
-    async def _post(self, path, **kwargs) -> ClientResponse:
-        """Post request to the server
+        async def revalidate() -> None:
+            try:
+                await asyncio.sleep(max(0.0, breaker.retry_at - time.monotonic()))
+                # outlives the request that served the stale response
+                with detached():
+                    await fetch()
+            except Exception as exc:
+                # the next stale hit tries again
+                self._logger.debug("Revalidating %s failed: %s", path, exc)
+            finally:
+                del self._revalidations[key]
+
+        self._revalidations[key] = asyncio.create_task(revalidate())
+
+    async def _open(self, method: str, path: str, **kwargs) -> "ClientResponse":
+        """Send a request, the caller reads and releases the response
+        :param method: HTTP method
         :param path: path of the request
         :param kwargs: additional parameters for the request
         :return: response from the server"""
-        await self._get_token()
         headers = kwargs.pop("headers", self._headers)
-        return await self._csession.post(urljoin(self._base_url, path),
-                                         ssl=self._ssl,
-                                         headers=headers,
-                                         **kwargs)
+        return await self._transport.request(method,
+                                             urljoin(self._base_url, path),
+                                             ssl=self._ssl,
+                                             headers=headers,
+                                             **kwargs)
+
+    async def _request(self, method: str, path: str,
+                       **kwargs) -> "ClientResponse":
+        """Send a request and read the body while holding a limiter slot
+        :param method: HTTP method
+        :param path: path of the request
+        :param kwargs: additional parameters for the request
+        :return: response from the server with the body read
+        :raises DeadlineExceeded: if the deadline of the caller passed"""
+        async with enforce():
+            await self._get_token()
+            breaker = self._breakers.get(method, path)
+            # fail fast, before waiting for a slot
+            breaker.before()
+            try:
+                async with self._limiter:
+                    started = time.monotonic()
+                    response = await self._open(method, path, **kwargs)
+                    # the connection is busy until the body is read
+                    await response.read()
+            except BaseException as exc:
+                if isinstance(exc, Exception) and is_upstream_failure(exc):
+                    breaker.failure()
+                else:
+                    breaker.release()
+                raise
+            breaker.success(time.monotonic() - started)
+            return response
+
+    async def _post(self, path, **kwargs) -> "ClientResponse":
+        """Post request to the server
+        :param path: path of the request
+        :param kwargs: additional parameters for the request
+        :return: response from the server"""
+        return await self._request("POST", path, **kwargs)
 
-    async def _get(self, path, **kwargs) -> ClientResponse:
+    async def _get(self, path, **kwargs) -> "ClientResponse":
         """Get request to the server
         :param path: path of the request
         :param kwargs: additional parameters for the request
         :return: response from the server"""
-        await self._get_token()
-        headers = kwargs.pop("headers", self._headers)
-        return await self._csession.get(urljoin(self._base_url, path),
-                                        ssl=self._ssl,
-                                        headers=headers,
-                                        **kwargs)
+        return await self._request("GET", path, **kwargs)
 
-    async def _put(self, path, **kwargs) -> ClientResponse:
+    async def _put(self, path, **kwargs) -> "ClientResponse":
         """Put request to the server
         :param path: path of the request
         :param kwargs: additional parameters for the request
         :return: response from the server"""
-        await self._get_token()
-        headers = kwargs.pop("headers", self._headers)
-        return await self._csession.put(urljoin(self._base_url, path),
-                                        ssl=self._ssl,
-                                        headers=headers,
-                                        **kwargs)
+        return await self._request("PUT", path, **kwargs)
 
-    async def _delete(self, path, **kwargs) -> ClientResponse:
+    async def _delete(self, path, **kwargs) -> "ClientResponse":
         """Delete request to the server
         :param path: path of the request
         :param kwargs: additional parameters for the request
         :return: response from the server"""
-        await self._get_token()
-        headers = kwargs.pop("headers", self._headers)
-        return await self._csession.delete(urljoin(self._base_url, path),
-                                           ssl=self._ssl,
-                                           headers=headers,
-                                           **kwargs)
+        return await self._request("DELETE", path, **kwargs)
 
+    @budgeted
     async def get_chargepoints(self) -> list[ChargePoint]:
         """Get all owned chargepoints
         :return: list of ChargePoint objects"""
         request_uri = f"/api/{API_VERSION}/chargepoints/owned"
-        response = await self._get(request_uri)
+        data = await self._get_cached(request_uri, CHARGEPOINTS_CACHE_TTL,
+                                      "chargepoints")
         res = []
-        for chargepoint in await response.json():
+        for chargepoint in json.loads(data):
             res.append(ChargePoint.from_dict(chargepoint))
         return res
 
+    @budgeted
     async def get_registered_rfid_tags(self, charge_point_id: str) -> list:
         """Get all registered RFID tags for a specific charge point.
         :param charge_point_id: ID of the charge point
         :return: list of RFID tags"""
-        charging_sessions = await self.get_chargingsessions(charge_point_id)
+        key = self._cache_key("rfid-tags", charge_point_id)
+        try:
+            charging_sessions = await self.get_chargingsessions(charge_point_id)
+        except Exception as exc:
+            if not (isinstance(exc, CircuitOpenError)
+                    or is_upstream_failure(exc)):
+                raise
+            data = await self._cache.get(key)
+            if data is None:
+                raise
+            self._logger.warning("Serving stale RFID tags: %s", exc)
+            mark_stale("rfid tags")
+            return json.loads(data)
         rfid_tags = []
         for c_session in charging_sessions:
             if c_session.rfid not in rfid_tags and c_session.rfid != UNUSED_RFID_SLOT:
                 rfid_tags.append(c_session.rfid)
+        await self._cache.set(key, json.dumps(rfid_tags).encode(),
+                              STALE_CACHE_TTL)
         return rfid_tags
 
+    @budgeted
     async def get_chargepoint_status(
             self, charge_point_id: str) -> ChargePointStatus:
         """Get charge point status
@@ -427,6 +952,7 @@ class Session:
         payload = await response.json()
         return ChargePointStatus.from_dict(payload)
 
+    @budgeted
     async def get_connector_chargingsessions(
             self,
             charge_point_id: str,
@@ -439,18 +965,15 @@ class Session:
         :param start_time: start time of the charging session
         :param end_time: end time of the charging session
         :return: list of ChargingSession objects"""
-        query_params = {}
-        if start_time:
-            query_params["startTime"] = start_time.isoformat()
-        if end_time:
-            query_params["endTime"] = end_time.isoformat()
-        request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/connectors/{connector_id}/chargingsessions"
-        response = await self._get(request_uri, params=query_params)
-        res = []
-        for session in await response.json():
-            res.append(ChargingSession.from_dict(session))
-        return res
-
+        return [
+            session async for session in self.iter_connector_chargingsessions(
+                charge_point_id=charge_point_id,
+                connector_id=connector_id,
+                start_time=start_time,
+                end_time=end_time)
+        ]
+
+    @budgeted
     async def get_rfid_chargingsessions(
             self,
             charge_point_id: str,
@@ -461,24 +984,20 @@ class Session:
         """Get all charging sessions of a specific connector
         :param charge_point_id: ID of the charge point
         :param connector_id: ID of the connector
-        :param rfid: RFID tag of the user
+        :param rfid: RFID tag of the user as hex, decimal or reversed decimal
         :param start_time: start time of the charging session
         :param end_time: end time of the charging session
         :return: list of ChargingSession objects"""
-        query_params = {}
-        if start_time:
-            query_params["startTime"] = start_time.isoformat()
-        if end_time:
-            query_params["endTime"] = end_time.isoformat()
-        request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/connectors/{connector_id}/chargingsessions"
-        response = await self._get(request_uri, params=query_params)
-        res = []
-        for session in await response.json():
-            chrgSession = ChargingSession.from_dict(session)
-            if chrgSession.rfid == rfid:
-                res.append(chrgSession)
-        return res
-
+        return [
+            session async for session in self.iter_rfid_chargingsessions(
+                charge_point_id=charge_point_id,
+                connector_id=connector_id,
+                rfid=rfid,
+                start_time=start_time,
+                end_time=end_time)
+        ]
+
+    @budgeted
     async def get_chargingsessions(
             self,
             charge_point_id: str,
@@ -489,18 +1008,181 @@ class Session:
         :param start_time: start time of the charging session
         :param end_time: end time of the charging session
         :return: list of ChargingSession objects"""
+        return [
+            session async for session in self.iter_chargingsessions(
+                charge_point_id=charge_point_id,
+                start_time=start_time,
+                end_time=end_time)
+        ]
+
+    async def _iter_sessions(
+            self, request_uri: str,
+            start_time: datetime | None,
+            end_time: datetime | None) -> AsyncIterator[ChargingSession]:
+        """Stream charging sessions from a session list endpoint.
+        The body is decoded element by element while it is downloaded.
+        Lists of completed time ranges are kept in the response cache.
+        :param request_uri: path of the session list endpoint
+        :param start_time: start time of the charging session
+        :param end_time: end time of the charging session
+        :return: async iterator over ChargingSession objects"""
         query_params = {}
         if start_time:
             query_params["startTime"] = start_time.isoformat()
         if end_time:
             query_params["endTime"] = end_time.isoformat()
+        cacheable = end_time is not None and end_time < datetime.now(
+            end_time.tzinfo) - COMPLETED_SESSIONS_MARGIN
+        key = self._cache_key("GET", request_uri,
+                              json.dumps(query_params, sort_keys=True))
+        if cacheable:
+            data = await self._cache.get(key)
+            if data is not None:
+                for session in self._decode_sessions(data):
+                    yield session
+                return
+        streamed = False
+        try:
+            async for session in self._stream_sessions(
+                    request_uri, query_params, key if cacheable else None):
+                streamed = True
+                yield session
+        except Exception as exc:
+            # completed lists are final, the last known good one is still right
+            if streamed or not cacheable or not (
+                    isinstance(exc, CircuitOpenError)
+                    or is_upstream_failure(exc)):
+                raise
+            data = await self._cache.get(key + "|stale")
+            if data is None:
+                raise
+            self._logger.warning("Serving stale charging sessions: %s", exc)
+            mark_stale("chargingsessions")
+            for session in self._decode_sessions(data):
+                yield session
+
+    def _decode_sessions(self, data: bytes) -> Iterator[ChargingSession]:
+        """Decode a cached session list
+        :param data: raw response body
+        :return: iterator over ChargingSession objects"""
+        for session in JsonArrayDecoder().feed(data):
+            session = ChargingSession.from_dict(session)
+            self._rfid_index.add_record(session)
+            yield session
+
+    async def _stream_sessions(
+            self, request_uri: str, query_params: dict,
+            cache_key: str | None) -> AsyncIterator[ChargingSession]:
+        """Request a session list and decode it while it is downloaded
+        :param request_uri: path of the session list endpoint
+        :param query_params: query parameters of the request
+        :param cache_key: key the complete body is cached under, None to not cache
+        :return: async iterator over ChargingSession objects
+        :raises DeadlineExceeded: if the deadline passed, checked per chunk"""
+        chunks = []
+        async with enforce():
+            await self._get_token()
+        breaker = self._breakers.get("GET", request_uri)
+        breaker.before()
+        try:
+            # the slot is held while the body streams in
+            async with contextlib.AsyncExitStack() as stack:
+                # a deadline must not span the yields below
+                async with enforce():
+                    await stack.enter_async_context(self._limiter)
+                    started = time.monotonic()
+                    response = await self._open("GET",
+                                                request_uri,
+                                                params=query_params)
+                breaker.success(time.monotonic() - started)
+
+                async def body():
+                    while True:
+                        async with enforce():
+                            chunk = await response.content.read(
+                                STREAM_CHUNK_SIZE)
+                        if not chunk:
+                            return
+                        if cache_key is not None:
+                            chunks.append(chunk)
+                        yield chunk
+
+                try:
+                    async for session in iter_json_array(body()):
+                        session = ChargingSession.from_dict(session)
+                        self._rfid_index.add_record(session)
+                        yield session
+                finally:
+                    await response.release()
+        except BaseException as exc:
+            if isinstance(exc, Exception) and is_upstream_failure(exc):
+                breaker.failure()
+            else:
+                breaker.release()
+            raise
+        if cache_key is not None:
+            data = b"".join(chunks)
+            await self._cache.set(cache_key, data,
+                                  COMPLETED_SESSIONS_CACHE_TTL)
+            await self._cache.set(cache_key + "|stale", data, STALE_CACHE_TTL)
+
+    @budgeted
+    def iter_connector_chargingsessions(
+            self,
+            charge_point_id: str,
+            connector_id: int,
+            start_time: datetime | None = None,
+            end_time: datetime | None = None
+    ) -> AsyncIterator[ChargingSession]:
+        """Stream all charging sessions of a specific connector
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param start_time: start time of the charging session
+        :param end_time: end time of the charging session
+        :return: async iterator over ChargingSession objects"""
+        request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/connectors/{connector_id}/chargingsessions"
+        return self._iter_sessions(request_uri, start_time, end_time)
+
+    @budgeted
+    async def iter_rfid_chargingsessions(
+            self,
+            charge_point_id: str,
+            connector_id: int,
+            rfid: str,
+            start_time: datetime | None = None,
+            end_time: datetime | None = None
+    ) -> AsyncIterator[ChargingSession]:
+        """Stream all charging sessions of a specific connector and RFID tag
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param rfid: RFID tag of the user as hex, decimal or reversed decimal
+        :param start_time: start time of the charging session
+        :param end_time: end time of the charging session
+        :return: async iterator over ChargingSession objects"""
+        async for session in self.iter_connector_chargingsessions(
+                charge_point_id=charge_point_id,
+                connector_id=connector_id,
+                start_time=start_time,
+                end_time=end_time):
+            if matches(session, rfid):
+                yield session
+
+    @budgeted
+    def iter_chargingsessions(
+            self,
+            charge_point_id: str,
+            start_time: datetime | None = None,
+            end_time: datetime | None = None
+    ) -> AsyncIterator[ChargingSession]:
+        """Stream all charging sessions of a charge point
+        :param charge_point_id: ID of the charge point
+        :param start_time: start time of the charging session
+        :param end_time: end time of the charging session
+        :return: async iterator over ChargingSession objects"""
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/chargingsessions"
-        response = await self._get(request_uri, params=query_params)
-        res = []
-        for session in await response.json():
-            res.append(ChargingSession.from_dict(session))
-        return res
+        return self._iter_sessions(request_uri, start_time, end_time)
 
+    @budgeted
     async def get_specific_chargingsession(
             self,
             charge_point_id: str,
@@ -525,6 +1207,7 @@ class Session:
             res.append(ChargingSession.from_dict(session))
         return res
 
+    @budgeted
     async def get_chargepoint_connector_settings(
             self, charge_point_id: str,
             connector_id: int) -> ChargePointConnectorSettings:
@@ -537,6 +1220,7 @@ class Session:
         payload = await response.json()
         return ChargePointConnectorSettings.from_dict(payload)
 
+    @budgeted
     async def get_chargepoint_settings(
             self, charge_point_id: str) -> ChargePointSettings:
         """Get chargepoint settings
@@ -547,6 +1231,7 @@ class Session:
         payload = await response.json()
         return ChargePointSettings.from_dict(payload)
 
+    @budgeted
     async def get_chargepoint_partner(
             self, charge_point_id: str) -> ChargePointPartner:
         """Get chargepoint settings
@@ -557,6 +1242,7 @@ class Session:
         payload = await response.json()
         return ChargePointPartner.from_dict(payload)
 
+    @budgeted
     async def get_chargepoint_override_status(
             self, charge_point_id: str) -> ChargePointScheduleOverrideStatus:
         """Get chargepoint settings
@@ -567,6 +1253,7 @@ class Session:
         payload = await response.json()
         return ChargePointScheduleOverrideStatus.from_dict(payload)
 
+    @budgeted
     async def get_chargepoint_schedules(
             self, charge_point_id: str) -> list[ChargePointSchedule]:
         """Get chargepoint settings
@@ -575,11 +1262,9 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/schedules"
         response = await self._get(request_uri)
         payload = await response.json()
-        res = []
-        for session in await response.json():
-            res.append(ChargePointSchedule.from_dict(session))
-        return res
+        return [ChargePointSchedule.from_dict(schedule) for schedule in payload]
 
+    @budgeted
     async def get_chargepoint_schedule(
             self, charge_point_id: str,
             schedule_id: int) -> ChargePointSchedule:
@@ -592,6 +1277,7 @@ class Session:
         payload = await response.json()
         return ChargePointSchedule.from_dict(payload)
 
+    @budgeted
     async def get_user(self, user_id: str) -> ChargeAmpsUser:
         """Get chargepoint settings
         :param user_id: ID of the user
@@ -601,6 +1287,7 @@ class Session:
         payload = await response.json()
         return ChargeAmpsUser.from_dict(payload)
 
+    @budgeted
     async def set_chargepoint_settings(self,
                                        settings: ChargePointSettings) -> None:
         """Set chargepoint settings
@@ -611,6 +1298,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/settings"
         await self._put(request_uri, json=payload)
 
+    @budgeted
     async def set_chargepoint_connector_settings(
             self, settings: ChargePointConnectorSettings) -> None:
         """Get all owned chargepoints
@@ -622,6 +1310,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/connectors/{connector_id}/settings"
         await self._put(request_uri, json=payload)
 
+    @budgeted
     async def set_chargepoint_schedule_override(self, charge_point_id: str,
                                                 connector_id: int) -> None:
         """override chargepoint schedule
@@ -631,6 +1320,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/connectors/{connector_id}/schedule/override"
         await self._put(request_uri, json="{}")
 
+    @budgeted
     async def remote_start(self, charge_point_id: str, connector_id: int,
                            start_auth: StartAuth) -> None:
         """Remote start chargepoint
@@ -642,6 +1332,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/connectors/{connector_id}/remotestart"
         await self._put(request_uri, json=payload)
 
+    @budgeted
     async def remote_stop(self, charge_point_id: str,
                           connector_id: int) -> None:
         """Remote stop chargepoint
@@ -651,6 +1342,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/connectors/{connector_id}/remotestop"
         await self._put(request_uri, json="{}")
 
+    @budgeted
     async def reboot(self, charge_point_id: str) -> None:
         """Reboot chargepoint
         :param charge_point_id: ID of the charge point
@@ -658,6 +1350,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/reboot"
         await self._put(request_uri, json="{}")
 
+    @budgeted
     async def register(self, charge_point_id: str,
                        chrg_point_auth: ChargePointAuth) -> None:
         """Register chargepoint to auth user
@@ -668,6 +1361,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/register"
         await self._put(request_uri, json=payload)
 
+    @budgeted
     async def update_schedule(self, charge_point_id: str,
                               chrg_schedule: ChargePointSchedule) -> None:
         """Update charge schedules. For CAPI charger only
@@ -678,6 +1372,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/schedules"
         await self._put(request_uri, json=payload)
 
+    @budgeted
     async def register(self, charge_point_id: str,
                        chrg_point_auth: ChargePointAuth) -> None:
         """Unregister chargepoint from user
@@ -688,6 +1383,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/unregister"
         await self._put(request_uri, json=payload)
 
+    @budgeted
     async def disable(self, chrg_point_ids: ChargePointIds) -> None:
         """Disable callback on chargepoints
         :param chrg_point_ids: ChargePointIds object
@@ -696,6 +1392,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/callbacks/disable"
         await self._put(request_uri, json=payload)
 
+    @budgeted
     async def enable(self, chrg_point_ids: ChargePointIds) -> None:
         """Enable callback on chargepoints
         :param chrg_point_ids: ChargePointIds object
@@ -704,6 +1401,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/callbacks/enable"
         await self._put(request_uri, json=payload)
 
+    @budgeted
     async def create_schedule(self, charge_point_id: str,
                               chrg_schedule: ChargePointSchedule) -> None:
         """create charge schedules. For CAPI charger only
@@ -714,6 +1412,7 @@ class Session:
         request_uri = f"/api/{API_VERSION}/chargepoints/{charge_point_id}/schedules"
         await self._post(request_uri, json=payload)
 
+    @budgeted
     async def delete_schedule(self, charge_point_id: str,
                               schedule_id: int) -> None:
         """Delete charge schedules. For CAPI charger only
@@ -0,0 +1,211 @@
+"""
+Circuit breakers of the upstream endpoints.
+Every endpoint (method and path with the IDs removed) gets a breaker. After a row of
+failed or slow requests it opens and further requests fail at once instead of
+waiting for the timeout. After a pause one probe request is let through, which
+closes the breaker again on success. While a breaker is open, cached results are
+served as stale, see Session._get_cached.
+"""
+import contextvars
+import re
+import time
+
+from deadlines import DeadlineExceeded
+
+DEFAULT_FAILURE_THRESHOLD = 5
+# a request taking longer counts as failure, the endpoint is overloaded
+DEFAULT_SLOW_CALL = 10.0
+DEFAULT_RESET_TIMEOUT = 30.0
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+_ID_SEGMENT = re.compile(r"\d")
+
+# names of the results served stale in the current request, see mark_stale
+_stale = contextvars.ContextVar("stale_results", default=None)
+# names of the results missing parts in the current request, see mark_partial
+_partial = contextvars.ContextVar("partial_results", default=None)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to an endpoint with an open breaker"""
+
+    def __init__(self, endpoint: str, retry_at: float):
+        super().__init__(f"Circuit of {endpoint} is open")
+        self.endpoint = endpoint
+        self.retry_at = retry_at
+
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    """Check if an exception means the upstream is unhealthy
+    Client errors (4xx, except 429) are answers of a healthy upstream, a passed
+    deadline of the caller says nothing about it.
+    :param exc: exception of a request
+    :return: True if the exception counts against the breaker"""
+    if isinstance(exc, DeadlineExceeded):
+        return False
+    status = getattr(exc, "status", None)
+    if isinstance(status, int):
+        return status >= 500 or status == 429
+    return isinstance(exc, (OSError, TimeoutError)) or (
+        exc.__class__.__module__.startswith(("aiohttp", "httpx", "httpcore")))
+
+
+def endpoint_of(method: str, path: str) -> str:
+    """Name the endpoint of a request, IDs are replaced by *
+    :param method: HTTP method
+    :param path: path of the request
+    :return: e.g. GET /api/v5/chargepoints/*/status"""
+    segments = path.split("?", 1)[0].split("/")
+    # keep /api/v5
+    return method + " " + "/".join(
+        segments[:3] + ["*" if _ID_SEGMENT.search(segment) else segment
+                        for segment in segments[3:]])
+
+
+def track_stale() -> None:
+    """Start collecting the stale and partial results of a request, tasks started by
+    the request report into the same lists"""
+    _stale.set([])
+    _partial.set([])
+
+
+def mark_stale(name: str) -> None:
+    """Note that a stale result was served in the current request
+    :param name: name of the result, e.g. chargepoints"""
+    stale = _stale.get()
+    if stale is None:
+        stale = []
+        _stale.set(stale)
+    if name not in stale:
+        stale.append(name)
+
+
+def stale_results() -> list[str]:
+    """Get the names of the stale results served in the current request
+    :return: list of names, empty if everything was fresh"""
+    return list(_stale.get() or [])
+
+
+def mark_partial(name: str) -> None:
+    """Note that a result of the current request misses a failed part
+    :param name: name of the missing part, e.g. sessions of 2012345678M"""
+    partial = _partial.get()
+    if partial is None:
+        partial = []
+        _partial.set(partial)
+    if name not in partial:
+        partial.append(name)
+
+
+def partial_results() -> list[str]:
+    """Get the names of the parts missing in the results of the current request
+    :return: list of names, empty if everything was complete"""
+    return list(_partial.get() or [])
+
+
+class CircuitBreaker:
+    """
+    Breaker of a single endpoint"""
+
+    def __init__(self,
+                 endpoint: str,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 slow_call: float = DEFAULT_SLOW_CALL,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+                 clock=time.monotonic):
+        """
+        Circuit breaker
+        :param endpoint: name of the endpoint
+        :param failure_threshold: failed or slow requests in a row opening the breaker
+        :param slow_call: seconds after which a successful request counts as failure
+        :param reset_timeout: seconds the breaker stays open before a probe
+        :param clock: time source"""
+        self.endpoint = endpoint
+        self._failure_threshold = failure_threshold
+        self._slow_call = slow_call
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return CLOSED
+        if self._clock() - self._opened_at >= self._reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    @property
+    def retry_at(self) -> float:
+        """Clock time of the next probe, 0 if the breaker is closed"""
+        if self._opened_at is None:
+            return 0.0
+        return self._opened_at + self._reset_timeout
+
+    def before(self) -> None:
+        """Ask for permission to send a request
+        :raises CircuitOpenError: if the breaker is open or a probe is running"""
+        state = self.state
+        if state == CLOSED:
+            return
+        if state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return
+        raise CircuitOpenError(self.endpoint, self.retry_at)
+
+    def success(self, seconds: float) -> None:
+        """Record a successful request
+        :param seconds: duration of the request"""
+        if seconds > self._slow_call:
+            self.failure()
+            return
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def failure(self) -> None:
+        """Record a failed request"""
+        self._failures += 1
+        if self._probing or self._failures >= self._failure_threshold:
+            self._opened_at = self._clock()
+        self._probing = False
+
+    def release(self) -> None:
+        """Forget a request that neither failed nor succeeded, e.g. a cancelled one"""
+        self._probing = False
+
+
+class BreakerRegistry:
+    """
+    One CircuitBreaker per endpoint"""
+
+    def __init__(self, **breaker_options):
+        """
+        Breakers of a session
+        :param breaker_options: see CircuitBreaker"""
+        self._options = breaker_options
+        self._breakers = {}
+
+    def get(self, method: str, path: str) -> CircuitBreaker:
+        """Get the breaker of a request
+        :param method: HTTP method
+        :param path: path of the request
+        :return: CircuitBreaker object"""
+        endpoint = endpoint_of(method, path)
+        if endpoint not in self._breakers:
+            self._breakers[endpoint] = CircuitBreaker(endpoint,
+                                                      **self._options)
+        return self._breakers[endpoint]
+
+    def states(self) -> dict[str, str]:
+        """Get the state of every breaker used so far
+        :return: dict of states by endpoint"""
+        return {
+            endpoint: breaker.state
+            for endpoint, breaker in self._breakers.items()
+        }
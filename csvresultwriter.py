@@ -0,0 +1,55 @@
+import csv
+from io import StringIO
+from collections.abc import AsyncIterable, AsyncIterator
+
+
+class CsvResult:
+    """
+    Class to generate a csv file with charging sessions data."""
+
+    HEADER = [
+        "No of Charging Process", "Start", "End", "RFID tag", "kWh",
+        "cent/kWh", "total costs"
+    ]
+
+    def __init__(self, delimiter: str = ","):
+        """
+        Initialize the CsvResult class.
+        :param delimiter: field delimiter of the csv file
+        """
+        self._delimiter = delimiter
+        return None
+
+    async def iter_output_file(self,
+                               priced_sessions: AsyncIterable,
+                               flush_rows: int = 100) -> AsyncIterator[bytes]:
+        """
+        Generates a csv file chunk by chunk while the charging sessions arrive.
+        :param priced_sessions: async iterable of PricedSession objects
+        :param flush_rows: number of rows collected into one chunk
+        :return: async iterator over utf-8 encoded chunks of the csv file
+        """
+        buffer = StringIO()
+        writer = csv.writer(buffer, delimiter=self._delimiter)
+        writer.writerow(self.HEADER)
+        idx = 1
+        total_costs = 0.0
+        async for priced in priced_sessions:
+            csession = priced.session
+            writer.writerow([
+                idx,
+                csession.start_time.strftime("%Y-%m-%d %H:%M"),
+                # empty while the session is still ongoing
+                csession.end_time.strftime("%Y-%m-%d %H:%M")
+                if csession.end_time is not None else "", csession.rfid,
+                csession.total_consumption_kwh, priced.kwh_price,
+                f"{priced.total_costs:.2f}"
+            ])
+            total_costs += priced.total_costs
+            idx += 1
+            if idx % flush_rows == 0:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        writer.writerow(["", "", "", "", "", "Total Costs", f"{total_costs:.2f}"])
+        yield buffer.getvalue().encode()
@@ -0,0 +1,134 @@
+"""
+Deadlines of upstream requests.
+A deadline is set for a block of code, e.g. the handling of a web request, and
+applies to every upstream request started in it, also in tasks started from it.
+A nested deadline never extends the outer one. Waiting for the token, a limiter
+slot, the response and every chunk of a streamed body is cut off once it passed,
+which cancels the request and frees its connection.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
+import time
+
+from collections.abc import AsyncIterator
+
+# monotonic clock time, asyncio uses the same clock
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the deadline passed before an upstream request completed"""
+
+
+def _earliest(timeout: float | None) -> float | None:
+    """Get the deadline of a timeout within the current deadline"""
+    current = _deadline.get()
+    if timeout is None:
+        return current
+    deadline = time.monotonic() + timeout
+    return deadline if current is None else min(current, deadline)
+
+
+def remaining() -> float | None:
+    """Get the time left until the current deadline
+    :return: seconds, negative if the deadline passed, None without deadline"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def set_deadline(timeout: float | None) -> None:
+    """Set the deadline of the current context, e.g. in a request hook
+    :param timeout: seconds from now, None keeps the current deadline"""
+    _deadline.set(_earliest(timeout))
+
+
+@contextlib.contextmanager
+def deadline(timeout: float | None):
+    """Limit the upstream requests of the block to a time budget
+    :param timeout: seconds from now, None keeps the current deadline"""
+    token = _deadline.set(_earliest(timeout))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextlib.contextmanager
+def detached():
+    """Run the block without deadline, e.g. a background refresh started by a request"""
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextlib.asynccontextmanager
+async def enforce():
+    """Cancel the block when the current deadline passes
+    Must not span a yield of an async generator, see iter_until.
+    :raises DeadlineExceeded: if the deadline passed"""
+    left = remaining()
+    if left is None:
+        yield
+        return
+    if left <= 0:
+        raise DeadlineExceeded("Deadline exceeded")
+    timeout = asyncio.timeout(left)
+    try:
+        async with timeout:
+            yield
+    except TimeoutError as exc:
+        # aiohttp timeouts are TimeoutErrors as well
+        if not timeout.expired():
+            raise
+        raise DeadlineExceeded("Deadline exceeded") from exc
+
+
+async def iter_until(iterator: AsyncIterator,
+                     deadline_at: float | None) -> AsyncIterator:
+    """Run every step of an async iterator under a deadline
+    The consumer runs between the steps and does not inherit the deadline.
+    :param iterator: async iterator
+    :param deadline_at: monotonic clock time, None for no deadline
+    :return: async iterator over the same items"""
+    try:
+        while True:
+            token = _deadline.set(deadline_at)
+            try:
+                item = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            finally:
+                _deadline.reset(token)
+            yield item
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def budgeted(func):
+    """Add a timeout keyword to a coroutine function or a function returning an
+    async iterator. The timeout is a budget in seconds for all upstream requests
+    of the call, including concurrent and streamed ones. Without it the deadline
+    of the caller applies."""
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, timeout: float | None = None, **kwargs):
+            with deadline(timeout):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    @functools.wraps(func)
+    def iter_wrapper(*args, timeout: float | None = None, **kwargs):
+        return iter_until(func(*args, **kwargs), _earliest(timeout))
+
+    return iter_wrapper
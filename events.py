@@ -0,0 +1,202 @@
+"""
+Push based charger events.
+Charge amps posts charging sessions and connector statuses to a callback URL once
+callbacks are enabled for a charge point. The receiver parses them into events,
+keeps the newest state per connector and fans the events out to subscribers, so
+status polling is only needed when no push arrived for a while.
+"""
+import asyncio
+import time
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+# the data classes load dataclasses_json, imported when the first callback arrives
+if TYPE_CHECKING:
+    from chargeampsdata import ChargingSession, ChargePointConnectorStatus
+
+SESSION_EVENT = "session"
+STATUS_EVENT = "status"
+# a connector without a push for this long is polled again
+PUSH_FRESHNESS = 300
+MAX_CALLBACK_BYTES = 1024 * 1024
+DEFAULT_QUEUE_SIZE = 1000
+RECENT_SESSIONS = 50
+
+
+@dataclass(frozen=True)
+class Event:
+    """Class representing a pushed charging session or connector status."""
+    kind: str
+    charge_point_id: str
+    connector_id: int
+    data: "ChargingSession | ChargePointConnectorStatus"
+    received: float = field(default_factory=time.time)
+
+    @property
+    def key(self) -> tuple[str, int]:
+        return (self.charge_point_id, self.connector_id)
+
+
+def parse_events(payload) -> list[Event]:
+    """Parse the body of a callback
+    Accepts a charging session, a connector status, a charge point status with
+    connector statuses, or a list of them.
+    :param payload: decoded JSON body
+    :return: list of Event objects
+    :raises ValueError: if an entry is none of the known objects"""
+    from chargeampsdata import (ChargingSession, ChargePointConnectorStatus,
+                                ChargePointStatus)
+
+    entries = payload if isinstance(payload, list) else [payload]
+    events = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise ValueError("Callback entries must be objects")
+        try:
+            if "connectorStatuses" in entry:
+                status = ChargePointStatus.from_dict(entry)
+                events.extend(
+                    Event(STATUS_EVENT, connector.charge_point_id,
+                          connector.connector_id, connector)
+                    for connector in status.connector_statuses)
+            elif "sessionType" in entry:
+                session = ChargingSession.from_dict(entry)
+                events.append(
+                    Event(SESSION_EVENT, session.charge_point_id,
+                          session.connector_id, session))
+            elif "status" in entry:
+                connector = ChargePointConnectorStatus.from_dict(entry)
+                events.append(
+                    Event(STATUS_EVENT, connector.charge_point_id,
+                          connector.connector_id, connector))
+            else:
+                raise ValueError("Unknown callback object")
+        except (KeyError, TypeError, AttributeError) as exc:
+            raise ValueError(f"Invalid callback object: {exc}") from exc
+    return events
+
+
+class EventBus:
+    """
+    Fans events out to subscriber queues without blocking the receiver"""
+
+    def __init__(self):
+        self._subscribers = {}
+        # events dropped because a subscriber fell behind
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, event: Event) -> None:
+        """Queue an event for every subscriber of its kind
+        A full queue drops its oldest event, a slow subscriber never delays the
+        callback response.
+        :param event: Event object"""
+        for queue, kinds in self._subscribers.items():
+            if kinds and event.kind not in kinds:
+                continue
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(event)
+
+    def subscribe(self,
+                  *kinds: str,
+                  queue_size: int = DEFAULT_QUEUE_SIZE) -> "Subscription":
+        """Start receiving events, events published from now on are queued
+        :param kinds: event kinds to receive, default is all
+        :param queue_size: events kept while the subscriber is busy
+        :return: Subscription object, close it when done"""
+        queue = asyncio.Queue(queue_size)
+        self._subscribers[queue] = frozenset(kinds)
+        return Subscription(self, queue)
+
+    def _unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.pop(queue, None)
+
+
+class Subscription:
+    """
+    Async iterator of the events of an EventBus subscriber"""
+
+    def __init__(self, bus: EventBus, queue: asyncio.Queue):
+        self._bus = bus
+        self._queue = queue
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> Event:
+        return await self._queue.get()
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stop receiving events"""
+        self._bus._unsubscribe(self._queue)
+
+
+class LiveState:
+    """
+    Newest pushed status and recent sessions per connector"""
+
+    def __init__(self, recent_sessions: int = RECENT_SESSIONS):
+        """
+        Connector state from callbacks
+        :param recent_sessions: sessions kept per connector"""
+        self._statuses = {}
+        self._sessions = {}
+        # newest push per charge point
+        self._updated = {}
+        self._recent_sessions = recent_sessions
+
+    def apply(self, event: Event) -> None:
+        """Update the state of the connector of an event
+        :param event: Event object"""
+        self._updated[event.charge_point_id] = max(
+            event.received, self._updated.get(event.charge_point_id, 0.0))
+        if event.kind == STATUS_EVENT:
+            self._statuses[event.key] = event.data
+            return
+        sessions = self._sessions.setdefault(event.key, OrderedDict())
+        # a running session is pushed again when it ends
+        sessions.pop(event.data.id, None)
+        sessions[event.data.id] = event.data
+        while len(sessions) > self._recent_sessions:
+            sessions.popitem(last=False)
+
+    def status(self, charge_point_id: str,
+               connector_id: int) -> "ChargePointConnectorStatus | None":
+        """Get the newest pushed status of a connector
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :return: ChargePointConnectorStatus object or None"""
+        return self._statuses.get((charge_point_id, connector_id))
+
+    def sessions(self, charge_point_id: str,
+                 connector_id: int) -> list["ChargingSession"]:
+        """Get the recently pushed sessions of a connector
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :return: list of ChargingSession objects, newest last"""
+        return list(self._sessions.get((charge_point_id, connector_id),
+                                       {}).values())
+
+    def is_fresh(self,
+                 charge_point_id: str,
+                 max_age: float = PUSH_FRESHNESS,
+                 now: float | None = None) -> bool:
+        """Check if a charge point pushed recently
+        :param charge_point_id: ID of the charge point
+        :param max_age: seconds a push is trusted
+        :param now: seconds since the epoch, defaults to now
+        :return: True if polling the charge point can be skipped"""
+        now = time.time() if now is None else now
+        return self._updated.get(charge_point_id, 0.0) >= now - max_age
@@ -0,0 +1,203 @@
+"""
+Streaming export pipeline.
+Charging sessions flow from the API through decode, RFID filter and pricing stages
+to a row writer. The stages run concurrently and are connected by bounded queues,
+so the first rows are available while later time windows are still being fetched.
+"""
+import asyncio
+import logging
+
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from chargeampsdata import ChargingSession
+from rfidindex import matches
+from watermarks import INCREMENTAL_LOOKBACK, Watermark
+
+DEFAULT_WINDOW = timedelta(days=7)
+DEFAULT_QUEUE_SIZE = 256
+
+_END = object()
+
+
+@dataclass(frozen=True)
+class PricedSession:
+    """Class representing a charging session with its costs."""
+    session: ChargingSession
+    kwh_price: float
+    total_costs: float
+
+
+def split_windows(
+        start_time: datetime | None, end_time: datetime | None,
+        window: timedelta) -> list[tuple[datetime | None, datetime | None]]:
+    """Split a time range into consecutive windows
+    :param start_time: start of the range, None for an open range
+    :param end_time: end of the range, None for an open range
+    :param window: length of a single window
+    :return: list of (start, end) tuples"""
+    if start_time is None or end_time is None:
+        return [(start_time, end_time)]
+    windows = []
+    current = start_time
+    while current < end_time:
+        upper = min(current + window, end_time)
+        windows.append((current, upper))
+        current = upper
+    return windows
+
+
+class _StageError:
+    """Marker passing a stage exception downstream"""
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+class ExportPipeline:
+    """
+    Concurrent fetch -> filter -> price pipeline for charging sessions"""
+
+    def __init__(self,
+                 client,
+                 charge_point_id: str,
+                 connector_id: int,
+                 kwh_price: float,
+                 rfid: str | None = None,
+                 start_time: datetime | None = None,
+                 end_time: datetime | None = None,
+                 window: timedelta = DEFAULT_WINDOW,
+                 queue_size: int = DEFAULT_QUEUE_SIZE,
+                 since: Watermark | None = None,
+                 archive=None):
+        """
+        Concurrent export pipeline
+        :param client: initialized Client object
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param kwh_price: price per kWh in cents
+        :param rfid: RFID tag to export in any format, None exports all tags
+        :param start_time: start time of the export
+        :param end_time: end time of the export
+        :param window: time window fetched per upstream request
+        :param queue_size: maximum number of items buffered between two stages
+        :param since: export only sessions ending after this watermark, start_time is
+            then only used for the first export
+        :param archive: SessionArchive object, windows of archived months are read from
+            it instead of the API"""
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        self._client = client
+        self._charge_point_id = charge_point_id
+        self._connector_id = connector_id
+        self._kwh_price = float(kwh_price)
+        self._rfid = rfid
+        self._since = since
+        self._archive = archive
+        if since is not None:
+            start_time = since.end_time - INCREMENTAL_LOOKBACK
+        self._windows = split_windows(start_time, end_time, window)
+        self._queue_size = queue_size
+        # newest exported session, advanced while the rows are yielded
+        self.watermark = since
+
+    def _archived(self, start: datetime | None,
+                  end: datetime | None) -> list[ChargingSession] | None:
+        """Read the sessions of a window from the archive
+        :return: list of ChargingSession objects, None if the window is not archived"""
+        if not self._archive.covers(self._charge_point_id, start, end):
+            return None
+        return self._archive.overlapping(self._charge_point_id, start, end,
+                                         self._connector_id)
+
+    async def _window(self, start: datetime | None,
+                      end: datetime | None) -> AsyncIterator[ChargingSession]:
+        """Get the sessions of a window from the archive or the API"""
+        if self._archive is not None:
+            # file access and decoding would block the event loop
+            sessions = await asyncio.to_thread(self._archived, start, end)
+            if sessions is not None:
+                for session in sessions:
+                    yield session
+                return
+        async for session in self._client.iter_connector_chargingsessions(
+                charge_point_id=self._charge_point_id,
+                connector_id=self._connector_id,
+                start_time=start,
+                end_time=end):
+            yield session
+
+    async def _fetch(self, out_q: asyncio.Queue) -> None:
+        """Fetch and decode sessions window by window"""
+        seen = set()
+        for start, end in self._windows:
+            async for session in self._window(start, end):
+                # sessions spanning a window border are returned twice
+                if session.id in seen:
+                    continue
+                seen.add(session.id)
+                await out_q.put(session)
+
+    async def _filter(self, in_q: asyncio.Queue, out_q: asyncio.Queue) -> None:
+        """Drop sessions of other RFID tags"""
+        while (item := await in_q.get()) is not _END:
+            if isinstance(item, _StageError):
+                await out_q.put(item)
+                return
+            if self._rfid is not None and not matches(item, self._rfid):
+                continue
+            if self._since is not None and not self._since.is_before(item):
+                continue
+            await out_q.put(item)
+
+    async def _price(self, in_q: asyncio.Queue, out_q: asyncio.Queue) -> None:
+        """Attach costs to sessions"""
+        while (item := await in_q.get()) is not _END:
+            if isinstance(item, _StageError):
+                await out_q.put(item)
+                return
+            await out_q.put(
+                PricedSession(session=item,
+                              kwh_price=self._kwh_price,
+                              total_costs=item.total_consumption_kwh *
+                              self._kwh_price / 100))
+
+    @staticmethod
+    async def _run_stage(stage, out_q: asyncio.Queue, *args) -> None:
+        """Run a stage and signal its end or failure downstream"""
+        try:
+            await stage(*args, out_q)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            await out_q.put(_StageError(exc))
+            return
+        await out_q.put(_END)
+
+    async def __aiter__(self) -> AsyncIterator[PricedSession]:
+        """Run the pipeline and yield priced sessions in arrival order"""
+        fetched = asyncio.Queue(self._queue_size)
+        filtered = asyncio.Queue(self._queue_size)
+        priced = asyncio.Queue(self._queue_size)
+        tasks = [
+            asyncio.create_task(self._run_stage(self._fetch, fetched)),
+            asyncio.create_task(
+                self._run_stage(self._filter, filtered, fetched)),
+            asyncio.create_task(self._run_stage(self._price, priced,
+                                                filtered)),
+        ]
+        try:
+            while (item := await priced.get()) is not _END:
+                if isinstance(item, _StageError):
+                    raise item.exc
+                if item.session.end_time is not None:
+                    mark = Watermark.of(item.session)
+                    if self.watermark is None or mark > self.watermark:
+                        self.watermark = mark
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
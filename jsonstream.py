@@ -0,0 +1,122 @@
+"""
+Incremental decoding of JSON arrays.
+The charge amps API returns large lists of charging sessions as a single JSON array.
+This module splits such an array into its elements while the body is still arriving,
+so every element can be decoded and handed on without buffering the whole response.
+"""
+import json
+import re
+
+from collections.abc import AsyncIterable, AsyncIterator, Callable
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# characters that change the scanner state outside and inside of strings
+_STRUCTURAL = re.compile(rb'[\[\]{},"]')
+_STRING_SPECIAL = re.compile(rb'["\\]')
+
+
+class JsonArrayDecoder:
+    """
+    Push decoder splitting a top level JSON array into its elements"""
+
+    def __init__(self, loads: Callable[[bytes], object] | None = None):
+        """
+        Push decoder for a top level JSON array
+        :param loads: function decoding a single element, defaults to orjson if installed"""
+        self._loads = loads or _loads
+        self._buffer = bytearray()
+        self._pos = 0
+        self._element_start = 0
+        self._depth = 0
+        self._in_string = False
+        self._started = False
+        self._finished = False
+
+    def feed(self, data: bytes) -> list:
+        """Feed the next chunk of the body
+        :param data: raw bytes of the body
+        :return: list of elements completed by this chunk"""
+        if self._finished:
+            return []
+        buf = self._buffer
+        buf += data
+        elements = []
+        pos = self._pos
+        while True:
+            if self._in_string:
+                match = _STRING_SPECIAL.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                pos = match.start()
+                if buf[pos] == 0x5C:  # backslash escapes the next byte
+                    if pos + 1 >= len(buf):
+                        break
+                    pos += 2
+                    continue
+                self._in_string = False
+                pos += 1
+                continue
+            match = _STRUCTURAL.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            pos = match.start()
+            char = buf[pos]
+            if not self._started:
+                if char != 0x5B:
+                    raise ValueError("JSON body is not an array")
+                self._started = True
+                self._depth = 1
+                self._element_start = pos + 1
+            elif char == 0x22:  # "
+                self._in_string = True
+            elif char in (0x5B, 0x7B):  # [ {
+                self._depth += 1
+            elif char in (0x5D, 0x7D):  # ] }
+                self._depth -= 1
+                if self._depth == 0:
+                    self._emit(pos, elements)
+                    self._finished = True
+                    break
+            elif self._depth == 1:  # comma between two elements
+                self._emit(pos, elements)
+                self._element_start = pos + 1
+            pos += 1
+        # drop consumed bytes, the incomplete element stays in the buffer
+        consumed = min(self._element_start, pos)
+        del buf[:consumed]
+        self._pos = pos - consumed
+        self._element_start -= consumed
+        return elements
+
+    def _emit(self, end: int, elements: list) -> None:
+        """Decode the element between the last separator and end"""
+        raw = bytes(self._buffer[self._element_start:end]).strip()
+        if raw:
+            elements.append(self._loads(raw))
+
+    def close(self) -> None:
+        """Check that the array was complete
+        :raises ValueError: if the body ended in the middle of the array"""
+        if not self._finished:
+            raise ValueError("Incomplete JSON array")
+
+
+async def iter_json_array(
+        chunks: AsyncIterable[bytes],
+        loads: Callable[[bytes], object] | None = None) -> AsyncIterator:
+    """Decode the elements of a JSON array from a stream of chunks
+    :param chunks: async iterable of raw body chunks
+    :param loads: function decoding a single element
+    :return: async iterator over the decoded elements"""
+    decoder = JsonArrayDecoder(loads)
+    async for chunk in chunks:
+        for element in decoder.feed(chunk):
+            yield element
+    decoder.close()
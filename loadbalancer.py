@@ -0,0 +1,382 @@
+"""
+Dynamic load balancing of a site.
+Chargers sharing one grid connection get a current limit per connector. Every tick
+the status of all load balanced charge points is polled, the site limit is divided
+among the charging connectors and only the max_current settings that changed by
+more than the hysteresis are written back.
+
+Run one balancer per site, not one per web worker:
+
+    python loadbalancer.py --limit 63 --interval 2
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import sys
+import time
+
+from dataclasses import dataclass, replace
+
+from chargeampscfgparser import ChargeAmpsCfgParser
+
+# IEC 61851, a car does not charge below 6 A
+DEFAULT_MIN_CURRENT = 6.0
+DEFAULT_MAX_CURRENT = 32.0
+DEFAULT_HYSTERESIS = 1.0
+DEFAULT_INTERVAL = 2.0
+# seconds the connector settings are reused before they are read again, so
+# changes made in the charge amps app are picked up
+DEFAULT_SETTINGS_TTL = 60.0
+# connectors switched off or paused take no part in the balancing
+INACTIVE_MODES = frozenset({"Off"})
+INACTIVE_STATUSES = frozenset({"Disabled", "Paused"})
+# a car drawing this much less than allowed is limited by itself
+CAR_LIMITED_MARGIN = 2.0
+CHARGING_CURRENT = 1.0
+
+
+@dataclass(frozen=True)
+class Demand:
+    """Class representing the state of a connector in a balancing round."""
+    charge_point_id: str
+    connector_id: int
+    charging: bool
+    allowed: float
+    max_current: float = DEFAULT_MAX_CURRENT
+    draw: float | None = None
+    priority: int = 0
+    weight: float = 1.0
+
+    @property
+    def key(self) -> tuple[str, int]:
+        return (self.charge_point_id, self.connector_id)
+
+    def cap(self, min_current: float) -> float:
+        """Highest current the connector can use
+        :param min_current: lowest current a car charges with
+        :return: current in A"""
+        if self.draw is not None and self.draw < self.allowed - CAR_LIMITED_MARGIN:
+            # leave the unused current to the others, the next rounds raise the
+            # cap again as long as the car follows
+            return min(self.max_current,
+                       max(min_current, self.draw + CAR_LIMITED_MARGIN))
+        return self.max_current
+
+
+def allocate(demands: list[Demand],
+             site_limit: float,
+             min_current: float = DEFAULT_MIN_CURRENT,
+             idle_current: float | None = None) -> dict[tuple[str, int], float]:
+    """Divide the site limit among connectors
+    Charging connectors get min_current in priority order as long as the limit
+    allows, the others are paused with 0 A. Idle connectors then get idle_current
+    so a car plugged in can start. The rest is shared by the charging connectors in
+    proportion to their weight, no connector above its cap (water filling).
+    :param demands: list of Demand objects
+    :param site_limit: current per phase of the grid connection in A
+    :param min_current: lowest current a car charges with
+    :param idle_current: current of idle connectors, default is min_current
+    :return: dict of whole amps by (charge point ID, connector ID)"""
+    idle_current = min_current if idle_current is None else idle_current
+    allocation = {demand.key: 0.0 for demand in demands}
+    budget = site_limit
+    admitted = []
+    for demand in sorted((d for d in demands if d.charging),
+                         key=lambda d: -d.priority):
+        if budget >= min_current:
+            admitted.append(demand)
+            allocation[demand.key] = min_current
+            budget -= min_current
+    for demand in demands:
+        if not demand.charging and budget >= idle_current:
+            allocation[demand.key] = idle_current
+            budget -= idle_current
+    # raise the level of all admitted connectors until the budget is used, the
+    # connector with the least headroom per weight is full first
+    open_demands = sorted(
+        admitted,
+        key=lambda d: (d.cap(min_current) - min_current) / d.weight)
+    while open_demands and budget > 1e-9:
+        total_weight = sum(d.weight for d in open_demands)
+        demand = open_demands[0]
+        headroom = (demand.cap(min_current) -
+                    allocation[demand.key]) / demand.weight
+        level = min(headroom, budget / total_weight)
+        for d in open_demands:
+            allocation[d.key] += level * d.weight
+        budget -= level * total_weight
+        if level < headroom:
+            break
+        open_demands.pop(0)
+    # chargers take whole amps, the amps lost by rounding down go to the largest
+    # remainders of the connectors below their cap
+    rounded = {key: math.floor(value + 1e-9) for key, value in allocation.items()}
+    spare = math.floor(site_limit - sum(rounded.values()) + 1e-9)
+    for demand in sorted(open_demands,
+                         key=lambda d: rounded[d.key] - allocation[d.key]):
+        if spare < 1:
+            break
+        if rounded[demand.key] + 1 <= demand.cap(min_current):
+            rounded[demand.key] += 1
+            spare -= 1
+    return {key: float(value) for key, value in rounded.items()}
+
+
+class LoadBalancer:
+    """
+    Control loop keeping the connectors of a site below a common limit"""
+
+    def __init__(self,
+                 client,
+                 charge_point_ids: list[str],
+                 site_limit: float,
+                 min_current: float = DEFAULT_MIN_CURRENT,
+                 max_current: float = DEFAULT_MAX_CURRENT,
+                 hysteresis: float = DEFAULT_HYSTERESIS,
+                 priorities: dict[tuple[str, int], int] | None = None,
+                 parallel: int = 4,
+                 settings_ttl: float = DEFAULT_SETTINGS_TTL):
+        """
+        Site load balancer
+        :param client: initialized Client object
+        :param charge_point_ids: IDs of the charge points behind the grid connection
+        :param site_limit: current per phase of the grid connection in A
+        :param min_current: lowest current a car charges with
+        :param max_current: highest current of a connector
+        :param hysteresis: smallest change written to a connector
+        :param priorities: priority by (charge point ID, connector ID), higher is served first
+        :param parallel: maximum number of upstream requests at the same time
+        :param settings_ttl: seconds the connector settings are reused, 0 reads them
+            every round"""
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        self._client = client
+        self._charge_point_ids = charge_point_ids
+        self._site_limit = site_limit
+        self._min_current = min_current
+        self._max_current = max_current
+        self._hysteresis = hysteresis
+        self._priorities = priorities or {}
+        self._semaphore = asyncio.Semaphore(parallel)
+        self._settings_ttl = settings_ttl
+        self._settings = {}
+        # monotonic time the settings of a connector were read
+        self._settings_read = {}
+
+    @classmethod
+    async def for_site(cls, client, site_limit: float,
+                       **kwargs) -> "LoadBalancer":
+        """Create a balancer of all load balanced charge points of the account
+        :param client: initialized Client object
+        :param site_limit: current per phase of the grid connection in A
+        :param kwargs: see LoadBalancer
+        :return: LoadBalancer object"""
+        charge_points = await client.get_chargepoints()
+        return cls(client, [
+            charge_point.id for charge_point in charge_points
+            if charge_point.is_loadbalanced
+        ], site_limit, **kwargs)
+
+    async def _limited(self, coroutine):
+        async with self._semaphore:
+            return await coroutine
+
+    async def _load_settings(self, keys: list[tuple[str, int]]) -> None:
+        """Read the connector settings not known yet or read too long ago"""
+        now = time.monotonic()
+        missing = [
+            key for key in keys if key not in self._settings
+            or now - self._settings_read[key] >= self._settings_ttl
+        ]
+        settings = await asyncio.gather(
+            *(self._limited(self._client.get_chargepoint_connector_settings(
+                *key)) for key in missing))
+        self._settings.update(zip(missing, settings))
+        self._settings_read.update((key, now) for key in missing)
+
+    def _allowed(self, key: tuple[str, int]) -> float:
+        max_current = self._settings[key].max_current
+        return self._max_current if max_current is None else max_current
+
+    async def demands(self) -> list[Demand]:
+        """Poll the status of all charge points
+        Connectors switched off or paused are left out, they get no current.
+        :return: list of Demand objects"""
+        statuses = await asyncio.gather(
+            *(self._limited(self._client.get_chargepoint_status(cp))
+              for cp in self._charge_point_ids))
+        connectors = [connector for status in statuses
+                      for connector in status.connector_statuses
+                      if connector.status not in INACTIVE_STATUSES]
+        await self._load_settings([(c.charge_point_id, c.connector_id)
+                                   for c in connectors])
+        demands = []
+        for connector in connectors:
+            key = (connector.charge_point_id, connector.connector_id)
+            if self._settings[key].mode in INACTIVE_MODES:
+                continue
+            currents = [m.current for m in connector.measurements or []]
+            draw = max(currents) if currents else None
+            demands.append(
+                Demand(charge_point_id=key[0],
+                       connector_id=key[1],
+                       charging=connector.status == "Charging"
+                       or (draw or 0.0) >= CHARGING_CURRENT,
+                       allowed=self._allowed(key),
+                       max_current=self._max_current,
+                       draw=draw,
+                       priority=self._priorities.get(key, 0)))
+        return demands
+
+    def changes(self, allocation: dict[tuple[str, int],
+                                       float]) -> dict[tuple[str, int], float]:
+        """Select the allocations worth writing
+        :param allocation: current by (charge point ID, connector ID)
+        :return: currents changed by at least the hysteresis, and smaller decreases
+            if the site would exceed its limit without them"""
+        changed = {
+            key: current
+            for key, current in allocation.items()
+            if abs(current - self._allowed(key)) >= self._hysteresis
+        }
+        projected = sum(
+            changed.get(key, self._allowed(key)) for key in allocation)
+        if projected > self._site_limit:
+            changed.update((key, current)
+                           for key, current in allocation.items()
+                           if current < self._allowed(key))
+        return changed
+
+    async def _write(self, key: tuple[str, int], current: float) -> bool:
+        settings = replace(self._settings[key], max_current=current)
+        try:
+            await self._limited(
+                self._client.set_chargepoint_connector_settings(settings))
+        except Exception:
+            self._logger.exception("Setting %s A on %s failed", current, key)
+            # read again, the charger may have kept the old value
+            self._settings.pop(key, None)
+            self._settings_read.pop(key, None)
+            return False
+        self._settings[key] = settings
+        return True
+
+    async def step(self) -> dict[tuple[str, int], float]:
+        """Run one balancing round
+        Decreases are written before increases, the site stays below its limit
+        while the settings change.
+        :return: written currents by (charge point ID, connector ID)"""
+        demands = await self.demands()
+        allocation = allocate(demands, self._site_limit, self._min_current)
+        changed = self.changes(allocation)
+        decreases = {k: v for k, v in changed.items() if v < self._allowed(k)}
+        increases = {k: v for k, v in changed.items() if k not in decreases}
+        written = {}
+        for batch in (decreases, increases):
+            results = await asyncio.gather(
+                *(self._write(key, current) for key, current in batch.items()))
+            written.update((key, current)
+                           for (key, current), ok in zip(batch.items(), results)
+                           if ok)
+            if not all(results):
+                # raising others could exceed the limit, retried next round
+                break
+        return written
+
+    async def run(self, interval: float = DEFAULT_INTERVAL) -> None:
+        """Balance until cancelled
+        :param interval: seconds between the starts of two rounds"""
+        next_round = time.monotonic()
+        while True:
+            try:
+                written = await self.step()
+                if written:
+                    self._logger.info("Set %s", written)
+            except Exception:
+                self._logger.exception("Balancing round failed")
+            next_round += interval
+            # skip rounds instead of catching up after a slow round
+            next_round = max(next_round, time.monotonic())
+            await asyncio.sleep(next_round - time.monotonic())
+
+
+async def main(argv: list[str] | None = None) -> int:
+    """Run the load balancer command line
+    :param argv: command line arguments
+    :return: exit code"""
+    from dotenv import load_dotenv
+
+    env_path = os.getenv("ENV_PATH", "/data/.env")
+    parser = argparse.ArgumentParser(
+        description="Keep the load balanced chargers below a site limit.")
+    parser.add_argument("--limit",
+                        type=float,
+                        required=True,
+                        help="current per phase of the grid connection in A")
+    parser.add_argument("--interval",
+                        type=float,
+                        default=DEFAULT_INTERVAL,
+                        help="seconds between two balancing rounds")
+    parser.add_argument("--min-current",
+                        type=float,
+                        default=DEFAULT_MIN_CURRENT,
+                        help="lowest current a car charges with")
+    parser.add_argument("--max-current",
+                        type=float,
+                        default=DEFAULT_MAX_CURRENT,
+                        help="highest current of a connector")
+    parser.add_argument("--hysteresis",
+                        type=float,
+                        default=DEFAULT_HYSTERESIS,
+                        help="smallest change written to a connector")
+    parser.add_argument("--charge-point",
+                        action="append",
+                        dest="charge_point_ids",
+                        help="charge point of the site, default is all load balanced")
+    parser.add_argument("--cfg",
+                        default=os.path.join(os.path.dirname(env_path),
+                                             "cfg.ini"),
+                        help="path of cfg.ini")
+    parser.add_argument("--tenant",
+                        help="account of a TENANT:<name> section, default is the only one")
+    args = parser.parse_args(argv)
+    if args.limit < args.min_current:
+        parser.error("--limit must be at least --min-current")
+
+    load_dotenv(env_path)
+    from tenants import TenantManager
+    from utils.utils import get_or_create_encryption_key
+
+    key = get_or_create_encryption_key()
+    cfgParser = ChargeAmpsCfgParser(args.cfg)
+    tenants = cfgParser.get_tenant_data()
+    manager = TenantManager(tenants, key, token_dir=os.path.dirname(env_path))
+    options = dict(min_current=args.min_current,
+                   max_current=args.max_current,
+                   hysteresis=args.hysteresis)
+    try:
+        tenant = manager.resolve(args.tenant)
+        if tenant not in tenants:
+            parser.error(f"unknown tenant {tenant}, configured are "
+                         f"{', '.join(tenants)}")
+        client = await manager.get_client(tenant)
+        if args.charge_point_ids:
+            balancer = LoadBalancer(client, args.charge_point_ids, args.limit,
+                                    **options)
+        else:
+            balancer = await LoadBalancer.for_site(client, args.limit,
+                                                   **options)
+        await balancer.run(args.interval)
+    finally:
+        await manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        sys.exit(asyncio.run(main()))
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,259 @@
+"""
+Opt-in sampling profiler for web requests.
+A background thread periodically samples the stack of the thread running a request
+and stores the result in collapsed-stack format, which can be rendered with
+flamegraph.pl or loaded into speedscope.
+"""
+import asyncio
+import functools
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+from collections import Counter
+from quart import make_response, request
+from quart.wrappers.response import IterableBody
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_QUERY_PARAM = "profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+DEFAULT_INTERVAL = 0.005
+DEFAULT_RETENTION = 50
+
+
+class SamplingProfiler:
+    """
+    Sampling profiler for a single thread"""
+
+    def __init__(self,
+                 thread_id: int,
+                 interval: float = DEFAULT_INTERVAL,
+                 max_depth: int = 128):
+        """
+        Sampling profiler for a single thread
+        :param thread_id: ident of the thread to sample
+        :param interval: sampling interval in seconds
+        :param max_depth: maximum number of frames recorded per sample"""
+        self._thread_id = thread_id
+        self._interval = interval
+        self._max_depth = max_depth
+        self._samples = Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._started = 0.0
+        self._duration = 0.0
+
+    def start(self) -> None:
+        """Start sampling in a background thread"""
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run,
+                                        name="sampling-profiler",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling and wait for the sampler thread"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._duration = time.perf_counter() - self._started
+
+    def _run(self) -> None:
+        """Sampler loop"""
+        while not self._stop_event.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self._max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} "
+                             f"({os.path.basename(code.co_filename)}"
+                             f":{frame.f_lineno})")
+                frame = frame.f_back
+            self._samples[";".join(reversed(stack))] += 1
+
+    @property
+    def sample_count(self) -> int:
+        """Number of collected samples"""
+        return sum(self._samples.values())
+
+    @property
+    def duration(self) -> float:
+        """Wall clock time covered by the profile in seconds"""
+        return self._duration
+
+    def collapsed(self) -> str:
+        """Profile in collapsed-stack format ("frame;frame;frame count")
+        :return: flamegraph compatible text"""
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in self._samples.most_common())
+
+
+class ProfileStore:
+    """
+    Directory of stored profiles with a bounded retention window"""
+
+    def __init__(self, directory: str, retention: int = DEFAULT_RETENTION):
+        """
+        Directory of stored profiles
+        :param directory: directory the profiles are written to
+        :param retention: maximum number of profiles to keep"""
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        self._directory = directory
+        self._retention = retention
+        self._lock = threading.Lock()
+
+    def _path(self, request_id: str) -> str:
+        """Path of the profile for a request id"""
+        return os.path.join(self._directory, f"{request_id}.folded")
+
+    def save(self, request_id: str, collapsed: str) -> str:
+        """Store a profile and drop the oldest ones beyond the retention window
+        :param request_id: ID of the profiled request
+        :param collapsed: profile in collapsed-stack format
+        :return: path of the stored profile"""
+        with self._lock:
+            os.makedirs(self._directory, exist_ok=True)
+            path = self._path(request_id)
+            with open(path, "w") as f:
+                f.write(collapsed)
+            self._prune()
+        self._logger.info("Stored profile %s", path)
+        return path
+
+    def load(self, request_id: str) -> str | None:
+        """Load a stored profile
+        :param request_id: ID of the profiled request
+        :return: profile in collapsed-stack format or None if unknown"""
+        if not is_valid_request_id(request_id):
+            return None
+        try:
+            with open(self._path(request_id)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def request_ids(self) -> list[str]:
+        """List stored request ids, newest first"""
+        try:
+            entries = [
+                e for e in os.scandir(self._directory)
+                if e.name.endswith(".folded")
+            ]
+        except FileNotFoundError:
+            return []
+        entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+        return [e.name[:-len(".folded")] for e in entries]
+
+    def _prune(self) -> None:
+        """Remove profiles beyond the retention window"""
+        for request_id in self.request_ids()[self._retention:]:
+            try:
+                os.remove(self._path(request_id))
+            except FileNotFoundError:
+                pass
+
+
+class _ProfiledBody:
+    """
+    Streamed response body finishing its profile when sent or abandoned"""
+
+    def __init__(self, iterator, finish):
+        self._iterator = iterator
+        self._finish = finish
+
+    def __aiter__(self) -> "_ProfiledBody":
+        return self
+
+    async def __anext__(self):
+        try:
+            return await anext(self._iterator)
+        except BaseException:
+            await self._finish()
+            raise
+
+    async def aclose(self) -> None:
+        # also called if the body was never iterated, e.g. on a disconnect
+        await self._finish()
+        aclose = getattr(self._iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def is_valid_request_id(request_id: str) -> bool:
+    """Check that a request id is safe to use as a file name"""
+    return bool(request_id) and len(request_id) <= 64 and all(
+        c.isalnum() or c in "-_" for c in request_id)
+
+
+def is_authorized(token: str | None, admin_token: str | None) -> bool:
+    """Check a supplied profiling token against the configured admin token
+    :param token: token supplied with the request
+    :param admin_token: configured admin token, profiling is disabled if empty
+    :return: True if profiling is allowed"""
+    if not admin_token or not token:
+        return False
+    return hmac.compare_digest(token.encode(), admin_token.encode())
+
+
+def profiled(store: ProfileStore, admin_token: str | None,
+             interval: float = DEFAULT_INTERVAL):
+    """Decorator profiling an async Quart view when an admin asks for it.
+    Profiling is requested with the X-Profile header or the profile query parameter,
+    both carrying the admin token. The request id is taken from X-Request-ID or generated
+    and returned in the X-Profile-Id response header. A streamed response is sampled
+    until its body is sent.
+    :param store: ProfileStore receiving the profiles
+    :param admin_token: admin token, profiling is disabled if empty
+    :param interval: sampling interval in seconds"""
+
+    def decorator(view):
+
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            token = request.headers.get(PROFILE_HEADER) or request.args.get(
+                PROFILE_QUERY_PARAM)
+            if not is_authorized(token, admin_token):
+                return await view(*args, **kwargs)
+            request_id = request.headers.get("X-Request-ID", "")
+            if not is_valid_request_id(request_id):
+                request_id = uuid.uuid4().hex
+            # the event loop thread is sampled, concurrent requests on the same
+            # worker show up in the profile as well
+            profiler = SamplingProfiler(threading.get_ident(), interval)
+            finished = False
+
+            async def finish():
+                nonlocal finished
+                if finished:
+                    return
+                finished = True
+                profiler.stop()
+                # file access would block the sampled event loop
+                await asyncio.to_thread(store.save, request_id,
+                                        profiler.collapsed())
+
+            profiler.start()
+            streamed = False
+            try:
+                response = await make_response(await view(*args, **kwargs))
+                if isinstance(response.response, IterableBody):
+                    # exports render their rows while the body is sent
+                    response.response.iter = _ProfiledBody(
+                        response.response.iter, finish)
+                    streamed = True
+            finally:
+                if not streamed:
+                    await finish()
+            response.headers[PROFILE_ID_HEADER] = request_id
+            return response
+
+        return wrapper
+
+    return decorator
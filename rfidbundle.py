@@ -0,0 +1,145 @@
+"""
+Bundle of one workbook per RFID tag.
+The sessions are fetched once and grouped by tag, the workbooks of the tags are
+rendered in worker processes and streamed back as one ZIP file while the remaining
+ones are still rendered, so the render time scales with the cores instead of the tags.
+"""
+import asyncio
+import multiprocessing
+import re
+import zipfile
+
+from collections.abc import AsyncIterator
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import replace
+
+from chargeampsdata import ChargingSession
+from rfidreport import RfidUsage
+
+SUMMARY_NAME = "summary.xlsx"
+INVALID_NAME_CHARS = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+def create_executor(workers: int | None = None) -> ProcessPoolExecutor:
+    """Create the worker processes rendering the workbooks
+    Workers are spawned, forking a process running an event loop and threads is unsafe.
+    :param workers: number of processes, default is the number of cores
+    :return: ProcessPoolExecutor object, shut it down when done"""
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+def render_workbook(sessions: list[ChargingSession],
+                    kwh_price: float,
+                    template_path: str | None = None) -> bytes:
+    """Render the workbook of a tag, runs in a worker process
+    :param sessions: ChargingSession objects of the tag
+    :param kwh_price: price per kWh in cents
+    :param template_path: xlsx template of the layout, parsed once per process, None
+        uses the built-in layout
+    :return: content of the xlsx file"""
+    from xlsxresultwriter import XlsxResult
+    from xlsxtemplate import load_template
+    template = load_template(template_path) if template_path else None
+    return XlsxResult(template).gen_output_file(sessions,
+                                                kwh_price).getvalue()
+
+
+def render_summary(usages: dict[str, RfidUsage], kwh_price: float) -> bytes:
+    """Render the summary of all tags without detail sheets, runs in a worker process
+    :param usages: dict of RfidUsage objects by RFID tag
+    :param kwh_price: price per kWh in cents
+    :return: content of the xlsx file"""
+    from xlsxresultwriter import XlsxResult
+    return XlsxResult().gen_rfid_report(usages, kwh_price).getvalue()
+
+
+def workbook_names(rfids: list[str]) -> dict[str, str]:
+    """Get unique file names of the tag workbooks
+    :param rfids: RFID tags
+    :return: dict of file names by RFID tag"""
+    names = {}
+    used = {SUMMARY_NAME}
+    for rfid in rfids:
+        stem = INVALID_NAME_CHARS.sub("_", rfid) or "rfid"
+        name = f"{stem}.xlsx"
+        n = 1
+        while name in used:
+            n += 1
+            name = f"{stem}_{n}.xlsx"
+        used.add(name)
+        names[rfid] = name
+    return names
+
+
+class _Chunks:
+    """
+    Unseekable file collecting the output of a ZipFile until it is sent"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def iter_bundle(usages: dict[str, RfidUsage],
+                      kwh_price: float,
+                      executor: Executor | None = None,
+                      summary: bool = True,
+                      template_path: str | None = None) -> AsyncIterator[bytes]:
+    """Render one workbook per tag and stream them as a ZIP file
+    Workbooks are added in the order they are done, the summary comes first.
+    :param usages: dict of RfidUsage objects with sessions by RFID tag, see
+        rfidreport.aggregate_by_rfid
+    :param kwh_price: price per kWh in cents
+    :param executor: executor rendering the workbooks, see create_executor, None uses
+        the default thread pool of the event loop
+    :param summary: add a workbook with the totals of all tags
+    :param template_path: xlsx template of the tag workbooks, None uses the built-in
+        layout
+    :return: async iterator over the chunks of the ZIP file"""
+    loop = asyncio.get_running_loop()
+    names = workbook_names([rfid for rfid, usage in usages.items()
+                            if usage.sessions])
+    pending = {
+        loop.run_in_executor(executor, render_workbook, usages[rfid].sessions,
+                             kwh_price, template_path): name
+        for rfid, name in names.items()
+    }
+    if summary:
+        totals = {
+            rfid: replace(usage, sessions=[])
+            for rfid, usage in usages.items()
+        }
+        pending[loop.run_in_executor(executor, render_summary, totals,
+                                     kwh_price)] = SUMMARY_NAME
+    sink = _Chunks()
+    try:
+        # xlsx files are compressed already
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as bundle:
+            first = [future for future, name in pending.items()
+                     if name == SUMMARY_NAME]
+            for future in first:
+                bundle.writestr(pending.pop(future), await future)
+                yield sink.take()
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    bundle.writestr(pending.pop(future), future.result())
+                yield sink.take()
+        yield sink.take()
+    finally:
+        # e.g. the client disconnected, workbooks not started yet are dropped
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,163 @@
+"""
+Lookup of RFID tags in any printed format.
+Charge amps reports every tag as hex (rfid), as decimal (rfidDec) and as decimal of
+the reversed bytes (rfidDecReverse). Cards show any of them, so the index resolves
+each representation to the canonical hex tag.
+"""
+from collections.abc import Iterable
+
+UNUSED_RFID_SLOT = "00000000000000"
+_SEPARATORS = str.maketrans("", "", " :-")
+
+
+def normalize_hex(value: str) -> str:
+    """Normalize a hex tag, e.g. "04:a1:b2" -> "04A1B2"
+    :param value: hex tag as printed
+    :return: upper case hex without separators"""
+    return value.translate(_SEPARATORS).upper()
+
+
+def normalize_dec(value: str) -> str:
+    """Normalize a decimal tag, e.g. "0012345" -> "12345"
+    :param value: decimal tag as printed
+    :return: decimal without separators and leading zeros"""
+    return value.translate(_SEPARATORS).lstrip("0") or "0"
+
+
+def dec_representations(rfid: str) -> tuple[str, str] | None:
+    """Compute the decimal representations of a hex tag
+    :param rfid: normalized hex tag
+    :return: (rfidDec, rfidDecReverse) or None if the tag is not hex"""
+    try:
+        data = bytes.fromhex(rfid if len(rfid) % 2 == 0 else "0" + rfid)
+    except ValueError:
+        return None
+    return (str(int.from_bytes(data, "big")),
+            str(int.from_bytes(data[::-1], "big")))
+
+
+def representations(record) -> tuple[str, str | None, str | None]:
+    """Get the normalized representations of a session or RFIDTag
+    :param record: object with rfid, rfidDec and rfidDecReverse attributes
+    :return: (hex, decimal, reversed decimal)"""
+    rfid_dec = getattr(record, "rfidDec", None)
+    rfid_dec_reverse = getattr(record, "rfidDecReverse", None)
+    return (normalize_hex(record.rfid),
+            normalize_dec(rfid_dec) if rfid_dec else None,
+            normalize_dec(rfid_dec_reverse) if rfid_dec_reverse else None)
+
+
+def matches(record, value: str) -> bool:
+    """Check if a session or RFIDTag has the tag in any format
+    :param record: object with rfid, rfidDec and rfidDecReverse attributes
+    :param value: tag in any format
+    :return: True if one representation is equal"""
+    if record.rfid == value:
+        return True
+    rfid, rfid_dec, rfid_dec_reverse = representations(record)
+    if normalize_hex(value) == rfid:
+        return True
+    value = normalize_dec(value)
+    return value == rfid_dec or value == rfid_dec_reverse
+
+
+class RfidIndex:
+    """
+    Resolves hex, decimal and reversed decimal tags to the canonical hex tag"""
+
+    def __init__(self):
+        """
+        Empty RFID index"""
+        self._by_hex = {}
+        self._by_dec = {}
+        self._by_dec_reverse = {}
+
+    def __len__(self) -> int:
+        return len(self._by_hex)
+
+    def __contains__(self, value: str) -> bool:
+        return self.resolve(value) is not None
+
+    def add(self,
+            rfid: str,
+            rfid_dec: str | None = None,
+            rfid_dec_reverse: str | None = None) -> str | None:
+        """Add a tag, missing decimal representations are computed
+        :param rfid: hex tag
+        :param rfid_dec: decimal tag
+        :param rfid_dec_reverse: decimal of the reversed bytes
+        :return: canonical hex tag, None for unused slots"""
+        canonical = normalize_hex(rfid)
+        if not canonical or canonical == UNUSED_RFID_SLOT:
+            return None
+        if canonical in self._by_hex:
+            return canonical
+        if rfid_dec is None or rfid_dec_reverse is None:
+            computed = dec_representations(canonical) or (None, None)
+            rfid_dec = rfid_dec or computed[0]
+            rfid_dec_reverse = rfid_dec_reverse or computed[1]
+        self._by_hex[canonical] = (rfid_dec and normalize_dec(rfid_dec),
+                                   rfid_dec_reverse
+                                   and normalize_dec(rfid_dec_reverse))
+        if rfid_dec:
+            self._by_dec.setdefault(normalize_dec(rfid_dec), canonical)
+        if rfid_dec_reverse:
+            self._by_dec_reverse.setdefault(normalize_dec(rfid_dec_reverse),
+                                            canonical)
+        return canonical
+
+    def add_record(self, record) -> str | None:
+        """Add the tag of a ChargingSession or RFIDTag
+        :param record: object with rfid, rfidDec and rfidDecReverse attributes
+        :return: canonical hex tag, None for unused slots"""
+        if record.rfid in self._by_hex:
+            # fast path for the many sessions of known tags
+            return record.rfid
+        return self.add(record.rfid, getattr(record, "rfidDec", None),
+                        getattr(record, "rfidDecReverse", None))
+
+    def update(self, records: Iterable) -> None:
+        """Add the tags of many sessions or RFIDTags
+        :param records: iterable of objects with rfid, rfidDec and rfidDecReverse"""
+        for record in records:
+            self.add_record(record)
+
+    def resolve(self, value: str) -> str | None:
+        """Resolve a tag in any format
+        A known hex tag wins over a decimal tag with the same digits.
+        :param value: hex, decimal or reversed decimal tag
+        :return: canonical hex tag or None if the tag is unknown"""
+        canonical = normalize_hex(value)
+        if canonical in self._by_hex:
+            return canonical
+        value = normalize_dec(value)
+        return self._by_dec.get(value) or self._by_dec_reverse.get(value)
+
+    def canonical(self, value: str) -> str | None:
+        """Get the canonical hex tag, the same however many tags are known yet
+        A tag with hex letters can only be hex, a tag of digits may be decimal and is
+        only resolved if it is known.
+        :param value: hex, decimal or reversed decimal tag
+        :return: canonical hex tag or None if the tag is neither hex nor known"""
+        canonical = normalize_hex(value)
+        if canonical.isdigit():
+            return self.resolve(value)
+        try:
+            int(canonical, 16)
+        except ValueError:
+            return None
+        return canonical
+
+    def describe(self, value: str) -> dict | None:
+        """Get all representations of a tag in any format
+        :param value: hex, decimal or reversed decimal tag
+        :return: dict with rfid, rfidDec and rfidDecReverse or None if unknown"""
+        canonical = self.resolve(value)
+        if canonical is None:
+            return None
+        rfid_dec, rfid_dec_reverse = self._by_hex[canonical]
+        return {
+            "rfid": canonical,
+            "rfidDec": rfid_dec,
+            "rfidDecReverse": rfid_dec_reverse
+        }
@@ -0,0 +1,46 @@
+"""
+Fleet wide RFID usage report.
+Charging sessions of all chargers and connectors are grouped by RFID tag in a single pass.
+"""
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from chargeampsdata import ChargingSession
+from rfidindex import UNUSED_RFID_SLOT
+
+
+@dataclass
+class RfidUsage:
+    """Class representing the aggregated usage of an RFID tag."""
+    rfid: str
+    session_count: int = 0
+    total_consumption_kwh: float = 0.0
+    total_costs: float = 0.0
+    sessions: list[ChargingSession] = field(default_factory=list)
+
+
+def aggregate_by_rfid(sessions: Iterable[ChargingSession],
+                      kwh_price: float,
+                      keep_sessions: bool = True) -> dict[str, RfidUsage]:
+    """Group charging sessions by RFID tag in a single pass
+    :param sessions: charging sessions of any number of chargers and connectors
+    :param kwh_price: price per kWh in cents
+    :param keep_sessions: keep the sessions of every tag for detail reports
+    :return: dict of RfidUsage objects by RFID tag, sorted by tag"""
+    kwh_price = float(kwh_price)
+    usages = {}
+    for session in sessions:
+        if session.rfid == UNUSED_RFID_SLOT:
+            continue
+        usage = usages.get(session.rfid)
+        if usage is None:
+            usage = usages[session.rfid] = RfidUsage(session.rfid)
+        usage.session_count += 1
+        usage.total_consumption_kwh += session.total_consumption_kwh
+        usage.total_costs += session.total_consumption_kwh * kwh_price / 100
+        if keep_sessions:
+            usage.sessions.append(session)
+    for usage in usages.values():
+        usage.sessions.sort(key=lambda s: (s.start_time or datetime.min, s.id))
+    return dict(sorted(usages.items()))
@@ -0,0 +1,253 @@
+"""
+Compiled index of charge point schedules.
+The rules of ChargePointSchedule (local start/end time, weekday flags, time zone and
+a connector list) are expanded once into sorted UTC intervals per connector, so
+"may connector X charge at t" and "when does that change next" are a bisect
+instead of parsing every schedule of the fleet again.
+"""
+import logging
+
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from chargeampsdata import ChargePointSchedule
+
+# intervals are compiled for this long around the queried times and recompiled
+# when a query leaves that window
+DEFAULT_HORIZON = timedelta(weeks=4)
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday",
+            "saturday", "sunday")
+
+
+def _timestamp(value: datetime) -> float:
+    """Seconds since the epoch, naive datetimes are local time"""
+    return value.timestamp()
+
+
+def _utc(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+def connector_ids(schedule: ChargePointSchedule) -> list[int]:
+    """Parse the connector list of a schedule, e.g. "1, 2" -> [1, 2]
+    :param schedule: ChargePointSchedule object
+    :return: list of connector IDs"""
+    return [int(part) for part in schedule.connectorIdList.split(",")
+            if part.strip()]
+
+
+def expand(schedule: ChargePointSchedule,
+           first_day: date,
+           last_day: date,
+           tz=None) -> list[tuple[float, float]]:
+    """Expand the rule of a schedule into intervals
+    A window ending at or before its start time ends on the next day.
+    :param schedule: ChargePointSchedule object
+    :param first_day: first local day a window may start on
+    :param last_day: last local day a window may start on
+    :param tz: time zone of the schedule, default is its timeZone
+    :return: list of (start, end) timestamps"""
+    if tz is None:
+        tz = ZoneInfo(schedule.timeZone)
+    start = timedelta(hours=schedule.startHours,
+                      minutes=schedule.startMinutes)
+    end = timedelta(hours=schedule.endHours, minutes=schedule.endMinutes)
+    if end <= start:
+        end += timedelta(days=1)
+    weekdays = [getattr(schedule, name) for name in WEEKDAYS]
+    intervals = []
+    day = first_day
+    while day <= last_day:
+        if weekdays[day.weekday()]:
+            midnight = datetime.combine(day, time())
+            intervals.append(
+                ((midnight + start).replace(tzinfo=tz).timestamp(),
+                 (midnight + end).replace(tzinfo=tz).timestamp()))
+        day += timedelta(days=1)
+    return intervals
+
+
+def merge(intervals: Iterable[tuple[float, float]]) -> list[float]:
+    """Merge overlapping intervals into a flat list of edges
+    :param intervals: (start, end) tuples in any order
+    :return: sorted [start, end, start, end, ...], a time is inside an interval if
+        an odd number of edges is at or before it"""
+    edges = []
+    for start, end in sorted(intervals):
+        if end <= start:
+            continue
+        if edges and start <= edges[-1]:
+            edges[-1] = max(edges[-1], end)
+        else:
+            edges.extend((start, end))
+    return edges
+
+
+class ScheduleIndex:
+    """
+    Charging windows of all connectors as sorted UTC edges"""
+
+    def __init__(self, horizon: timedelta = DEFAULT_HORIZON):
+        """
+        Empty schedule index
+        :param horizon: period compiled before and after the origin"""
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        self._horizon = horizon
+        self._schedules = {}
+        self._edges = {}
+        self._origin = None
+        self._window = (0.0, 0.0)
+
+    def __contains__(self, key: tuple[str, int]) -> bool:
+        return key in self.connectors()
+
+    @property
+    def charge_points(self) -> list[str]:
+        """IDs of the charge points with loaded schedules"""
+        return list(self._schedules)
+
+    def connectors(self) -> list[tuple[str, int]]:
+        """Get the connectors with at least one active schedule
+        :return: list of (charge point ID, connector ID)"""
+        return list({(charge_point_id, connector_id): None
+                     for charge_point_id, schedules in self._schedules.items()
+                     for schedule in schedules if schedule.active
+                     for connector_id in connector_ids(schedule)})
+
+    def refresh(self, charge_point_id: str,
+                schedules: list[ChargePointSchedule]) -> bool:
+        """Replace the schedules of a charge point
+        :param charge_point_id: ID of the charge point
+        :param schedules: all schedules of the charge point
+        :return: True if the schedules changed and were compiled again"""
+        schedules = tuple(schedules)
+        if self._schedules.get(charge_point_id) == schedules:
+            return False
+        self._schedules[charge_point_id] = schedules
+        if self._origin is not None:
+            self._compile(charge_point_id)
+        return True
+
+    def remove(self, charge_point_id: str) -> None:
+        """Drop the schedules of a charge point
+        :param charge_point_id: ID of the charge point"""
+        self._schedules.pop(charge_point_id, None)
+        for key in [key for key in self._edges if key[0] == charge_point_id]:
+            del self._edges[key]
+
+    def _ensure(self, *timestamps: float) -> None:
+        """Compile all schedules around the timestamps if any is outside the window"""
+        low, high = self._window
+        first, last = min(timestamps), max(timestamps)
+        if self._origin is not None and low <= first and last < high:
+            return
+        self._origin = first
+        # a range longer than the horizon is compiled as a whole
+        self._window = (first - self._horizon.total_seconds(),
+                        last + self._horizon.total_seconds())
+        self._edges = {}
+        for charge_point_id in self._schedules:
+            self._compile(charge_point_id)
+
+    def _compile(self, charge_point_id: str) -> None:
+        """Expand the schedules of a charge point for the current window"""
+        for key in [key for key in self._edges if key[0] == charge_point_id]:
+            del self._edges[key]
+        low, high = self._window
+        # one extra day on both sides covers every time zone and overnight windows
+        first_day = _utc(low).date() - timedelta(days=2)
+        last_day = _utc(high).date() + timedelta(days=1)
+        intervals = {}
+        for schedule in self._schedules[charge_point_id]:
+            if not schedule.active:
+                continue
+            try:
+                tz = ZoneInfo(schedule.timeZone)
+            except (ZoneInfoNotFoundError, ValueError):
+                self._logger.warning(
+                    "Unknown time zone %s of schedule %s, using UTC",
+                    schedule.timeZone, schedule.id)
+                tz = timezone.utc
+            expanded = expand(schedule, first_day, last_day, tz)
+            for connector_id in connector_ids(schedule):
+                intervals.setdefault(connector_id, []).extend(expanded)
+        for connector_id, connector_intervals in intervals.items():
+            self._edges[(charge_point_id, connector_id)] = merge(
+                connector_intervals)
+
+    def _edges_of(self, charge_point_id: str, connector_id: int,
+                  *times: datetime) -> tuple[list[float], list[float]]:
+        timestamps = [_timestamp(value) for value in times]
+        self._ensure(*timestamps)
+        return self._edges.get((charge_point_id, connector_id),
+                               []), timestamps
+
+    def is_allowed(self, charge_point_id: str, connector_id: int,
+                   at: datetime) -> bool:
+        """Check if a schedule window of a connector contains a time
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param at: point in time
+        :return: True if the connector may charge"""
+        edges, (t, ) = self._edges_of(charge_point_id, connector_id, at)
+        return bisect_right(edges, t) % 2 == 1
+
+    def windows(self, charge_point_id: str, connector_id: int,
+                start_time: datetime,
+                end_time: datetime) -> list[tuple[datetime, datetime]]:
+        """Get the schedule windows of a connector overlapping a period
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param start_time: start of the period
+        :param end_time: end of the period
+        :return: list of (start, end) UTC datetimes clipped to the period"""
+        edges, (start, end) = self._edges_of(charge_point_id, connector_id,
+                                             start_time, end_time)
+        lo = bisect_right(edges, start)
+        hi = bisect_left(edges, end)
+        # an odd index is inside a window, the period start opens it
+        clipped = ([start] if lo % 2 == 1 else []) + edges[lo:hi]
+        if hi % 2 == 1:
+            clipped.append(end)
+        return [(_utc(clipped[i]), _utc(clipped[i + 1]))
+                for i in range(0, len(clipped), 2)]
+
+    def overlaps(self, charge_point_id: str, connector_id: int,
+                 start_time: datetime, end_time: datetime) -> bool:
+        """Check if a connector may charge at any time of a period
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param start_time: start of the period
+        :param end_time: end of the period
+        :return: True if a schedule window overlaps the period"""
+        edges, (start, end) = self._edges_of(charge_point_id, connector_id,
+                                             start_time, end_time)
+        lo = bisect_right(edges, start)
+        return lo % 2 == 1 or bisect_left(edges, end) > lo
+
+    def next_transition(self, charge_point_id: str, connector_id: int,
+                        at: datetime) -> datetime | None:
+        """Get the next time a connector starts or stops being allowed to charge
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param at: point in time
+        :return: UTC datetime or None if nothing changes within the horizon"""
+        edges, (t, ) = self._edges_of(charge_point_id, connector_id, at)
+        i = bisect_right(edges, t)
+        return _utc(edges[i]) if i < len(edges) else None
+
+    def next_transitions(self, at: datetime) -> dict[tuple[str, int], datetime]:
+        """Get the next transition of every connector
+        :param at: point in time
+        :return: dict of UTC datetimes by (charge point ID, connector ID)"""
+        t = _timestamp(at)
+        self._ensure(t)
+        transitions = {}
+        for key, edges in self._edges.items():
+            i = bisect_right(edges, t)
+            if i < len(edges):
+                transitions[key] = _utc(edges[i])
+        return transitions
@@ -0,0 +1,166 @@
+"""
+Declarative schedule sync.
+Given the wanted schedules per charge point, the current schedules are fetched once,
+compared, and only the differences are written: new schedules are created, changed
+ones updated and (with prune) schedules missing from the wanted set deleted.
+Schedules are matched by ID if the wanted schedule has one, otherwise by name, so
+one standard set without IDs can be pushed to a whole fleet.
+"""
+import asyncio
+import logging
+
+from dataclasses import dataclass, field, replace
+
+from chargeampsdata import ChargePointSchedule
+
+DEFAULT_PARALLEL_WRITES = 4
+
+
+@dataclass(frozen=True)
+class ScheduleDiff:
+    """Class representing the writes bringing a charge point to the wanted schedules."""
+    create: list[ChargePointSchedule] = field(default_factory=list)
+    update: list[ChargePointSchedule] = field(default_factory=list)
+    delete: list[ChargePointSchedule] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.create) + len(self.update) + len(self.delete)
+
+
+@dataclass(frozen=True)
+class SyncResult:
+    """Class representing the outcome of the sync of a charge point."""
+    charge_point_id: str
+    created: int = 0
+    updated: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def same_rule(a: ChargePointSchedule, b: ChargePointSchedule) -> bool:
+    """Check if two schedules are equal apart from their ID and charge point
+    :param a: ChargePointSchedule object
+    :param b: ChargePointSchedule object
+    :return: True if no update is needed"""
+    return (replace(a, id=0, chargePointId="")
+            == replace(b, id=0, chargePointId=""))
+
+
+def diff_schedules(charge_point_id: str,
+                   current: list[ChargePointSchedule],
+                   wanted: list[ChargePointSchedule],
+                   prune: bool = True) -> tuple[ScheduleDiff, int]:
+    """Compute the minimal writes from the current to the wanted schedules
+    :param charge_point_id: ID of the charge point
+    :param current: schedules on the charge point
+    :param wanted: schedules the charge point should have
+    :param prune: delete current schedules that are not wanted
+    :return: (ScheduleDiff object, number of unchanged schedules)"""
+    names = [schedule.name for schedule in wanted if not schedule.id]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate schedule names {', '.join(duplicates)}")
+    by_id = {schedule.id: schedule for schedule in current}
+    by_name = {}
+    for schedule in current:
+        by_name.setdefault(schedule.name, schedule)
+    diff = ScheduleDiff()
+    matched = set()
+    unchanged = 0
+    for schedule in wanted:
+        schedule = replace(schedule, chargePointId=charge_point_id)
+        existing = by_id.get(schedule.id) if schedule.id else by_name.get(
+            schedule.name)
+        if existing is None or existing.id in matched:
+            diff.create.append(replace(schedule, id=0))
+            continue
+        matched.add(existing.id)
+        if same_rule(existing, schedule):
+            unchanged += 1
+        else:
+            diff.update.append(replace(schedule, id=existing.id))
+    if prune:
+        diff.delete.extend(schedule for schedule in current
+                           if schedule.id not in matched)
+    return diff, unchanged
+
+
+async def sync_charge_point(client,
+                            charge_point_id: str,
+                            wanted: list[ChargePointSchedule],
+                            semaphore: asyncio.Semaphore,
+                            prune: bool = True,
+                            dry_run: bool = False) -> SyncResult:
+    """Bring one charge point to the wanted schedules
+    Deletes run before creates, a charge point with a schedule limit never holds
+    the old and the new set at the same time.
+    :param client: initialized Client object
+    :param charge_point_id: ID of the charge point
+    :param wanted: schedules the charge point should have
+    :param semaphore: bounds the upstream requests of all charge points
+    :param prune: delete current schedules that are not wanted
+    :param dry_run: only count the writes
+    :return: SyncResult object"""
+    logger = logging.getLogger(__name__)
+    try:
+        async with semaphore:
+            current = await client.get_chargepoint_schedules(charge_point_id)
+        diff, unchanged = diff_schedules(charge_point_id, current, wanted,
+                                         prune)
+    except Exception as exc:
+        logger.exception("Reading the schedules of %s failed",
+                         charge_point_id)
+        return SyncResult(charge_point_id,
+                          errors=[str(exc) or exc.__class__.__name__])
+    if dry_run:
+        return SyncResult(charge_point_id, len(diff.create), len(diff.update),
+                          len(diff.delete), unchanged)
+
+    async def write(operation, argument) -> str | None:
+        async with semaphore:
+            try:
+                await operation(charge_point_id, argument)
+            except Exception as exc:
+                logger.exception("Schedule write on %s failed",
+                                 charge_point_id)
+                return str(exc) or exc.__class__.__name__
+        return None
+
+    deleted = await asyncio.gather(*(write(client.delete_schedule, schedule.id)
+                                     for schedule in diff.delete))
+    written = await asyncio.gather(
+        *(write(client.update_schedule, schedule) for schedule in diff.update),
+        *(write(client.create_schedule, schedule) for schedule in diff.create))
+    updated, created = written[:len(diff.update)], written[len(diff.update):]
+    return SyncResult(
+        charge_point_id,
+        created=created.count(None),
+        updated=updated.count(None),
+        deleted=deleted.count(None),
+        unchanged=unchanged,
+        errors=[error for error in deleted + written if error is not None])
+
+
+async def sync_schedules(client,
+                         wanted: dict[str, list[ChargePointSchedule]],
+                         parallel: int = DEFAULT_PARALLEL_WRITES,
+                         prune: bool = True,
+                         dry_run: bool = False) -> dict[str, SyncResult]:
+    """Bring charge points to the wanted schedules
+    :param client: initialized Client object
+    :param wanted: schedules by charge point ID
+    :param parallel: maximum number of upstream requests at the same time
+    :param prune: delete current schedules that are not wanted
+    :param dry_run: only count the writes
+    :return: dict of SyncResult objects by charge point ID"""
+    semaphore = asyncio.Semaphore(parallel)
+    results = await asyncio.gather(
+        *(sync_charge_point(client, charge_point_id, schedules, semaphore,
+                            prune, dry_run)
+          for charge_point_id, schedules in wanted.items()))
+    return {result.charge_point_id: result for result in results}
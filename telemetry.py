@@ -0,0 +1,380 @@
+"""
+In-memory history of connector measurements.
+Every status poll appends current and voltage per charger, connector and phase to
+fixed size ring buffers of typed arrays. Samples are rolled up into minute and hour
+buckets while they arrive, so power curves and load analysis can look back further
+than the raw samples are kept. Range queries slice the arrays and aggregate them
+with the C implemented sum and max.
+"""
+import time
+
+from array import array
+from collections.abc import Iterator
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from chargeampsdata import ChargePointConnectorStatus, ChargePointStatus
+
+DEFAULT_RAW_CAPACITY = 720  # 2 hours of 10 second polls
+DEFAULT_MINUTE_CAPACITY = 1440  # 1 day
+DEFAULT_HOUR_CAPACITY = 24 * 31  # 1 month
+# samples further apart are a gap in the data, not a constant load
+DEFAULT_MAX_GAP = 15 * 60
+
+RESOLUTIONS = {"raw": 0, "minute": 60, "hour": 3600}
+
+_RAW_COLUMNS = {"t": "I", "current": "f", "voltage": "f", "energy": "d"}
+_ROLLUP_COLUMNS = {
+    "t": "I",
+    "count": "H",
+    "current": "f",
+    "peak": "f",
+    "voltage": "f",
+    "energy": "f"
+}
+
+
+class _Ring:
+    """Typed array columns of fixed capacity, the oldest row is overwritten"""
+
+    def __init__(self, capacity: int, columns: dict[str, str]):
+        self.capacity = capacity
+        self.columns = {
+            name: array(code, bytes(array(code).itemsize * capacity))
+            for name, code in columns.items()
+        }
+        self._start = 0
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.itemsize * len(column)
+                   for column in self.columns.values())
+
+    def covers(self, timestamp: float) -> bool:
+        """Check if no row at or after a timestamp was overwritten yet"""
+        return self._len > 0 and (self._len < self.capacity
+                                  or self.get("t", 0) <= timestamp)
+
+    def _physical(self, index: int) -> int:
+        return (self._start + index) % self.capacity
+
+    def append(self, values: dict) -> None:
+        if self._len < self.capacity:
+            row = self._physical(self._len)
+            self._len += 1
+        else:
+            row = self._start
+            self._start = (self._start + 1) % self.capacity
+        for name, column in self.columns.items():
+            column[row] = values[name]
+
+    def get(self, name: str, index: int) -> float:
+        """Get a value by logical index, negative indices count from the newest row"""
+        if index < 0:
+            index += self._len
+        return self.columns[name][self._physical(index)]
+
+    def set_last(self, name: str, value: float) -> None:
+        self.columns[name][self._physical(self._len - 1)] = value
+
+    def bisect(self, timestamp: float) -> int:
+        """Get the logical index of the first row at or after a timestamp"""
+        times = self.columns["t"]
+        lo, hi = 0, self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[self._physical(mid)] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def slices(self, name: str, lo: int, hi: int) -> Iterator[array]:
+        """Get the rows lo to hi of a column as at most two array slices"""
+        if lo >= hi:
+            return
+        column = self.columns[name]
+        first, last = self._physical(lo), self._physical(hi - 1) + 1
+        if first < last:
+            yield column[first:last]
+        else:
+            yield column[first:]
+            yield column[:last]
+
+
+class PhaseSeries:
+    """
+    Raw samples and minute and hour rollups of a single phase"""
+
+    def __init__(self,
+                 raw_capacity: int = DEFAULT_RAW_CAPACITY,
+                 minute_capacity: int = DEFAULT_MINUTE_CAPACITY,
+                 hour_capacity: int = DEFAULT_HOUR_CAPACITY,
+                 max_gap: float = DEFAULT_MAX_GAP):
+        """
+        History of a single phase
+        :param raw_capacity: number of raw samples kept
+        :param minute_capacity: number of minute rollups kept
+        :param hour_capacity: number of hour rollups kept
+        :param max_gap: seconds between two samples up to which energy is integrated"""
+        self._raw = _Ring(raw_capacity, _RAW_COLUMNS)
+        self._rollups = {
+            RESOLUTIONS["minute"]: _Ring(minute_capacity, _ROLLUP_COLUMNS),
+            RESOLUTIONS["hour"]: _Ring(hour_capacity, _ROLLUP_COLUMNS),
+        }
+        self._max_gap = max_gap
+        self._last = None
+        self._energy = 0.0
+
+    @property
+    def nbytes(self) -> int:
+        """Memory of the buffers in bytes"""
+        return self._raw.nbytes + sum(ring.nbytes
+                                      for ring in self._rollups.values())
+
+    def append(self, timestamp: float, current: float,
+               voltage: float) -> bool:
+        """Append a sample
+        :param timestamp: seconds since the epoch
+        :param current: current in A
+        :param voltage: voltage in V
+        :return: False if the sample is not newer than the last one"""
+        timestamp = int(timestamp)
+        power = current * voltage
+        increment = 0.0
+        if self._last is not None:
+            last_time, last_power = self._last
+            if timestamp <= last_time:
+                return False
+            if timestamp - last_time <= self._max_gap:
+                # trapezoid between the two samples, in Wh
+                increment = (timestamp - last_time) * (power +
+                                                       last_power) / 7200
+        self._last = (timestamp, power)
+        self._energy += increment
+        self._raw.append({
+            "t": timestamp,
+            "current": current,
+            "voltage": voltage,
+            "energy": self._energy
+        })
+        for seconds, ring in self._rollups.items():
+            self._roll(ring, timestamp - timestamp % seconds, current, voltage,
+                       increment)
+        return True
+
+    @staticmethod
+    def _roll(ring: _Ring, bucket: int, current: float, voltage: float,
+              increment: float) -> None:
+        """Add a sample to the newest bucket, which is updated in place"""
+        if not len(ring) or ring.get("t", -1) != bucket:
+            ring.append({
+                "t": bucket,
+                "count": 1,
+                "current": current,
+                "peak": current,
+                "voltage": voltage,
+                "energy": increment
+            })
+            return
+        count = ring.get("count", -1) + 1
+        ring.set_last("count", count)
+        for name, value in (("current", current), ("voltage", voltage)):
+            mean = ring.get(name, -1)
+            ring.set_last(name, mean + (value - mean) / count)
+        ring.set_last("peak", max(ring.get("peak", -1), current))
+        ring.set_last("energy", ring.get("energy", -1) + increment)
+
+    def _ring_for(self, start: float) -> tuple[int, _Ring]:
+        """Get the finest resolution still holding the start of a range"""
+        for seconds, ring in ((0, self._raw), *self._rollups.items()):
+            if ring.covers(start):
+                return seconds, ring
+        seconds = RESOLUTIONS["hour"]
+        return seconds, self._rollups[seconds]
+
+    def energy_wh(self, start: float, end: float) -> float:
+        """Integrate the energy of a time range
+        :param start: seconds since the epoch
+        :param end: seconds since the epoch
+        :return: energy in Wh"""
+        seconds, ring = self._ring_for(start)
+        if seconds:
+            lo, hi = ring.bisect(start - start % seconds), ring.bisect(end + 1)
+            return float(sum(sum(part) for part in ring.slices("energy", lo, hi)))
+        lo, hi = ring.bisect(start), ring.bisect(end + 1)
+        if hi - lo < 2:
+            return 0.0
+        return ring.get("energy", hi - 1) - ring.get("energy", lo)
+
+    def peak_current(self, start: float, end: float) -> float | None:
+        """Get the highest current of a time range
+        :param start: seconds since the epoch
+        :param end: seconds since the epoch
+        :return: current in A or None without samples"""
+        seconds, ring = self._ring_for(start)
+        name = "peak" if seconds else "current"
+        lo = ring.bisect(start - start % seconds if seconds else start)
+        peaks = [max(part) for part in ring.slices(name, lo, ring.bisect(end + 1))]
+        return max(peaks) if peaks else None
+
+    def curve(self, start: float, end: float,
+              resolution: str) -> list[tuple[int, float, float]]:
+        """Get the samples or rollups of a time range
+        :param start: seconds since the epoch
+        :param end: seconds since the epoch
+        :param resolution: raw, minute or hour
+        :return: list of (timestamp, current, voltage)"""
+        seconds = RESOLUTIONS[resolution]
+        ring = self._rollups[seconds] if seconds else self._raw
+        lo = ring.bisect(start - start % seconds if seconds else start)
+        hi = ring.bisect(end + 1)
+        columns = [[value for part in ring.slices(name, lo, hi) for value in part]
+                   for name in ("t", "current", "voltage")]
+        return list(zip(*columns))
+
+
+class TelemetryStore:
+    """
+    Measurement history of all chargers, connectors and phases"""
+
+    def __init__(self, **series_options):
+        """
+        Measurement history
+        :param series_options: capacities and max_gap of every PhaseSeries"""
+        self._series_options = series_options
+        self._series = {}
+
+    @property
+    def nbytes(self) -> int:
+        """Memory of all buffers in bytes"""
+        return sum(series.nbytes for series in self._series.values())
+
+    def append(self,
+               charge_point_id: str,
+               connector_id: int,
+               phase: str,
+               current: float,
+               voltage: float,
+               timestamp: float | None = None) -> bool:
+        """Append a measurement
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param phase: phase of the measurement, e.g. L1
+        :param current: current in A
+        :param voltage: voltage in V
+        :param timestamp: seconds since the epoch, defaults to now
+        :return: False if the measurement is not newer than the last one"""
+        key = (charge_point_id, connector_id, phase)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = PhaseSeries(**self._series_options)
+        return series.append(time.time() if timestamp is None else timestamp,
+                             current, voltage)
+
+    def record_status(self,
+                      status: "ChargePointStatus",
+                      timestamp: float | None = None) -> int:
+        """Append the measurements of a status poll
+        :param status: ChargePointStatus object
+        :param timestamp: seconds since the epoch, defaults to now
+        :return: number of appended measurements"""
+        timestamp = time.time() if timestamp is None else timestamp
+        return sum(
+            self.record_connector_status(connector, timestamp)
+            for connector in status.connector_statuses)
+
+    def record_connector_status(self,
+                                connector: "ChargePointConnectorStatus",
+                                timestamp: float | None = None) -> int:
+        """Append the measurements of a single connector, e.g. of a callback
+        :param connector: ChargePointConnectorStatus object
+        :param timestamp: seconds since the epoch, defaults to now
+        :return: number of appended measurements"""
+        timestamp = time.time() if timestamp is None else timestamp
+        appended = 0
+        for measurement in connector.measurements or []:
+            appended += self.append(connector.charge_point_id,
+                                    connector.connector_id, measurement.phase,
+                                    measurement.current, measurement.voltage,
+                                    timestamp)
+        return appended
+
+    def phases(self, charge_point_id: str, connector_id: int) -> list[str]:
+        """Get the phases with measurements of a connector"""
+        return sorted(phase for cp, conn, phase in self._series
+                      if (cp, conn) == (charge_point_id, connector_id))
+
+    def _selected(self, charge_point_id: str, connector_id: int,
+                  phase: str | None) -> list[PhaseSeries]:
+        phases = [phase] if phase else self.phases(charge_point_id,
+                                                   connector_id)
+        return [
+            self._series[(charge_point_id, connector_id, name)]
+            for name in phases
+            if (charge_point_id, connector_id, name) in self._series
+        ]
+
+    def energy_wh(self,
+                  charge_point_id: str,
+                  connector_id: int,
+                  start_time: datetime,
+                  end_time: datetime,
+                  phase: str | None = None) -> float:
+        """Integrate the energy of a connector
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param start_time: start of the range
+        :param end_time: end of the range
+        :param phase: single phase, None sums all phases
+        :return: energy in Wh"""
+        return sum(
+            series.energy_wh(start_time.timestamp(), end_time.timestamp())
+            for series in self._selected(charge_point_id, connector_id, phase))
+
+    def peak_current(self,
+                     charge_point_id: str,
+                     connector_id: int,
+                     start_time: datetime,
+                     end_time: datetime,
+                     phase: str | None = None) -> float | None:
+        """Get the highest current of a connector
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param start_time: start of the range
+        :param end_time: end of the range
+        :param phase: single phase, None for the highest of all phases
+        :return: current in A or None without measurements"""
+        peaks = [
+            peak for series in self._selected(charge_point_id, connector_id,
+                                              phase)
+            if (peak := series.peak_current(start_time.timestamp(),
+                                            end_time.timestamp())) is not None
+        ]
+        return max(peaks) if peaks else None
+
+    def curve(self,
+              charge_point_id: str,
+              connector_id: int,
+              phase: str,
+              start_time: datetime,
+              end_time: datetime,
+              resolution: str = "minute") -> list[tuple[int, float, float]]:
+        """Get the power curve of a phase
+        :param charge_point_id: ID of the charge point
+        :param connector_id: ID of the connector
+        :param phase: phase, e.g. L1
+        :param start_time: start of the range
+        :param end_time: end of the range
+        :param resolution: raw, minute or hour
+        :return: list of (timestamp, current, voltage)"""
+        series = self._series.get((charge_point_id, connector_id, phase))
+        if series is None:
+            return []
+        return series.curve(start_time.timestamp(), end_time.timestamp(),
+                            resolution)
@@ -0,0 +1,266 @@
+"""
+Multi account support.
+Every tenant (charge amps account) gets its own logged in Client. All clients share
+one connection pool, and upstream requests are granted round robin across tenants,
+so a large export of one tenant can not starve the requests of the others.
+"""
+import asyncio
+import logging
+import os
+
+from collections import deque
+
+from chargeampscfgparser import DEFAULT_TENANT
+from transport import AIOHTTP
+
+DEFAULT_POOL_SIZE = 32
+
+
+def token_file_name(tenant: str) -> str:
+    """Get the name of the persisted token file of a tenant
+    :param tenant: name of the tenant
+    :return: token.enc for the default tenant, token-<tenant>.enc otherwise"""
+    return "token.enc" if tenant == DEFAULT_TENANT else f"token-{tenant}.enc"
+
+
+class FairScheduler:
+    """
+    Grants a limited number of request slots round robin across tenants"""
+
+    def __init__(self, total_slots: int = DEFAULT_POOL_SIZE):
+        """
+        Fair request scheduler
+        :param total_slots: number of requests running at the same time over all tenants"""
+        self._free = total_slots
+        self._caps = {}
+        self._running = {}
+        self._waiters = {}
+        # tenants with waiting requests in round robin order
+        self._turns = deque()
+
+    def register(self, tenant: str, max_concurrency: int) -> None:
+        """Add a tenant or change its cap
+        :param tenant: name of the tenant
+        :param max_concurrency: number of requests the tenant may run at the same time"""
+        self._caps[tenant] = max_concurrency
+        self._running.setdefault(tenant, 0)
+        self._waiters.setdefault(tenant, deque())
+
+    def running(self, tenant: str) -> int:
+        """Get the number of running requests of a tenant"""
+        return self._running[tenant]
+
+    def _dispatch(self) -> None:
+        """Grant free slots to the waiting tenants in turn"""
+        blocked = 0
+        while self._free > 0 and blocked < len(self._turns):
+            tenant = self._turns.popleft()
+            waiters = self._waiters[tenant]
+            while waiters and waiters[0].done():
+                # cancelled while waiting
+                waiters.popleft()
+            if not waiters:
+                continue
+            if self._running[tenant] >= self._caps[tenant]:
+                self._turns.append(tenant)
+                blocked += 1
+                continue
+            waiters.popleft().set_result(None)
+            self._running[tenant] += 1
+            self._free -= 1
+            blocked = 0
+            if waiters:
+                self._turns.append(tenant)
+
+    async def acquire(self, tenant: str) -> None:
+        """Wait for a request slot of a tenant
+        :param tenant: name of the tenant"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[tenant].append(waiter)
+        if tenant not in self._turns:
+            self._turns.append(tenant)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # granted and cancelled at the same time
+                self.release(tenant)
+            raise
+
+    def release(self, tenant: str) -> None:
+        """Return a request slot of a tenant
+        :param tenant: name of the tenant"""
+        self._running[tenant] -= 1
+        self._free += 1
+        self._dispatch()
+
+    def limiter(self, tenant: str) -> "TenantLimiter":
+        """Get the limiter passed to the client of a tenant
+        :param tenant: name of the tenant
+        :return: TenantLimiter object"""
+        return TenantLimiter(self, tenant)
+
+
+class TenantLimiter:
+    """
+    Async context manager holding a request slot of a tenant"""
+
+    def __init__(self, scheduler: FairScheduler, tenant: str):
+        self._scheduler = scheduler
+        self._tenant = tenant
+
+    async def __aenter__(self) -> None:
+        await self._scheduler.acquire(self._tenant)
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._scheduler.release(self._tenant)
+
+
+class ClientLease:
+    """
+    Use of the clients of a TenantManager, released exactly once"""
+
+    def __init__(self, manager: "TenantManager"):
+        self._manager = manager
+        self._released = False
+        manager._users += 1
+        manager._idle.clear()
+
+    def release(self) -> None:
+        """End the use of the clients"""
+        if self._released:
+            return
+        self._released = True
+        self._manager._users -= 1
+        if self._manager._users == 0:
+            self._manager._idle.set()
+
+
+class TenantManager:
+    """
+    One pooled, logged in Client per tenant"""
+
+    def __init__(self,
+                 tenants: dict[str, dict],
+                 key: bytes,
+                 cache=None,
+                 token_dir: str | None = None,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 telemetry=None,
+                 transport: str = AIOHTTP):
+        """
+        Tenant aware client manager
+        :param tenants: dict of account data by tenant, see ChargeAmpsCfgParser.get_tenant_data
+        :param key: Fernet key of the encrypted credentials and tokens
+        :param cache: cache backend shared by all tenants, keys are scoped per account
+        :param token_dir: directory of the persisted tokens, None disables persistence
+        :param pool_size: number of upstream connections shared by all tenants
+        :param telemetry: TelemetryStore shared by all tenants
+        :param transport: HTTP transport of the clients, the connection pool is only
+            shared with aiohttp, http2 multiplexes on one connection per tenant"""
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        self._tenants = tenants
+        self._key = key
+        self._cache = cache
+        self._token_dir = token_dir
+        self._pool_size = pool_size
+        self._telemetry = telemetry
+        self._transport = transport
+        self._scheduler = FairScheduler(pool_size)
+        for name, data in tenants.items():
+            self._scheduler.register(name, data["maxConcurrency"])
+        self._connector = None
+        self._clients = {}
+        self._locks = {name: asyncio.Lock() for name in tenants}
+        self._users = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def tenants(self) -> list[str]:
+        """Names of the configured tenants"""
+        return list(self._tenants)
+
+    def resolve(self, tenant: str | None) -> str:
+        """Get the tenant a request is for
+        :param tenant: name of the tenant, None or empty if the request names none
+        :return: the given tenant, else the only configured tenant or the default tenant"""
+        if tenant:
+            return tenant
+        if len(self._tenants) == 1:
+            return next(iter(self._tenants))
+        return DEFAULT_TENANT
+
+    def tenant_data(self, tenant: str) -> dict:
+        """Get the account data of a tenant
+        :param tenant: name of the tenant
+        :return: dict with baseUrl, pricekWh, maxConcurrency, ..."""
+        if tenant not in self._tenants:
+            raise KeyError(f"Unknown tenant {tenant}")
+        return self._tenants[tenant]
+
+    async def get_client(self, tenant: str = DEFAULT_TENANT):
+        """Get the client of a tenant, logging in on first use
+        :param tenant: name of the tenant
+        :return: initialized Client object"""
+        data = self.tenant_data(tenant)
+        async with self._locks[tenant]:
+            if tenant not in self._clients:
+                from aiohttp import TCPConnector
+                from chargeampsclient import Client
+                from utils.utils import decrypt_many
+
+                if self._connector is None and self._transport == AIOHTTP:
+                    self._connector = TCPConnector(limit=self._pool_size)
+                token_file = None
+                if self._token_dir:
+                    token_file = os.path.join(self._token_dir,
+                                              token_file_name(tenant))
+                email, password = decrypt_many(
+                    (data["email"], data["password"]), self._key)
+                client = Client(email,
+                                password,
+                                data["apiKey"],
+                                data["baseUrl"],
+                                cache=self._cache,
+                                token_key=self._key,
+                                token_file=token_file,
+                                connector=self._connector,
+                                limiter=self._scheduler.limiter(tenant),
+                                telemetry=self._telemetry,
+                                transport=self._transport)
+                try:
+                    await client.init_session()
+                except BaseException:
+                    await client.close_session()
+                    raise
+                self._clients[tenant] = client
+            return self._clients[tenant]
+
+    def lease(self) -> ClientLease:
+        """Register a user of the clients, e.g. a request streaming an export
+        :return: ClientLease object, release it when done"""
+        return ClientLease(self)
+
+    async def drain(self, timeout: float | None = None) -> None:
+        """Close all clients once all leases are released
+        :param timeout: seconds to wait for the leases, None waits for all"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except TimeoutError:
+            self._logger.warning("Closing clients still used by %d requests",
+                                 self._users)
+        await self.close()
+
+    async def close(self) -> None:
+        """Close all clients and the shared connection pool"""
+        for tenant, lock in self._locks.items():
+            async with lock:
+                client = self._clients.pop(tenant, None)
+                if client is not None:
+                    await client.close_session()
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
@@ -1,13 +1,58 @@
 from chargeampsclient import Client
 from chargeampscfgparser import ChargeAmpsCfgParser
-from xlsxresultwriter import XlsxResult
-from utils.utils import get_or_create_encryption_key, decrypt
+from xlsxresultwriter import XlsxResult, sheet_names
+from utils.utils import get_or_create_encryption_key, decrypt, encrypt
+from utils.utils import KeyManager, decrypt_many
+from utils.rotate_key import rotate_cfg_key
 
 import unittest
 from unittest.mock import patch, mock_open
+import asyncio
 import configparser
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 from utils.cfg_file_generator import prompt_cfg_interactive
+from profiler import SamplingProfiler, ProfileStore, profiled, PROFILE_HEADER, PROFILE_ID_HEADER
+from jsonstream import JsonArrayDecoder, iter_json_array
+from exportpipeline import ExportPipeline, PricedSession, split_windows
+from csvresultwriter import CsvResult
+from chargeampsdata import ChargingSession
+from rfidreport import aggregate_by_rfid
+from xlsxtemplate import load_template
+from rfidbundle import SUMMARY_NAME, create_executor, iter_bundle, workbook_names
+from batchexport import ExportJob, load_manifest, run_batch, run_job
+from tenants import FairScheduler, TenantManager
+from watermarks import Watermark, WatermarkStore, watermark_key
+from archive import Partition, SessionArchive, archive_months
+from rfidindex import RfidIndex, matches
+from telemetry import TelemetryStore
+from scheduleindex import ScheduleIndex
+from schedulesync import diff_schedules, sync_schedules
+from loadbalancer import Demand, LoadBalancer, allocate
+from events import EventBus, LiveState, SESSION_EVENT, STATUS_EVENT, parse_events
+from utils.callback_sender import build_body, storm
+from utils.transport_benchmark import MockApi, benchmark, serve
+from circuitbreaker import (BreakerRegistry, CircuitBreaker, CircuitOpenError, endpoint_of,
+                            is_upstream_failure, partial_results, stale_results,
+                            track_stale)
+from chargeampsdata import ChargePointStatus, ChargePointConnectorStatus, ChargePointMeasurement, ChargePointSchedule
+from chargeampsdata import ChargePointConnectorSettings
+from cachestore import MemoryCache, SqliteCache, RedisCache
+from deadlines import DeadlineExceeded, deadline, remaining
+from admission import AdmissionController, AdmissionRejected, BULK, INTERACTIVE, admitted
+from aiohttp import web
+from cryptography.fernet import Fernet
+import jwt
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
 
 
 class TestCfgFileGenerator(unittest.TestCase):
@@ -129,6 +174,1730 @@ class TestPyChargeAmpsAPI(unittest.IsolatedAsyncioTestCase):
         await myclient.close_session()
 
 
+class TestProfiler(unittest.TestCase):
+
+    def test_sampling_profiler(self):
+        """Profiler collects collapsed stacks of the sampled thread"""
+
+        def busy_loop():
+            end = time.time() + 0.1
+            while time.time() < end:
+                sum(range(1000))
+
+        profiler = SamplingProfiler(threading.get_ident(), interval=0.001)
+        profiler.start()
+        busy_loop()
+        profiler.stop()
+        self.assertGreater(profiler.sample_count, 0)
+        self.assertIn("busy_loop", profiler.collapsed())
+
+    def test_profile_store_retention(self):
+        """Store keeps only the newest profiles"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = ProfileStore(tmp_dir, retention=2)
+            for request_id in ("a", "b", "c"):
+                store.save(request_id, "main;work 1\n")
+                time.sleep(0.01)
+            self.assertEqual(store.request_ids(), ["c", "b"])
+            self.assertIsNone(store.load("a"))
+            self.assertIsNone(store.load("../etc/passwd"))
+            self.assertEqual(store.load("c"), "main;work 1\n")
+
+    def test_profiled_streamed_response(self):
+        """A streamed body is sampled until it is sent"""
+        from quart import Quart, Response
+
+        def render_rows():
+            end = time.time() + 0.1
+            while time.time() < end:
+                sum(range(1000))
+
+        async def export_and_load(store):
+            web_app = Quart(__name__)
+
+            @web_app.route("/export")
+            @profiled(store, "secret", interval=0.001)
+            async def export():
+
+                async def chunks():
+                    render_rows()
+                    yield b"row\n"
+
+                return Response(chunks(), mimetype="text/csv")
+
+            response = await web_app.test_client().get(
+                "/export", headers={PROFILE_HEADER: "secret", "X-Request-ID": "req1"})
+            self.assertEqual(await response.get_data(), b"row\n")
+            self.assertEqual(response.headers[PROFILE_ID_HEADER], "req1")
+            return store.load("req1")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profile = asyncio.run(export_and_load(ProfileStore(tmp_dir)))
+        self.assertIn("render_rows", profile)
+
+
+class TestJsonStream(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.data = [{
+            "rfid": "9C8BE8DF",
+            "name": "quote \" bracket ] brace } comma ,",
+            "nested": [1, {"a": None}]
+        }, 2, "plain", [], {
+            "path": "C:\\"
+        }]
+        self.raw = json.dumps(self.data).encode()
+
+    def test_decoder_chunk_boundaries(self):
+        """Elements are decoded for every possible chunk size"""
+        for chunk_size in range(1, len(self.raw) + 1):
+            decoder = JsonArrayDecoder()
+            elements = []
+            for i in range(0, len(self.raw), chunk_size):
+                elements += decoder.feed(self.raw[i:i + chunk_size])
+            decoder.close()
+            self.assertEqual(elements, self.data)
+
+    def test_decoder_rejects_invalid_body(self):
+        """Non-array and truncated bodies raise ValueError"""
+        with self.assertRaises(ValueError):
+            JsonArrayDecoder().feed(b'{"token": "abc"}')
+        decoder = JsonArrayDecoder()
+        decoder.feed(self.raw[:-3])
+        with self.assertRaises(ValueError):
+            decoder.close()
+
+    async def test_iter_json_array(self):
+        """Async iteration yields elements as chunks arrive"""
+
+        async def chunks():
+            for i in range(0, len(self.raw), 7):
+                yield self.raw[i:i + 7]
+
+        elements = [element async for element in iter_json_array(chunks())]
+        self.assertEqual(elements, self.data)
+
+
+def make_session(session_id: int,
+                 rfid: str,
+                 kwh: float = 10.0,
+                 start_time: datetime = datetime(2025, 1, 1, 10),
+                 charge_point_id: str = "CP1",
+                 connector_id: int = 1) -> ChargingSession:
+    """Create a ChargingSession for tests"""
+    return ChargingSession(id=session_id,
+                           charge_point_id=charge_point_id,
+                           connector_id=connector_id,
+                           user_id="user",
+                           rfid=rfid,
+                           rfidDec=str(int(rfid, 16)),
+                           rfidDecReverse=str(
+                               int.from_bytes(
+                                   bytes.fromhex(rfid)[::-1], "big")),
+                           organisationId=None,
+                           session_type="RFID",
+                           total_consumption_kwh=kwh,
+                           externalTransactionId=None,
+                           externalId=None,
+                           start_time=start_time,
+                           end_time=start_time + timedelta(hours=2))
+
+
+class FakeSessionClient:
+    """Client stand-in serving sessions from memory"""
+
+    def __init__(self, sessions: list[ChargingSession]):
+        self.sessions = sessions
+        self.calls = []
+
+    async def iter_connector_chargingsessions(self,
+                                              charge_point_id,
+                                              connector_id,
+                                              start_time=None,
+                                              end_time=None):
+        self.calls.append((charge_point_id, connector_id, start_time,
+                           end_time))
+        for session in self.sessions:
+            if session.charge_point_id != charge_point_id or session.connector_id != connector_id:
+                continue
+            if start_time and session.end_time < start_time:
+                continue
+            if end_time and session.start_time > end_time:
+                continue
+            yield session
+
+    def canonical_rfid(self, rfid):
+        index = RfidIndex()
+        index.update(self.sessions)
+        return index.canonical(rfid)
+
+    async def get_chargingsessions(self,
+                                   charge_point_id,
+                                   start_time=None,
+                                   end_time=None):
+        self.calls.append((charge_point_id, None, start_time, end_time))
+        return [
+            session for session in self.sessions
+            if session.charge_point_id == charge_point_id and
+            start_time <= session.start_time < end_time
+        ]
+
+
+class TestExportPipeline(unittest.IsolatedAsyncioTestCase):
+
+    def test_split_windows(self):
+        """Ranges are split into consecutive windows"""
+        windows = split_windows(datetime(2025, 1, 1), datetime(2025, 1, 10),
+                                timedelta(days=4))
+        self.assertEqual(windows,
+                         [(datetime(2025, 1, 1), datetime(2025, 1, 5)),
+                          (datetime(2025, 1, 5), datetime(2025, 1, 9)),
+                          (datetime(2025, 1, 9), datetime(2025, 1, 10))])
+        self.assertEqual(split_windows(None, None, timedelta(days=1)),
+                         [(None, None)])
+
+    async def test_pipeline_filters_and_prices(self):
+        """Sessions are deduplicated, filtered by RFID and priced"""
+        sessions = [
+            make_session(i, "9C8BE8DF" if i % 2 else "AABBCCDD", kwh=2.0,
+                         start_time=datetime(2025, 1, 1 + i, 23))
+            for i in range(10)
+        ]
+        client = FakeSessionClient(sessions)
+        pipeline = ExportPipeline(client,
+                                  charge_point_id="CP1",
+                                  connector_id=1,
+                                  kwh_price="30",
+                                  rfid="9C8BE8DF",
+                                  start_time=datetime(2025, 1, 1),
+                                  end_time=datetime(2025, 1, 12),
+                                  window=timedelta(days=1),
+                                  queue_size=2)
+        priced = [p async for p in pipeline]
+        self.assertEqual([p.session.id for p in priced], [1, 3, 5, 7, 9])
+        self.assertAlmostEqual(priced[0].total_costs, 0.6)
+        self.assertEqual(len(client.calls), 11)
+
+    async def test_csv_ongoing_session(self):
+        """An ongoing session is written with an empty end"""
+        ongoing = replace(make_session(2, "AABBCCDD", kwh=1.0), end_time=None)
+
+        async def priced_sessions():
+            for session in (make_session(1, "AABBCCDD", kwh=2.0), ongoing):
+                yield PricedSession(session, 30.0, session.total_consumption_kwh * 0.3)
+
+        chunks = [chunk async for chunk in CsvResult().iter_output_file(priced_sessions())]
+        rows = list(csv.reader(io.StringIO(b"".join(chunks).decode())))
+        self.assertEqual(rows[1][1:3], ["2025-01-01 10:00", "2025-01-01 12:00"])
+        self.assertEqual(rows[2][1:3], ["2025-01-01 10:00", ""])
+        self.assertEqual(rows[3][5:], ["Total Costs", "0.90"])
+
+    async def test_xlsx_ongoing_session(self):
+        """An ongoing session is written with an empty end"""
+        import openpyxl
+        ongoing = replace(make_session(2, "AABBCCDD", kwh=1.0), end_time=None)
+
+        async def priced_sessions():
+            for session in (make_session(1, "AABBCCDD", kwh=2.0), ongoing):
+                yield PricedSession(session, 30.0, session.total_consumption_kwh * 0.3)
+
+        output = await XlsxResult().gen_output_file_from_stream(priced_sessions(), 30.0)
+        worksheet = openpyxl.load_workbook(output).active
+        self.assertEqual(worksheet.cell(2, 3).value, datetime(2025, 1, 1, 12))
+        self.assertIsNone(worksheet.cell(3, 3).value)
+
+
+class TestRfidReport(unittest.TestCase):
+
+    def test_aggregate_by_rfid(self):
+        """Sessions of all chargers are grouped by tag in one pass"""
+        sessions = [
+            make_session(1, "AABBCCDD", kwh=10.0, charge_point_id="CP1"),
+            make_session(2, "9C8BE8DF", kwh=5.0, charge_point_id="CP2"),
+            make_session(3, "AABBCCDD", kwh=2.5, charge_point_id="CP2",
+                         connector_id=2),
+            make_session(4, "00000000000000", kwh=1.0),
+        ]
+        usages = aggregate_by_rfid(sessions, "30")
+        self.assertEqual(list(usages), ["9C8BE8DF", "AABBCCDD"])
+        usage = usages["AABBCCDD"]
+        self.assertEqual(usage.session_count, 2)
+        self.assertAlmostEqual(usage.total_consumption_kwh, 12.5)
+        self.assertAlmostEqual(usage.total_costs, 3.75)
+        self.assertEqual([s.id for s in usage.sessions], [1, 3])
+
+    def test_report_sheet_names(self):
+        """Tags differing in case or after 31 characters get their own sheets"""
+        import openpyxl
+        long_tag = "A" * 40
+        sessions = [
+            make_session(1, "aabbccdd"),
+            make_session(2, "AABBCCDD"),
+            make_session(3, long_tag),
+            make_session(4, long_tag + "BB"),
+        ]
+        self.assertEqual(sheet_names(["aabbccdd", "AABBCCDD", long_tag, long_tag + "BB"]),
+                         {"aabbccdd": "aabbccdd", "AABBCCDD": "AABBCCDD_2",
+                          long_tag: "A" * 31, long_tag + "BB": "A" * 29 + "_2"})
+        output = XlsxResult().gen_rfid_report(aggregate_by_rfid(sessions, "30"), "30")
+        self.assertEqual(len(openpyxl.load_workbook(output).sheetnames), 5)
+
+
+class TestFleetSessions(unittest.IsolatedAsyncioTestCase):
+
+    async def testPartialFleet(self):
+        """A failing charger leaves out its sessions, all failing fail the request"""
+        from types import SimpleNamespace
+        client = Client("test@example.com", "secret", "apikey", "http://127.0.0.1:9")
+        charge_points = [
+            SimpleNamespace(connectors=[SimpleNamespace(charge_point_id=cp, connector_id=1)])
+            for cp in ("CP1", "CP2")
+        ]
+        failing = {"CP2"}
+
+        async def get_chargepoints():
+            return charge_points
+
+        async def get_connector_chargingsessions(charge_point_id, connector_id, start_time,
+                                                 end_time):
+            if charge_point_id in failing:
+                raise OSError("unreachable")
+            return [make_session(1, "AA01", charge_point_id=charge_point_id)]
+
+        client.get_chargepoints = get_chargepoints
+        client.get_connector_chargingsessions = get_connector_chargingsessions
+        track_stale()
+        sessions = await client.get_fleet_chargingsessions()
+        self.assertEqual([s.charge_point_id for s in sessions], ["CP1"])
+        self.assertEqual(partial_results(), ["sessions of CP2"])
+        failing.add("CP1")
+        with self.assertRaises(OSError):
+            await client.get_fleet_chargingsessions()
+
+
+class TestRfidBundle(unittest.IsolatedAsyncioTestCase):
+
+    async def testBundle(self):
+        """Every tag gets its own workbook in the streamed ZIP"""
+        import openpyxl
+        import zipfile
+        from io import BytesIO
+        sessions = [
+            make_session(i, ("AA01", "BB02", "CC03")[i % 3], kwh=1.0 + i)
+            for i in range(7)
+        ]
+        usages = aggregate_by_rfid(sessions, 30)
+        executor = create_executor(2)
+        try:
+            chunks = [chunk async for chunk in iter_bundle(usages, 30.0, executor)]
+        finally:
+            executor.shutdown()
+        self.assertGreater(len(chunks), 2)
+        with zipfile.ZipFile(BytesIO(b"".join(chunks))) as bundle:
+            self.assertEqual(bundle.namelist()[0], SUMMARY_NAME)
+            self.assertEqual(sorted(bundle.namelist()[1:]),
+                             ["AA01.xlsx", "BB02.xlsx", "CC03.xlsx"])
+            sheet = openpyxl.load_workbook(BytesIO(bundle.read("AA01.xlsx"))).active
+            self.assertEqual([row[0] for row in sheet.iter_rows(min_row=2, max_col=1,
+                                                                 values_only=True)],
+                             [1, 2, 3, None])
+            summary = openpyxl.load_workbook(BytesIO(bundle.read(SUMMARY_NAME)))
+            self.assertEqual(summary.sheetnames, ["RFID Summary"])
+        chunks = [chunk async for chunk in iter_bundle(usages, 30.0, summary=False)]
+        with zipfile.ZipFile(BytesIO(b"".join(chunks))) as bundle:
+            self.assertNotIn(SUMMARY_NAME, bundle.namelist())
+        self.assertEqual(workbook_names(["A/1", "A:1", "summary"]),
+                         {"A/1": "A_1.xlsx", "A:1": "A_1_2.xlsx", "summary": "summary_2.xlsx"})
+
+
+class TestXlsxTemplate(unittest.TestCase):
+
+    def testTemplateLayout(self):
+        """Exports take titles, styles and widths from the template, totals are computed"""
+        import openpyxl
+        template = load_template()
+        self.assertIs(load_template(), template)
+        sessions = [make_session(i, "AA01", kwh=10.0 + i,
+                                 start_time=datetime(2025, 1, 1 + i, 8)) for i in range(3)]
+        output = XlsxResult(template).gen_output_file(sessions, "30")
+        sheet = openpyxl.load_workbook(output).active
+        self.assertEqual([cell.value for cell in sheet[1]],
+                         ["No Charging Process", "Start", "End", "kWh", "RFID tag",
+                          "cent/kWh", "total costs"])
+        self.assertTrue(sheet["A1"].font.b)
+        self.assertEqual(sheet["B1"].border.bottom.style, "thin")
+        self.assertAlmostEqual(sheet.column_dimensions["A"].width, 18.2, delta=1)
+        self.assertEqual(sheet["B2"].value, datetime(2025, 1, 1, 8))
+        self.assertEqual(sheet["E3"].value, "AA01")
+        self.assertEqual(sheet["G2"].number_format, '#,##0.00\\ "€"')
+        self.assertAlmostEqual(sheet["G4"].value, 3.6)
+        self.assertEqual(sheet["F5"].value, "Total Costs")
+        self.assertAlmostEqual(sheet["G5"].value, 9.9)
+        ongoing = replace(sessions[0], end_time=None)
+        sheet = openpyxl.load_workbook(XlsxResult(template).gen_output_file([ongoing], "30")).active
+        self.assertIsNone(sheet["C2"].value)
+
+    def testBuiltinTotal(self):
+        """The total of the built-in layout sums up the last session as well"""
+        import openpyxl
+        sessions = [make_session(i, "AA01") for i in range(3)]
+        sheet = openpyxl.load_workbook(XlsxResult().gen_output_file(sessions, 30)).active
+        self.assertEqual(sheet["G5"].value, "=SUM(G2:G4)")
+
+
+class TestBatchExport(unittest.IsolatedAsyncioTestCase):
+
+    async def testTenantMain(self):
+        """The command line logs in with a TENANT section, unknown tenants are refused"""
+        import batchexport
+        api = MockChargeAmpsApi([make_session(1, "AA01", start_time=datetime(2025, 1, 2))])
+        url = await api.start()
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                env_path = os.path.join(directory, ".env")
+                cfg_path = os.path.join(directory, "cfg.ini")
+                manifest_path = os.path.join(directory, "manifest.json")
+                output_dir = os.path.join(directory, "exports")
+                with patch.dict(os.environ, {"ENV_PATH": env_path, "EMAIL_ENCRYPTION_KEY": ""}):
+                    key = get_or_create_encryption_key()
+                    config = configparser.ConfigParser()
+                    config["GENERAL"] = {"baseUrl": url, "pricekWh": "30"}
+                    config["TENANT:garage"] = {
+                        "email": encrypt("garage@example.com", key),
+                        "password": encrypt("secret", key),
+                        "apiKey": "key"
+                    }
+                    with open(cfg_path, "w") as f:
+                        config.write(f)
+                    with open(manifest_path, "w") as f:
+                        json.dump([{"start": "2025-01-01", "end": "2025-02-01",
+                                    "format": "csv", "name": "january"}], f)
+                    argv = [manifest_path, "--output-dir", output_dir, "--cfg", cfg_path,
+                            "--template", ""]
+                    self.assertEqual(await batchexport.main(argv), 0)
+                    with patch("sys.stderr"), self.assertRaises(SystemExit):
+                        await batchexport.main(argv + ["--tenant", "acme"])
+                self.assertTrue(os.path.exists(os.path.join(output_dir, "january.csv")))
+                self.assertTrue(os.path.exists(os.path.join(directory, "token-garage.enc")))
+        finally:
+            await api.stop()
+
+    async def testRunBatch(self):
+        """Jobs run concurrently and a failing job does not stop the others"""
+        client = FakeSessionClient([
+            make_session(1, "AA01", kwh=10.0),
+            make_session(2, "BB02", kwh=5.0),
+            make_session(3, "AA01", kwh=2.0, connector_id=2),
+        ])
+
+        async def no_chargepoints():
+            return []
+
+        client.get_chargepoints = no_chargepoints
+        jobs = [
+            ExportJob.from_dict({
+                "charge_point_id": "CP1",
+                "rfid": "AA01",
+                "start": "2025-01-01",
+                "end": "2025-02-01",
+                "format": "csv"
+            }),
+            ExportJob.from_dict({
+                "charge_point_id": "CP1",
+                "connector_id": 2,
+                "start": "2025-01-01",
+                "end": "2025-02-01",
+                "name": "connector 2"
+            }),
+            ExportJob.from_dict({
+                "start": "2025-01-01",
+                "end": "2025-02-01",
+                "name": "default charge point"
+            }),
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            results = await run_batch(client, jobs, directory, 25.0, workers=2)
+            self.assertEqual([result.rows for result in results], [1, 1, 0])
+            with open(results[0].path) as f:
+                self.assertIn("Total Costs,2.50", f.read())
+            self.assertTrue(results[1].path.endswith("connector_2.xlsx"))
+            self.assertEqual(results[2].error, "No charge points found.")
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ["AA01_2025-01-01_2025-02-01.csv",
+                              "connector_2.xlsx"])
+
+    def testManifestNames(self):
+        """Duplicate output names are rejected before anything runs"""
+        job = {"rfid": "AA01", "start": "2025-01-01", "end": "2025-02-01"}
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as manifest:
+            json.dump([job, {**job, "format": "csv"}, job], manifest)
+            manifest.flush()
+            with self.assertRaises(ValueError):
+                load_manifest(manifest.name)
+
+    async def testOnlyNewTagFormats(self):
+        """only_new jobs share the watermark of a tag in any format"""
+        session = make_session(1, "04A1B2C3")
+        client = FakeSessionClient([session])
+        job = {"charge_point_id": "CP1", "start": "2025-01-01",
+               "end": "2025-02-01", "format": "csv", "only_new": True}
+        with tempfile.TemporaryDirectory() as directory:
+            store = WatermarkStore(os.path.join(directory, "watermarks.json"))
+            for rfid in ("04:a1:b2:c3", session.rfidDec):
+                result = await run_job(
+                    client, ExportJob.from_dict({**job, "rfid": rfid}),
+                    directory, 25.0, store)
+                self.assertEqual(result.rows, 0 if rfid == session.rfidDec else 1)
+            self.assertIsNotNone(
+                await store.get(watermark_key("CP1", 1, "04A1B2C3")))
+            with self.assertRaises(ValueError):
+                await run_job(client, ExportJob.from_dict({**job, "rfid": "12345"}),
+                              directory, 25.0, store)
+
+    async def testDuplicateOnlyNew(self):
+        """A second only_new job of a tag fails, in whatever format it is given"""
+        session = make_session(1, "04A1B2C3")
+        client = FakeSessionClient([session])
+        job = {"charge_point_id": "CP1", "start": "2025-01-01",
+               "end": "2025-02-01", "format": "csv", "only_new": True}
+        jobs = [ExportJob.from_dict({**job, "rfid": "04:a1:b2:c3", "name": "hex"}),
+                ExportJob.from_dict({**job, "rfid": session.rfidDec, "name": "dec"}),
+                ExportJob.from_dict({**job, "rfid": session.rfidDec, "name": "all",
+                                     "only_new": False})]
+        with tempfile.TemporaryDirectory() as directory:
+            store = WatermarkStore(os.path.join(directory, "watermarks.json"))
+            results = await run_batch(client, jobs, directory, 25.0, watermarks=store)
+        self.assertEqual([result.rows for result in results], [1, 0, 1])
+        self.assertEqual([result.error for result in results],
+                         [None, "Duplicate only_new job of the same tag", None])
+
+
+class TestWatermarks(unittest.IsolatedAsyncioTestCase):
+
+    async def testStore(self):
+        """Watermarks only move forward and survive a restart"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "watermarks.json")
+            key = watermark_key("CP1", 1, "AA01")
+            store = WatermarkStore(path)
+            self.assertIsNone(await store.get(key))
+            newer = Watermark(datetime(2025, 2, 1), 7)
+            await store.advance(key, newer)
+            older = await store.advance(key, Watermark(datetime(2025, 1, 1), 9))
+            self.assertEqual(older, newer)
+            self.assertEqual(await WatermarkStore(path).get(key), newer)
+            self.assertIsNone(await store.get(watermark_key("CP1", 1, None)))
+
+    async def testOnlyNewSessions(self):
+        """An incremental export fetches and exports only the delta"""
+        sessions = [
+            make_session(1, "AA01", start_time=datetime(2025, 1, 3)),
+            make_session(2, "AA01", start_time=datetime(2025, 1, 20)),
+        ]
+        client = FakeSessionClient(sessions)
+
+        async def export(since):
+            pipeline = ExportPipeline(client,
+                                      charge_point_id="CP1",
+                                      connector_id=1,
+                                      kwh_price=25.0,
+                                      rfid="AA01",
+                                      start_time=datetime(2025, 1, 1),
+                                      end_time=datetime(2025, 3, 1),
+                                      since=since)
+            ids = [priced.session.id async for priced in pipeline]
+            return ids, pipeline.watermark
+
+        ids, watermark = await export(None)
+        self.assertEqual(ids, [1, 2])
+        self.assertEqual(watermark, Watermark(datetime(2025, 1, 20, 2), 2))
+        sessions.append(make_session(3, "AA01", start_time=datetime(2025, 2, 5)))
+        client.calls.clear()
+        ids, watermark = await export(watermark)
+        self.assertEqual(ids, [3])
+        self.assertEqual(watermark.session_id, 3)
+        # the fetch starts at the watermark instead of the start of the range
+        self.assertEqual(client.calls[0][2], datetime(2025, 1, 19, 2))
+        ids, unchanged = await export(watermark)
+        self.assertEqual(ids, [])
+        self.assertEqual(unchanged, watermark)
+
+
+class TestArchive(unittest.IsolatedAsyncioTestCase):
+
+    async def testRoundtripAndPruning(self):
+        """Archived sessions read back unchanged, only matching partitions are opened"""
+        sessions = [
+            make_session(i, "AA01", kwh=i / 4,
+                         start_time=datetime(2025, 1 + i % 3, 1 + i, 8),
+                         charge_point_id="CP1" if i % 2 else "CP/2",
+                         connector_id=1 + i % 4 // 2)
+            for i in range(12)
+        ]
+        sessions[3] = replace(sessions[3], organisationId="org", externalId="ü")
+        running = replace(make_session(99, "AA01"), end_time=None)
+        with tempfile.TemporaryDirectory() as directory:
+            archive = SessionArchive(directory)
+            self.assertEqual(archive.append(sessions + [running]), 6)
+            # newer copies replace archived ones
+            sessions[1] = replace(sessions[1], total_consumption_kwh=7.0)
+            self.assertEqual(archive.append([sessions[1]]), 1)
+            self.assertEqual(archive.charge_points(), ["CP1", "CP/2"])
+            expected = sorted((s for s in sessions if s.charge_point_id == "CP1"),
+                              key=lambda s: s.start_time)
+            self.assertEqual(list(archive.sessions("CP1")), expected)
+            self.assertEqual(
+                archive.partitions(["CP1"], datetime(2025, 2, 10), datetime(2025, 3, 1)),
+                [archive.path("CP1", datetime(2025, 2, 1))])
+            window = list(archive.sessions("CP1", datetime(2025, 2, 1),
+                                           datetime(2025, 2, 8), connector_id=1))
+            self.assertEqual([s.id for s in window], [1])
+            scanned = list(archive.scan(None, datetime(2025, 3, 1), None,
+                                        ("id", "total_consumption_kwh")))
+            self.assertEqual([(cp, sorted(columns)) for cp, columns in scanned],
+                             [("CP1", ["id", "total_consumption_kwh"]),
+                              ("CP/2", ["id", "total_consumption_kwh"])])
+            self.assertEqual(scanned[0][1], {"id": [5, 11], "total_consumption_kwh": [1.25, 2.75]})
+            with Partition(archive.path("CP1", datetime(2025, 1, 1))) as part:
+                self.assertEqual(part.rows, 2)
+                self.assertEqual(part.values("organisationId"), ["org", None])
+
+    async def testArchiveMonthsAndExport(self):
+        """Completed months are archived once and exported without the API"""
+        sessions = [
+            make_session(i, "AA01", start_time=datetime(2025, 1, 1) + timedelta(days=5 * i))
+            for i in range(14)
+        ]
+        client = FakeSessionClient(sessions)
+        with tempfile.TemporaryDirectory() as directory:
+            archive = SessionArchive(directory)
+            counts = await archive_months(client, archive, datetime(2024, 12, 1),
+                                          datetime(2025, 3, 1), ["CP1"],
+                                          now=datetime(2025, 3, 15))
+            # March is not completed yet, December is archived empty
+            self.assertEqual(counts, {"CP1": 3})
+            self.assertTrue(archive.covers("CP1", datetime(2025, 1, 5), datetime(2025, 2, 20)))
+            # sessions of November may overlap the start of December
+            self.assertFalse(archive.covers("CP1", datetime(2024, 12, 5), datetime(2025, 1, 5)))
+            self.assertFalse(archive.covers("CP1", datetime(2025, 2, 20), datetime(2025, 3, 2)))
+            client.calls.clear()
+            self.assertEqual(await archive_months(client, archive, datetime(2024, 12, 1),
+                                                  datetime(2025, 3, 1), ["CP1"],
+                                                  now=datetime(2025, 3, 15)), {"CP1": 0})
+            self.assertEqual(client.calls, [])
+
+            pipeline = ExportPipeline(client,
+                                      charge_point_id="CP1",
+                                      connector_id=1,
+                                      kwh_price=25.0,
+                                      start_time=datetime(2025, 1, 1),
+                                      end_time=datetime(2025, 3, 10),
+                                      archive=archive)
+            ids = [priced.session.id async for priced in pipeline]
+            self.assertEqual(ids, list(range(14)))
+            # only the windows reaching into March ask the API
+            self.assertEqual([call[2] for call in client.calls],
+                             [datetime(2025, 2, 26), datetime(2025, 3, 5)])
+
+    async def testOverlappingWindow(self):
+        """Archived windows hold the sessions the API returns, also those started before"""
+        sessions = [
+            make_session(1, "AA01", start_time=datetime(2025, 1, 10)),
+            make_session(2, "AA01", start_time=datetime(2025, 1, 31, 23)),
+            make_session(3, "AA01", start_time=datetime(2025, 2, 3)),
+            make_session(4, "AA01", start_time=datetime(2025, 2, 3), connector_id=2),
+        ]
+        client = FakeSessionClient(sessions)
+        with tempfile.TemporaryDirectory() as directory:
+            archive = SessionArchive(directory)
+            archive.append(sessions)
+            start, end = datetime(2025, 2, 1), datetime(2025, 2, 8)
+            # sessions only reads the sessions starting in the range
+            self.assertEqual([s.id for s in archive.sessions("CP1", start, end)], [3, 4])
+            self.assertEqual([s.id for s in archive.overlapping("CP1", start, end, 1)], [2, 3])
+            self.assertEqual(archive.overlapping("CP1", datetime(2025, 2, 4), datetime(2025, 2, 8)),
+                             [])
+
+            async def export(archive):
+                pipeline = ExportPipeline(client, charge_point_id="CP1", connector_id=1,
+                                          kwh_price=25.0, start_time=start, end_time=end,
+                                          archive=archive)
+                return [priced.session.id async for priced in pipeline]
+
+            client.calls.clear()
+            self.assertEqual(await export(archive), await export(None))
+            self.assertEqual(len(client.calls), 1)
+
+
+class TestRfidIndex(unittest.IsolatedAsyncioTestCase):
+
+    def testResolve(self):
+        """Hex, decimal and reversed decimal resolve to the hex tag"""
+        session = make_session(1, "04A1B2C3")
+        index = RfidIndex()
+        index.update([session, make_session(2, "00000000000000")])
+        self.assertEqual(len(index), 1)
+        for printed in ("04A1B2C3", "04:a1:b2:c3", session.rfidDec,
+                        "00" + session.rfidDec, session.rfidDecReverse):
+            with self.subTest(printed=printed):
+                self.assertEqual(index.resolve(printed), "04A1B2C3")
+                self.assertTrue(matches(session, printed))
+        self.assertIsNone(index.resolve("12345"))
+        self.assertFalse(matches(session, "12345"))
+
+    def testComputedRepresentations(self):
+        """Tags without decimal values (e.g. from the login) are computed"""
+        index = RfidIndex()
+        index.add("0000000A")
+        # the hex tag 10 wins over the decimal 10 of another tag
+        index.add("10")
+        self.assertEqual(index.describe("167772160"), {
+            "rfid": "0000000A",
+            "rfidDec": "10",
+            "rfidDecReverse": "167772160"
+        })
+        self.assertEqual(index.resolve("10"), "10")
+
+    def testCanonical(self):
+        """Canonical tags do not depend on the tags known yet"""
+        session = make_session(1, "04A1B2C3")
+        index = RfidIndex()
+        self.assertEqual(index.canonical("04:a1:b2:c3"), "04A1B2C3")
+        self.assertIsNone(index.canonical(session.rfidDec))
+        self.assertIsNone(index.canonical("not a tag"))
+        index.add_record(session)
+        self.assertEqual(index.canonical("04a1b2c3"), "04A1B2C3")
+        self.assertEqual(index.canonical(session.rfidDecReverse), "04A1B2C3")
+
+    async def testExportByDecimal(self):
+        """Exports accept the decimal tag"""
+        session = make_session(1, "04A1B2C3")
+        client = FakeSessionClient([session, make_session(2, "BB02")])
+        pipeline = ExportPipeline(client,
+                                  charge_point_id="CP1",
+                                  connector_id=1,
+                                  kwh_price=25.0,
+                                  rfid=session.rfidDecReverse)
+        self.assertEqual([priced.session.id async for priced in pipeline],
+                         [1])
+
+
+class TestTelemetry(unittest.TestCase):
+
+    START = 1735689600  # 2025-01-01 00:00 UTC
+
+    def at(self, seconds: float) -> datetime:
+        return datetime.fromtimestamp(self.START + seconds)
+
+    def testRollupsAndQueries(self):
+        """Energy and peaks come from raw samples or rollups"""
+        store = TelemetryStore(raw_capacity=720)
+        # three hours of 10 A on three phases, polled every 10 seconds
+        for step in range(3 * 360 + 1):
+            for phase in ("L1", "L2", "L3"):
+                current = 16.0 if (step, phase) == (500, "L2") else 10.0
+                store.append("CP1", 1, phase, current, 230.0,
+                             self.START + step * 10)
+        # the last hour is still in the raw samples
+        self.assertAlmostEqual(
+            store.energy_wh("CP1", 1, self.at(7200), self.at(10800)),
+            3 * 2300.0,
+            delta=1)
+        # the first hours only in the minute rollups
+        self.assertAlmostEqual(
+            store.energy_wh("CP1", 1, self.at(0), self.at(10800)),
+            3 * 3 * 2300.0 + 6 * 230 * 10 / 3600,
+            delta=1)
+        self.assertEqual(
+            store.peak_current("CP1", 1, self.at(0), self.at(10800)), 16.0)
+        self.assertEqual(
+            store.peak_current("CP1", 1, self.at(7200), self.at(10800),
+                               "L1"), 10.0)
+        hours = store.curve("CP1", 1, "L2", self.at(0), self.at(10800),
+                            "hour")
+        self.assertEqual([row[0] - self.START for row in hours],
+                         [0, 3600, 7200, 10800])
+        self.assertAlmostEqual(hours[1][1], 10.0 + 6 / 360, places=3)
+        self.assertEqual(len(store.curve("CP1", 1, "L1", self.at(0),
+                                         self.at(10800), "raw")), 720)
+
+    def testRecordStatus(self):
+        """Status polls are recorded per connector and phase"""
+        store = TelemetryStore()
+        status = ChargePointStatus(
+            id="CP1",
+            status="Online",
+            connector_statuses=[
+                ChargePointConnectorStatus(
+                    charge_point_id="CP1",
+                    connector_id=1,
+                    total_consumption_kwh=1.0,
+                    status="Charging",
+                    measurements=[
+                        ChargePointMeasurement("L1", 8.0, 231.0),
+                        ChargePointMeasurement("L2", 8.0, 229.0)
+                    ]),
+                ChargePointConnectorStatus(charge_point_id="CP1",
+                                           connector_id=2,
+                                           total_consumption_kwh=0.0,
+                                           status="Available",
+                                           measurements=None)
+            ])
+        self.assertEqual(store.record_status(status, self.START), 2)
+        # a repeated poll within the same second is ignored
+        self.assertEqual(store.record_status(status, self.START), 0)
+        self.assertEqual(store.phases("CP1", 1), ["L1", "L2"])
+        self.assertEqual(store.phases("CP1", 2), [])
+        # buffers are allocated per phase, ~64 kB hold a day of minutes
+        for phase in ("L1", "L2", "L3"):
+            store.append("CP2", 1, phase, 1.0, 230.0, self.START)
+        self.assertLess(store.nbytes, 5 * 64 * 1024)
+
+
+def make_schedule(schedule_id, start, end, connectors="1", weekdays=(0, 1, 2, 3, 4, 5, 6),
+                  time_zone="Europe/Stockholm", active=True, charge_point_id="CP1"):
+    """ChargePointSchedule from "HH:MM" times and weekday numbers"""
+    days = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+    return ChargePointSchedule(
+        id=schedule_id, chargePointId=charge_point_id, name=f"schedule {schedule_id}",
+        active=active, startHours=int(start[:2]), startMinutes=int(start[3:]),
+        endHours=int(end[:2]), endMinutes=int(end[3:]), timeZone=time_zone,
+        connectorIdList=connectors, **{day: i in weekdays for i, day in enumerate(days)})
+
+
+class TestScheduleIndex(unittest.TestCase):
+
+    def utc(self, *args) -> datetime:
+        return datetime(*args, tzinfo=timezone.utc)
+
+    def testPointAndRangeQueries(self):
+        """Windows are local time, overnight windows end on the next day"""
+        index = ScheduleIndex()
+        index.refresh("CP1", [
+            make_schedule(1, "22:00", "06:00", "1, 2"),
+            make_schedule(2, "05:00", "07:00", "1", weekdays=(0, ))
+        ])
+        # Monday 2025-01-06, Stockholm is UTC+1 in winter
+        self.assertTrue(index.is_allowed("CP1", 1, self.utc(2025, 1, 6, 4, 59)))
+        self.assertTrue(index.is_allowed("CP1", 1, self.utc(2025, 1, 6, 5, 30)))
+        self.assertFalse(index.is_allowed("CP1", 2, self.utc(2025, 1, 6, 5, 30)))
+        self.assertFalse(index.is_allowed("CP1", 3, self.utc(2025, 1, 6, 2, 0)))
+        # the two windows of connector 1 are merged
+        self.assertEqual(index.next_transition("CP1", 1, self.utc(2025, 1, 6, 0, 0)),
+                         self.utc(2025, 1, 6, 6, 0))
+        self.assertEqual(index.windows("CP1", 2, self.utc(2025, 1, 6, 12, 0),
+                                       self.utc(2025, 1, 7, 12, 0)),
+                         [(self.utc(2025, 1, 6, 21, 0), self.utc(2025, 1, 7, 5, 0))])
+        self.assertEqual(index.windows("CP1", 2, self.utc(2025, 1, 7, 0, 0),
+                                       self.utc(2025, 1, 7, 1, 0)),
+                         [(self.utc(2025, 1, 7, 0, 0), self.utc(2025, 1, 7, 1, 0))])
+        self.assertFalse(index.overlaps("CP1", 2, self.utc(2025, 1, 7, 5, 0),
+                                        self.utc(2025, 1, 7, 21, 0)))
+        self.assertTrue(index.overlaps("CP1", 2, self.utc(2025, 1, 7, 5, 0),
+                                       self.utc(2025, 1, 7, 21, 1)))
+
+    def testDaylightSavingAndRefresh(self):
+        """Queries far from the first one are compiled with their own UTC offset"""
+        index = ScheduleIndex(horizon=timedelta(days=7))
+        schedules = [make_schedule(1, "22:00", "06:00", "1")]
+        self.assertTrue(index.refresh("CP1", schedules))
+        self.assertEqual(index.next_transition("CP1", 1, self.utc(2025, 1, 6, 12, 0)),
+                         self.utc(2025, 1, 6, 21, 0))
+        # summer time, UTC+2
+        self.assertEqual(index.next_transition("CP1", 1, self.utc(2025, 7, 7, 12, 0)),
+                         self.utc(2025, 7, 7, 20, 0))
+        self.assertFalse(index.refresh("CP1", list(schedules)))
+        self.assertTrue(index.refresh("CP1", [make_schedule(1, "22:00", "06:00", "1",
+                                                            active=False)]))
+        self.assertIsNone(index.next_transition("CP1", 1, self.utc(2025, 7, 7, 12, 0)))
+
+    def testRangeLongerThanHorizon(self):
+        """A range query compiles the whole range, not only around its start"""
+        index = ScheduleIndex(horizon=timedelta(days=1))
+        index.refresh("CP1", [make_schedule(1, "22:00", "06:00", "1")])
+        windows = index.windows("CP1", 1, self.utc(2025, 1, 6, 12, 0),
+                                self.utc(2025, 1, 13, 12, 0))
+        self.assertEqual(len(windows), 7)
+        self.assertEqual(windows[-1],
+                         (self.utc(2025, 1, 12, 21, 0), self.utc(2025, 1, 13, 5, 0)))
+
+
+class FakeSiteClient:
+    """Charge points with one connector each, drawing what they are allowed"""
+
+    def __init__(self, wanted: dict[str, float]):
+        self.wanted = wanted
+        self.settings = {cp: ChargePointConnectorSettings(cp, 1, "On", False, False, 32.0)
+                         for cp in wanted}
+        self.writes = []
+        self.reads = 0
+
+    async def get_chargepoint_status(self, charge_point_id):
+        current = min(self.wanted[charge_point_id], self.settings[charge_point_id].max_current)
+        return ChargePointStatus(charge_point_id, "Online", [ChargePointConnectorStatus(
+            charge_point_id, 1, 0.0, "Charging" if current else "Available",
+            [ChargePointMeasurement("L1", current, 230.0)])])
+
+    async def get_chargepoint_connector_settings(self, charge_point_id, connector_id):
+        self.reads += 1
+        return self.settings[charge_point_id]
+
+    async def set_chargepoint_connector_settings(self, settings):
+        self.writes.append((settings.charge_point_id, settings.max_current))
+        self.settings[settings.charge_point_id] = settings
+
+
+class TestLoadBalancer(unittest.IsolatedAsyncioTestCase):
+
+    def testAllocate(self):
+        """Equal share up to the caps, low priority paused first"""
+        demands = [Demand("A", 1, True, 32.0), Demand("B", 1, True, 32.0, draw=8.0),
+                   Demand("C", 1, True, 32.0, priority=-1), Demand("D", 1, False, 32.0)]
+        self.assertEqual(allocate(demands, 40.0),
+                         {("A", 1): 12.0, ("B", 1): 10.0, ("C", 1): 12.0, ("D", 1): 6.0})
+        self.assertEqual(allocate(demands, 13.0),
+                         {("A", 1): 6.0, ("B", 1): 7.0, ("C", 1): 0.0, ("D", 1): 0.0})
+        weighted = [Demand("A", 1, True, 32.0, weight=2.0), Demand("B", 1, True, 32.0)]
+        self.assertEqual(allocate(weighted, 30.0), {("A", 1): 18.0, ("B", 1): 12.0})
+
+    async def testStep(self):
+        """Decreases first, no writes once the site is balanced"""
+        client = FakeSiteClient({"A": 32.0, "B": 32.0, "C": 0.0})
+        balancer = LoadBalancer(client, ["A", "B", "C"], site_limit=40.0)
+        self.assertEqual(await balancer.step(),
+                         {("A", 1): 17.0, ("B", 1): 17.0, ("C", 1): 6.0})
+        self.assertEqual(await balancer.step(), {})
+        # a third car starts, the others make room before it is raised
+        client.wanted["C"] = 32.0
+        client.writes.clear()
+        written = await balancer.step()
+        self.assertEqual(written, {("A", 1): 14.0, ("B", 1): 13.0, ("C", 1): 13.0})
+        self.assertEqual(client.writes[-1], ("C", 13.0))
+        self.assertLessEqual(sum(s.max_current for s in client.settings.values()), 40.0)
+        self.assertEqual(await balancer.step(), {})
+
+    async def testSettingsRefresh(self):
+        """Settings are read again after their TTL, switched off connectors are left out"""
+        client = FakeSiteClient({"A": 32.0, "B": 32.0})
+        balancer = LoadBalancer(client, ["A", "B"], site_limit=40.0)
+        await balancer.step()
+        await balancer.step()
+        self.assertEqual(client.reads, 2)
+        # switched off in the charge amps app, unseen until the settings expire
+        client.settings["B"] = replace(client.settings["B"], mode="Off")
+        self.assertEqual(await balancer.step(), {})
+        balancer._settings_ttl = 0
+        client.writes.clear()
+        self.assertEqual(await balancer.step(), {("A", 1): 32.0})
+        self.assertEqual(client.writes, [("A", 32.0)])
+        self.assertEqual(client.reads, 4)
+
+
+class TestCallbacks(unittest.IsolatedAsyncioTestCase):
+
+    async def testEventsAndSubscribers(self):
+        """Callbacks update the live state and reach matching subscribers"""
+        import random
+        events = parse_events(build_body(0, 3, 50, random.Random(7)))
+        self.assertEqual(len(events), 50)
+        with self.assertRaises(ValueError):
+            parse_events([{"chargePointId": "CP1", "status": "Charging"}])
+        bus = EventBus()
+        state = LiveState()
+        with bus.subscribe(SESSION_EVENT, queue_size=2) as sessions:
+            for event in events:
+                state.apply(event)
+                bus.publish(event)
+            pushed = [e for e in events if e.kind == SESSION_EVENT]
+            # the slow subscriber lost the oldest events
+            self.assertEqual(bus.dropped, len(pushed) - 2)
+            self.assertEqual(await anext(sessions), pushed[-2])
+            self.assertEqual(await anext(sessions), pushed[-1])
+        self.assertEqual(len(bus), 0)
+        last = [e for e in events if e.kind == STATUS_EVENT][-1]
+        self.assertIs(state.status(*last.key), last.data)
+        self.assertTrue(state.is_fresh(last.charge_point_id))
+        self.assertFalse(state.is_fresh(last.charge_point_id, now=time.time() + 3600))
+
+    async def testStorm(self):
+        """The sender reports throughput and refused requests"""
+        received = []
+
+        async def receiver(request):
+            if request.headers.get("X-Callback-Token") != "secret":
+                return web.json_response({}, status=403)
+            received.extend(parse_events(await request.json()))
+            return web.json_response({})
+
+        server = web.Application()
+        server.router.add_post("/callbacks", receiver)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/callbacks"
+        try:
+            result = await storm(url, "secret", 200, 10, 20, 5)
+            self.assertEqual((result["failed"], len(received)), (0, 1000))
+            self.assertGreater(result["rps"], 0)
+            result = await storm(url, None, 10, 2, 20, 1)
+            self.assertEqual(result["failed"], 10)
+        finally:
+            await runner.cleanup()
+
+
+class RespStandIn:
+    """Minimal Redis protocol server supporting GET, SET (PX, NX) and DEL"""
+
+    def __init__(self):
+        self.data = {}
+        self.server = None
+        self.delay = 0
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        while line := await reader.readline():
+            args = []
+            for _ in range(int(line[1:])):
+                length = int((await reader.readline())[1:])
+                args.append((await reader.readexactly(length + 2))[:-2])
+            command = args[0].upper()
+            if command == b"GET":
+                await asyncio.sleep(self.delay)
+                value = self.data.get(args[1])
+                writer.write(b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" %
+                             (len(value), value))
+            elif command == b"SET":
+                if b"NX" in args[3:] and args[1] in self.data:
+                    writer.write(b"$-1\r\n")
+                else:
+                    self.data[args[1]] = args[2]
+                    writer.write(b"+OK\r\n")
+            elif command == b"DEL":
+                writer.write(b":%d\r\n" % int(self.data.pop(args[1], None) is not None))
+            await writer.drain()
+        writer.close()
+
+
+class TestCacheStore(unittest.IsolatedAsyncioTestCase):
+
+    async def check_backend(self, cache):
+        self.assertIsNone(await cache.get("missing"))
+        await cache.set("token", b"abc", ttl=60)
+        self.assertEqual(await cache.get("token"), b"abc")
+        self.assertTrue(await cache.add("lock", b"1", ttl=60))
+        self.assertFalse(await cache.add("lock", b"2", ttl=60))
+        await cache.delete("lock")
+        self.assertTrue(await cache.add("lock", b"3", ttl=60))
+        await cache.close()
+
+    async def test_memory_cache(self):
+        """Memory backend stores values and expires them"""
+        cache = MemoryCache()
+        await cache.set("short", b"x", ttl=0.01)
+        await asyncio.sleep(0.02)
+        self.assertIsNone(await cache.get("short"))
+        await self.check_backend(cache)
+
+    async def test_sqlite_cache_shared(self):
+        """Two SQLite caches on the same file see each other's values"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "cache.sqlite")
+            first, second = SqliteCache(path), SqliteCache(path)
+            await first.set("token", b"shared")
+            self.assertEqual(await second.get("token"), b"shared")
+            self.assertTrue(await first.add("login", b"1", ttl=60))
+            self.assertFalse(await second.add("login", b"2", ttl=60))
+            await second.close()
+            await self.check_backend(first)
+
+    async def test_memory_cache_bounds(self):
+        """Memory backend drops the least recently used and the expired values"""
+        cache = MemoryCache(max_entries=2, max_bytes=100)
+        await cache.set("a", b"1")
+        await cache.set("b", b"2")
+        self.assertEqual(await cache.get("a"), b"1")
+        await cache.set("c", b"3")
+        self.assertIsNone(await cache.get("b"))
+        self.assertEqual(await cache.get("a"), b"1")
+        await cache.set("big", b"x" * 98)
+        self.assertIsNone(await cache.get("a"))
+        self.assertIsNone(await cache.get("c"))
+        await cache.set("short", b"x", ttl=0.01)
+        await asyncio.sleep(0.02)
+        cache._next_sweep = 0
+        await cache.set("d", b"4")
+        self.assertNotIn("short", cache._entries)
+        self.assertEqual(cache._bytes, sum(
+            len(key) + len(value) for key, (value, _) in cache._entries.items()))
+
+    async def test_sqlite_cache_sweep(self):
+        """SQLite backend removes expired values while storing"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = SqliteCache(os.path.join(tmp_dir, "cache.sqlite"))
+            await cache.set("short", b"x", ttl=0.01)
+            await asyncio.sleep(0.02)
+            cache._next_sweep = 0
+            await cache.set("token", b"abc", ttl=60)
+            self.assertEqual(
+                cache._execute("SELECT COUNT(*) FROM cache")[0], 1)
+            await cache.close()
+
+    async def test_redis_cache(self):
+        """Redis protocol adapter works against a local stand-in"""
+        stand_in = RespStandIn()
+        port = await stand_in.start()
+        try:
+            await self.check_backend(RedisCache.from_url(f"redis://127.0.0.1:{port}"))
+        finally:
+            await stand_in.stop()
+
+    async def test_redis_cache_cancelled(self):
+        """A command cancelled before its reply does not leave the reply to the next one"""
+        stand_in = RespStandIn()
+        port = await stand_in.start()
+        cache = RedisCache.from_url(f"redis://127.0.0.1:{port}")
+        try:
+            await cache.set("first", b"1")
+            await cache.set("second", b"2")
+            stand_in.delay = 0.1
+            with self.assertRaises(TimeoutError):
+                await asyncio.wait_for(cache.get("first"), 0.02)
+            stand_in.delay = 0
+            self.assertEqual(await cache.get("second"), b"2")
+            await cache.close()
+        finally:
+            await stand_in.stop()
+
+
+class MockChargeAmpsApi:
+    """Local stand-in for the charge amps API counting requests"""
+
+    def __init__(self, sessions: list[ChargingSession] | None = None):
+        self.sessions = sessions or []
+        self.counts = {}
+        # seconds to wait before answering, by last path segment
+        self.delays = {}
+        self.app = web.Application(middlewares=[self._count])
+        self.app.router.add_post("/api/v5/auth/login", self._login)
+        self.app.router.add_post("/api/v5/auth/refreshToken", self._login)
+        self.app.router.add_get("/api/v5/chargepoints/owned", self._owned)
+        self.app.router.add_get(
+            "/api/v5/chargepoints/{cp}/connectors/{conn}/chargingsessions",
+            self._sessions)
+        self.schedules = {}
+        self.writes = []
+        self.app.router.add_get("/api/v5/chargepoints/{cp}/schedules", self._get_schedules)
+        self.app.router.add_post("/api/v5/chargepoints/{cp}/schedules", self._write_schedule)
+        self.app.router.add_put("/api/v5/chargepoints/{cp}/schedules", self._write_schedule)
+        self.app.router.add_delete("/api/v5/chargepoints/{cp}/schedules/{id}",
+                                   self._delete_schedule)
+        self.runner = None
+        self.url = None
+
+    async def start(self) -> str:
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+    @web.middleware
+    async def _count(self, request, handler):
+        name = request.path.rsplit("/", 1)[-1]
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if name in self.delays:
+            await asyncio.sleep(self.delays[name])
+        return await handler(request)
+
+    async def _login(self, request):
+        token = jwt.encode({"exp": int(time.time()) + 3600}, "k" * 32)
+        return web.json_response({
+            "token": token,
+            "refreshToken": "refresh",
+            "user": {
+                "id": "user",
+                "firstName": "First",
+                "lastName": "Last",
+                "email": "test@example.com",
+                "mobile": "",
+                "rfidTags": [],
+                "userStatus": "Valid"
+            }
+        })
+
+    async def _owned(self, request):
+        return web.json_response([{
+            "id": "CP1",
+            "name": "Garage",
+            "password": "",
+            "type": "HALO",
+            "isLoadbalanced": False,
+            "firmwareVersion": "1",
+            "hardwareVersion": "1",
+            "connectors": [{
+                "chargePointId": "CP1",
+                "connectorId": 1,
+                "type": "Type2"
+            }]
+        }])
+
+    async def _sessions(self, request):
+        return web.json_response([
+            s.to_dict() for s in self.sessions
+            if s.charge_point_id == request.match_info["cp"]
+            and s.connector_id == int(request.match_info["conn"])
+        ])
+
+    async def _get_schedules(self, request):
+        return web.json_response(self.schedules.get(request.match_info["cp"], []))
+
+    async def _write_schedule(self, request):
+        schedule = await request.json()
+        schedules = self.schedules.setdefault(request.match_info["cp"], [])
+        self.writes.append((request.method, request.match_info["cp"], schedule["id"]))
+        if request.method == "POST":
+            schedule["id"] = max([s["id"] for s in schedules] + [0]) + 1
+        else:
+            schedules[:] = [s for s in schedules if s["id"] != schedule["id"]]
+        schedules.append(schedule)
+        return web.json_response(schedule)
+
+    async def _delete_schedule(self, request):
+        schedule_id = int(request.match_info["id"])
+        self.writes.append(("DELETE", request.match_info["cp"], schedule_id))
+        schedules = self.schedules.get(request.match_info["cp"], [])
+        schedules[:] = [s for s in schedules if s["id"] != schedule_id]
+        return web.json_response({})
+
+
+class TestScheduleSync(unittest.IsolatedAsyncioTestCase):
+
+    def testDiff(self):
+        """Schedules without ID are matched by name"""
+        current = [make_schedule(7, "22:00", "06:00"), make_schedule(8, "08:00", "10:00"),
+                   make_schedule(9, "12:00", "13:00")]
+        wanted = [replace(current[0], id=0), replace(current[1], id=0, endHours=11),
+                  make_schedule(0, "18:00", "19:00")]
+        wanted[2] = replace(wanted[2], name="evening")
+        diff, unchanged = diff_schedules("CP1", current, wanted)
+        self.assertEqual(unchanged, 1)
+        self.assertEqual([(s.id, s.endHours) for s in diff.update], [(8, 11)])
+        self.assertEqual([(s.id, s.name) for s in diff.create], [(0, "evening")])
+        self.assertEqual([s.id for s in diff.delete], [9])
+        self.assertEqual(len(diff_schedules("CP1", current, wanted, prune=False)[0]), 2)
+        with self.assertRaises(ValueError):
+            diff_schedules("CP1", current, [wanted[2], wanted[2]])
+
+    async def testSyncFleet(self):
+        """One read per charge point, only differences are written"""
+        api = MockChargeAmpsApi()
+        url = await api.start()
+        api.schedules["CP1"] = [make_schedule(1, "22:00", "06:00").to_dict(),
+                                make_schedule(2, "12:00", "13:00").to_dict()]
+        wanted = [replace(make_schedule(0, "22:00", "06:00"), name="schedule 1")]
+        client = Client("test@example.com", "secret", "apikey", url)
+        try:
+            await client.init_session()
+            index = await client.get_schedule_index(["CP1", "CP2"])
+            self.assertIn(("CP1", 1), index)
+            self.assertNotIn(("CP2", 1), index)
+            results = await sync_schedules(client, {"CP1": wanted, "CP2": wanted},
+                                           parallel=2)
+            self.assertEqual(sorted(api.writes), [("DELETE", "CP1", 2), ("POST", "CP2", 0)])
+            self.assertEqual((results["CP1"].unchanged, results["CP1"].deleted), (1, 1))
+            self.assertEqual(results["CP2"].created, 1)
+            self.assertTrue(all(result.ok for result in results.values()))
+            # a second run finds nothing to do
+            api.writes.clear()
+            results = await sync_schedules(client, {"CP1": wanted, "CP2": wanted})
+            self.assertEqual(api.writes, [])
+            self.assertEqual([r.unchanged for r in results.values()], [1, 1])
+            index = await client.get_schedule_index(["CP1", "CP2"])
+            self.assertIn(("CP2", 1), index)
+        finally:
+            await client.close_session()
+            await api.stop()
+
+
+class TestCircuitBreaker(unittest.IsolatedAsyncioTestCase):
+
+    def testStates(self):
+        """Opens after failures in a row, one probe closes it again"""
+        now = [0.0]
+        breaker = CircuitBreaker("GET /owned", failure_threshold=2, slow_call=1.0,
+                                 reset_timeout=10.0, clock=lambda: now[0])
+        breaker.before()
+        breaker.failure()
+        breaker.before()
+        breaker.success(2.0)  # too slow
+        with self.assertRaises(CircuitOpenError):
+            breaker.before()
+        now[0] = 10.0
+        breaker.before()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before()  # the probe is running
+        breaker.failure()
+        self.assertEqual(breaker.state, "open")
+        now[0] = 20.0
+        breaker.before()
+        breaker.success(0.1)
+        self.assertEqual(breaker.state, "closed")
+        self.assertEqual(endpoint_of("GET", "/api/v5/chargepoints/2012345678M/connectors/1/settings"),
+                         "GET /api/v5/chargepoints/*/connectors/*/settings")
+
+    async def testStaleWhileUpstreamDown(self):
+        """Charge points and completed sessions are served stale, then fail fast"""
+        api = MockChargeAmpsApi([make_session(1, "AABBCCDD")])
+        url = await api.start()
+        client = Client("test@example.com", "secret", "apikey", url)
+        session = client._session
+        session._breakers = BreakerRegistry(failure_threshold=2, reset_timeout=60)
+        start, end = datetime(2025, 1, 1), datetime(2025, 1, 2)
+        try:
+            await client.init_session()
+            await client.get_chargepoints()
+            self.assertEqual(len(await client.get_connector_chargingsessions("CP1", 1, start, end)), 1)
+            await api.stop()
+            await session._cache.delete(
+                session._cache_key("GET", "/api/v5/chargepoints/owned", "null"))
+            await session._cache.delete(session._cache_key(
+                "GET", "/api/v5/chargepoints/CP1/connectors/1/chargingsessions",
+                json.dumps({"startTime": start.isoformat(), "endTime": end.isoformat()},
+                           sort_keys=True)))
+            track_stale()
+            self.assertEqual([cp.id for cp in await client.get_chargepoints()], ["CP1"])
+            sessions = await client.get_connector_chargingsessions("CP1", 1, start, end)
+            self.assertEqual([s.id for s in sessions], [1])
+            self.assertEqual(stale_results(), ["chargepoints", "chargingsessions"])
+            # the breaker of the owned endpoint is open now
+            await client.get_chargepoints()
+            self.assertEqual(session._breakers.get("GET", "/api/v5/chargepoints/owned").state,
+                             "open")
+            # statuses have no stale copy, other charge points share the breaker
+            for charge_point_id in ("CP1", "CP2"):
+                with self.assertRaises(OSError):
+                    await client.get_chargepoint_status(charge_point_id)
+            with self.assertRaises(CircuitOpenError):
+                await client.get_chargepoint_status("CP3")
+        finally:
+            await client.close_session()
+
+
+class TestDeadlines(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.api = MockChargeAmpsApi([make_session(1, "AABBCCDD")])
+        url = await self.api.start()
+        self.limiter = asyncio.Semaphore(1)
+        self.client = Client("test@example.com", "secret", "apikey", url,
+                             limiter=self.limiter)
+        await self.client.init_session()
+
+    async def asyncTearDown(self):
+        await self.client.close_session()
+        await self.api.stop()
+
+    async def testTimeoutBudget(self):
+        """A slow upstream fails at the deadline without tripping the breaker"""
+        self.api.delays.update(chargingsessions=5, owned=5)
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            await self.client.get_connector_chargingsessions("CP1", 1, timeout=0.2)
+        self.assertLess(time.monotonic() - started, 2)
+        with deadline(0.2):
+            # a nested budget never extends the outer deadline
+            with self.assertRaises(DeadlineExceeded):
+                await self.client.get_chargepoints(timeout=30)
+            self.assertLess(remaining(), 0.2)
+        self.assertIsNone(remaining())
+        breaker = self.client._session._breakers.get(
+            "GET", "/api/v5/chargepoints/CP1/connectors/1/chargingsessions")
+        self.assertEqual(breaker.state, "closed")
+        self.api.delays.clear()
+        sessions = await self.client.get_connector_chargingsessions("CP1", 1, timeout=5)
+        self.assertEqual([s.id for s in sessions], [1])
+
+    async def testCancelExport(self):
+        """Cancelling a running export frees its upstream slot at once"""
+        self.api.delays["chargingsessions"] = 5
+        pipeline = ExportPipeline(self.client, "CP1", 1, kwh_price=30,
+                                  start_time=datetime(2025, 1, 1),
+                                  end_time=datetime(2025, 3, 1))
+
+        async def export():
+            return [item async for item in pipeline]
+
+        task = asyncio.create_task(export())
+        while self.api.counts.get("chargingsessions", 0) == 0:
+            await asyncio.sleep(0.01)
+        self.assertTrue(self.limiter.locked())
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertFalse(self.limiter.locked())
+        self.api.delays.clear()
+        self.assertEqual(len(await self.client.get_chargepoints(timeout=5)), 1)
+
+
+class TestAdmission(unittest.IsolatedAsyncioTestCase):
+
+    async def testLanes(self):
+        """Interactive requests get the reserved slot and go first, a full queue rejects"""
+        controller = AdmissionController(max_in_flight=2, max_per_user=2, queue_size=2,
+                                         queue_timeout=0.2, interactive_reserve=1)
+        export = await controller.acquire("a", BULK)
+        waiting_export = asyncio.create_task(controller.acquire("b", BULK))
+        lookup = await controller.acquire("c", INTERACTIVE)
+        waiting_lookup = asyncio.create_task(controller.acquire("d", INTERACTIVE))
+        await asyncio.sleep(0)
+        self.assertEqual((controller.in_flight, controller.queued), (2, 2))
+        with self.assertRaises(AdmissionRejected) as rejected:
+            await controller.acquire("e", INTERACTIVE)
+        self.assertGreaterEqual(rejected.exception.retry_after, 1)
+        export.release()
+        export.release()  # released once only
+        await asyncio.sleep(0)
+        self.assertTrue(waiting_lookup.done())
+        self.assertFalse(waiting_export.done())
+        with self.assertRaises(AdmissionRejected):
+            await waiting_export
+        self.assertEqual(controller.rejected, {"full": 1, "timeout": 1})
+        lookup.release()
+        waiting_lookup.result().release()
+        self.assertEqual((controller.in_flight, controller.queued), (0, 0))
+
+    async def testStreamedResponse(self):
+        """A streamed export holds its slot until the body is sent"""
+        from quart import Quart, Response
+        controller = AdmissionController(max_in_flight=1)
+        web_app = Quart(__name__)
+        in_flight = []
+
+        @web_app.route("/export", methods=["POST"])
+        @admitted(controller, BULK, "X-Forwarded-For")
+        async def export():
+
+            async def chunks():
+                for i in range(3):
+                    in_flight.append(controller.in_flight)
+                    yield f"{i}\n".encode()
+
+            return Response(chunks(), mimetype="text/csv")
+
+        response = await web_app.test_client().post(
+            "/export", headers={"X-Forwarded-For": "10.0.0.1, 10.0.0.2"})
+        self.assertEqual(await response.get_data(), b"0\n1\n2\n")
+        self.assertEqual(in_flight, [1, 1, 1])
+        self.assertEqual(controller.in_flight, 0)
+
+
+class TestTransport(unittest.IsolatedAsyncioTestCase):
+
+    async def testTransports(self):
+        """Both transports poll the mock API, http2 over a single connection"""
+        api = MockApi(latency=0.05)
+        url, shutdown, server = await serve(api)
+        try:
+            results = {}
+            for transport in ("aiohttp", "http2"):
+                results[transport] = await benchmark(api, url, transport, requests=40,
+                                                     concurrency=20, charge_points=10)
+                client = Client("test@example.com", "secret", "apikey", url,
+                                transport=transport)
+                await client.init_session()
+                try:
+                    with self.assertRaises(client._session._transport.status_error) as error:
+                        await client.get_user("unknown")
+                finally:
+                    await client.close_session()
+                self.assertEqual(error.exception.status, 404)
+                self.assertFalse(is_upstream_failure(error.exception))
+            self.assertEqual([r["failed"] for r in results.values()], [0, 0])
+            self.assertGreater(results["aiohttp"]["connections"], 1)
+            self.assertEqual(results["http2"]["connections"], 1)
+        finally:
+            shutdown.set()
+            await server
+
+
+class TestTokenPersistence(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.api = MockChargeAmpsApi()
+        self.url = await self.api.start()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.token_file = os.path.join(self.tmp_dir.name, "token.enc")
+        self.key = Fernet.generate_key()
+
+    async def asyncTearDown(self):
+        await self.api.stop()
+        self.tmp_dir.cleanup()
+
+    async def start_client(self, email: str = "test@example.com") -> Client:
+        client = Client(email,
+                        "secret",
+                        "apikey",
+                        self.url,
+                        token_key=self.key,
+                        token_file=self.token_file)
+        await client.init_session()
+        await client.close_session()
+        return client
+
+    async def test_token_reused_after_restart(self):
+        """A restarted client reuses the encrypted token instead of logging in"""
+        await self.start_client()
+        client = await self.start_client()
+        self.assertEqual(self.api.counts["login"], 1)
+        self.assertEqual(client._user._userid, "user")
+        with open(self.token_file, "rb") as f:
+            self.assertNotIn(b"refresh", f.read())
+
+    async def test_token_of_other_credentials_ignored(self):
+        """The stored token is only used for the credentials it belongs to"""
+        await self.start_client()
+        await self.start_client("other@example.com")
+        self.assertEqual(self.api.counts["login"], 2)
+
+
+class TestTenants(unittest.IsolatedAsyncioTestCase):
+
+    async def testFairScheduling(self):
+        """Waiting tenants are served in turn and within their caps"""
+        scheduler = FairScheduler(total_slots=2)
+        scheduler.register("big", 2)
+        scheduler.register("small", 1)
+        order = []
+
+        async def request(tenant: str, seconds: float = 0.01):
+            async with scheduler.limiter(tenant):
+                order.append(tenant)
+                await asyncio.sleep(seconds)
+
+        big_export = [asyncio.create_task(request("big")) for _ in range(6)]
+        await asyncio.sleep(0)
+        interactive = [asyncio.create_task(request("small")) for _ in range(2)]
+        await asyncio.gather(*big_export, *interactive)
+        # big and small take turns, the small requests do not queue behind the
+        # whole export
+        self.assertEqual(order[:5], ["big", "big", "big", "small", "big"])
+        self.assertEqual(order.count("small"), 2)
+        self.assertEqual(scheduler.running("big"), 0)
+
+    async def testCancelledWaiter(self):
+        """A cancelled request does not keep its slot"""
+        scheduler = FairScheduler(total_slots=1)
+        scheduler.register("a", 1)
+        await scheduler.acquire("a")
+        waiting = asyncio.create_task(scheduler.acquire("a"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        scheduler.release("a")
+        await asyncio.wait_for(scheduler.acquire("a"), 1)
+        self.assertEqual(scheduler.running("a"), 1)
+
+    async def testTenantClients(self):
+        """Every tenant logs in with its own account over the shared pool"""
+        api = MockChargeAmpsApi()
+        url = await api.start()
+        key = Fernet.generate_key()
+        with tempfile.NamedTemporaryFile("w", suffix=".ini") as cfg:
+            config = configparser.ConfigParser()
+            config["GENERAL"] = {"baseUrl": url, "pricekWh": "25"}
+            for tenant in ("acme", "globex"):
+                config[f"TENANT:{tenant}"] = {
+                    "email": encrypt(f"{tenant}@example.com", key),
+                    "password": encrypt("secret", key),
+                    "apiKey": "key",
+                    "maxConcurrency": "2"
+                }
+            config["TENANT:globex"]["pricekWh"] = "31"
+            config.write(cfg)
+            cfg.flush()
+            tenants = ChargeAmpsCfgParser(cfg.name).get_tenant_data()
+        self.assertEqual(sorted(tenants), ["acme", "globex"])
+        self.assertEqual(tenants["acme"]["pricekWh"], "25")
+        self.assertEqual(tenants["globex"]["pricekWh"], "31")
+        manager = TenantManager(tenants, key, pool_size=4)
+        try:
+            acme, globex = await asyncio.gather(manager.get_client("acme"),
+                                                manager.get_client("globex"))
+            self.assertIs(await manager.get_client("acme"), acme)
+            self.assertEqual(acme._user._email, "acme@example.com")
+            self.assertEqual(globex._user._email, "globex@example.com")
+            self.assertIs(acme._session._transport._session.connector,
+                          globex._session._transport._session.connector)
+            await asyncio.gather(acme.get_chargepoints(),
+                                 globex.get_chargepoints())
+            self.assertEqual(api.counts["login"], 2)
+            self.assertEqual(api.counts["owned"], 2)
+        finally:
+            await manager.close()
+            await api.stop()
+
+    def testResolve(self):
+        """Requests without a tenant go to the only tenant, else to the default"""
+        single = TenantManager({"garage": {"maxConcurrency": 1}}, b"key")
+        self.assertEqual(single.resolve(None), "garage")
+        self.assertEqual(single.resolve(""), "garage")
+        self.assertEqual(single.resolve("other"), "other")
+        several = TenantManager({"default": {"maxConcurrency": 1},
+                                 "garage": {"maxConcurrency": 1}}, b"key")
+        self.assertEqual(several.resolve(None), "default")
+        self.assertEqual(several.resolve("garage"), "garage")
+
+    async def testDrain(self):
+        """Replaced clients are closed once the last lease is released"""
+        manager = TenantManager({"a": {"maxConcurrency": 1}}, b"key")
+        closed = []
+
+        async def close():
+            closed.append(manager._users)
+
+        manager.close = close
+        first, second = manager.lease(), manager.lease()
+        drain = asyncio.create_task(manager.drain())
+        first.release()
+        first.release()  # released once only
+        await asyncio.sleep(0)
+        self.assertEqual(closed, [])
+        second.release()
+        await asyncio.wait_for(drain, 1)
+        self.assertEqual(closed, [0])
+        manager.lease()
+        await manager.drain(timeout=0.01)
+        self.assertEqual(closed, [0, 1])
+
+
+class TestKeyManager(unittest.TestCase):
+
+    def testCreateAndReload(self):
+        """A key is created once, other lines are kept, changes are picked up"""
+        with tempfile.TemporaryDirectory() as directory:
+            env_path = os.path.join(directory, ".env")
+            with open(env_path, "w") as f:
+                f.write("ENV_PATH=/data/.env\nCALLBACK_TOKEN=abc")
+            manager = KeyManager(env_path)
+            with patch.dict(os.environ, {"EMAIL_ENCRYPTION_KEY": ""}):
+                key = manager.get_or_create_key()
+                mtime = os.stat(env_path).st_mtime_ns
+                self.assertEqual(manager.get_or_create_key(), key)
+                self.assertEqual(os.stat(env_path).st_mtime_ns, mtime)
+                with open(env_path) as f:
+                    self.assertEqual(f.read().splitlines(),
+                                     ["ENV_PATH=/data/.env", "CALLBACK_TOKEN=abc",
+                                      f"EMAIL_ENCRYPTION_KEY={key.decode()}"])
+                # rotated by another process
+                other = KeyManager(env_path)
+                token = other.encrypt("user@example.com")
+                new_key = other.rotate()
+                self.assertEqual(manager.keys, [new_key, key])
+                self.assertEqual(manager.decrypt_many([token, manager.encrypt("x")]),
+                                 ["user@example.com", "x"])
+                self.assertEqual(decrypt(manager.reencrypt(token), new_key),
+                                 "user@example.com")
+                manager.drop_old_keys()
+                self.assertEqual(other.keys, [new_key])
+                with self.assertRaises(Exception):
+                    other.decrypt(token)
+
+    def testRotateCfg(self):
+        """Credentials of cfg.ini move to the new key, tokens of the old key still decrypt"""
+        with tempfile.TemporaryDirectory() as directory:
+            env_path = os.path.join(directory, ".env")
+            cfg_path = os.path.join(directory, "cfg.ini")
+            with patch.dict(os.environ, {"ENV_PATH": env_path, "EMAIL_ENCRYPTION_KEY": ""}):
+                manager = KeyManager(env_path)
+                key = manager.get_or_create_key()
+                with open(cfg_path, "w") as f:
+                    f.write("[USERDATA]\n"
+                            f"email = {encrypt('a@example.com', key)}\n"
+                            f"password = {encrypt('secret', key)}\n"
+                            "apiKey = k\n\n"
+                            "# tenants\n"
+                            "[TENANT:acme]\n"
+                            f"email={encrypt('b@example.com', key)}\n"
+                            "password = None\n")
+                os.chmod(env_path, 0o640)
+                os.chmod(cfg_path, 0o644)
+                self.assertEqual(rotate_cfg_key(cfg_path, manager), 3)
+                # the rewritten files keep their modes
+                self.assertEqual(os.stat(env_path).st_mode & 0o777, 0o640)
+                self.assertEqual(os.stat(cfg_path).st_mode & 0o777, 0o644)
+                new_key = manager.keys[0]
+                self.assertNotEqual(new_key, key)
+                cfg = configparser.ConfigParser()
+                cfg.read(cfg_path)
+                self.assertEqual(decrypt_many([cfg["USERDATA"]["email"],
+                                               cfg["USERDATA"]["password"],
+                                               cfg["TENANT:acme"]["email"]], new_key),
+                                 ["a@example.com", "secret", "b@example.com"])
+                # a worker still holding the old key
+                self.assertEqual(decrypt(cfg["USERDATA"]["email"], key), "a@example.com")
+                with open(cfg_path) as f:
+                    self.assertIn("# tenants\n", f.read())
+
+
+# import time budgets in seconds and the dependencies a module must not pull in
+IMPORT_BUDGETS = {
+    "app": (1.0, ("xlsxwriter", "cryptography", "dataclasses_json",
+                  "marshmallow", "aiohttp", "jwt", "ciso8601")),
+    "chargeampsclient": (0.5, ("xlsxwriter", "cryptography", "aiohttp",
+                               "jwt", "ciso8601")),
+    "utils.cfg_file_generator": (0.3, ("cryptography", "dataclasses_json",
+                                       "marshmallow", "ciso8601")),
+}
+
+
+class TestImportTime(unittest.TestCase):
+
+    def import_in_fresh_interpreter(self, module: str) -> tuple[float, list]:
+        """Import a module in a new interpreter
+        :return: import time in seconds and the loaded heavy dependencies"""
+        heavy = IMPORT_BUDGETS[module][1]
+        script = ("import sys, time\n"
+                  "start = time.perf_counter()\n"
+                  f"import {module}\n"
+                  "print(time.perf_counter() - start)\n"
+                  f"print(','.join(m for m in {heavy!r} if m in sys.modules))")
+        with tempfile.TemporaryDirectory() as directory:
+            output = subprocess.run(
+                [sys.executable, "-c", script],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env={
+                    **os.environ, "ENV_PATH": os.path.join(directory, ".env")
+                },
+                capture_output=True,
+                text=True,
+                check=True).stdout.splitlines()
+        return float(output[0]), [m for m in output[1].split(",") if m]
+
+    def testImportBudgets(self):
+        """Heavy dependencies are loaded on first use, not on import"""
+        for module, (budget, _) in IMPORT_BUDGETS.items():
+            with self.subTest(module=module):
+                # best of three, the first run also warms the file system cache
+                runs = [self.import_in_fresh_interpreter(module)
+                        for _ in range(3)]
+                self.assertEqual(runs[0][1], [])
+                self.assertLess(min(seconds for seconds, _ in runs), budget)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
     #loop = asyncio.get_event_loop()
@@ -0,0 +1,166 @@
+"""
+HTTP transports of the API session.
+Session sends its requests through a transport. aiohttp speaks HTTP/1.1 and needs one
+connection per concurrent request, the http2 transport (httpx) multiplexes the
+concurrent requests to a backend on one connection. The responses of both offer the
+part of aiohttp.ClientResponse used by Session: status, read, json, content.read and
+release.
+"""
+import json
+
+AIOHTTP = "aiohttp"
+HTTP2 = "http2"
+TRANSPORTS = (AIOHTTP, HTTP2)
+
+
+class ResponseStatusError(Exception):
+    """Raised by the http2 transport for error statuses, like aiohttp.ClientResponseError"""
+
+    def __init__(self, status: int, message: str, url: str):
+        super().__init__(f"{status}, message={message!r}, url={url!r}")
+        self.status = status
+        self.message = message
+        self.url = url
+
+
+class AiohttpTransport:
+    """
+    HTTP/1.1 transport, one connection per concurrent request"""
+
+    def __init__(self,
+                 connector=None,
+                 connect_timeout: float | None = None,
+                 read_timeout: float | None = None):
+        """
+        aiohttp transport, must be created in the event loop
+        :param connector: aiohttp connector shared with other transports, not closed
+        :param connect_timeout: seconds to establish a connection
+        :param read_timeout: seconds without data before a request fails"""
+        from aiohttp import ClientResponseError, ClientSession, ClientTimeout
+        self.status_error = ClientResponseError
+        self._session = ClientSession(raise_for_status=True,
+                                      connector=connector,
+                                      connector_owner=connector is None,
+                                      timeout=ClientTimeout(
+                                          total=None,
+                                          connect=connect_timeout,
+                                          sock_read=read_timeout))
+
+    async def request(self, method: str, url: str, **kwargs):
+        """Send a request, the caller reads and releases the response
+        :param method: HTTP method
+        :param url: URL of the request
+        :param kwargs: headers, params, json and ssl
+        :return: aiohttp.ClientResponse object
+        :raises aiohttp.ClientResponseError: if the status is an error"""
+        return await self._session.request(method, url, **kwargs)
+
+    async def close(self) -> None:
+        await self._session.close()
+
+
+class _Http2Content:
+    """
+    Body of a streamed http2 response, read chunk by chunk"""
+
+    def __init__(self, response):
+        self._response = response
+        self._chunks = None
+
+    async def read(self, n: int) -> bytes:
+        """Read the next chunk of the body
+        :param n: maximum size of the chunk
+        :return: chunk, empty at the end of the body"""
+        if self._chunks is None:
+            self._chunks = self._response.aiter_bytes(n)
+        return await anext(self._chunks, b"")
+
+
+class Http2Response:
+    """
+    httpx response with the interface of aiohttp.ClientResponse used by Session"""
+
+    def __init__(self, response):
+        self._response = response
+        self.status = response.status_code
+        self.headers = response.headers
+        self.content = _Http2Content(response)
+
+    async def read(self) -> bytes:
+        return await self._response.aread()
+
+    async def json(self):
+        return json.loads(await self.read())
+
+    async def release(self) -> None:
+        await self._response.aclose()
+
+
+class Http2Transport:
+    """
+    HTTP/2 transport multiplexing concurrent requests on one connection"""
+
+    def __init__(self,
+                 base_url: str,
+                 verify: bool = True,
+                 connect_timeout: float | None = None,
+                 read_timeout: float | None = None):
+        """
+        httpx transport
+        HTTPS backends negotiate HTTP/2 and fall back to HTTP/1.1, plain HTTP backends
+        (e.g. a local test server) are expected to speak HTTP/2 (prior knowledge).
+        :param base_url: URL of the backend
+        :param verify: verify the TLS certificate of the backend
+        :param connect_timeout: seconds to establish a connection
+        :param read_timeout: seconds without data before a request fails"""
+        import httpx
+        self.status_error = ResponseStatusError
+        self._client = httpx.AsyncClient(
+            http1=not base_url.startswith("http://"),
+            http2=True,
+            verify=verify,
+            timeout=httpx.Timeout(None,
+                                  connect=connect_timeout,
+                                  read=read_timeout))
+
+    async def request(self, method: str, url: str, **kwargs) -> Http2Response:
+        """Send a request, the caller reads and releases the response
+        :param method: HTTP method
+        :param url: URL of the request
+        :param kwargs: headers, params, json and ssl (ignored, see verify)
+        :return: Http2Response object
+        :raises ResponseStatusError: if the status is an error"""
+        kwargs.pop("ssl", None)
+        response = await self._client.send(self._client.build_request(
+            method, url, **kwargs),
+                                           stream=True)
+        if response.status_code >= 400:
+            await response.aclose()
+            raise ResponseStatusError(response.status_code,
+                                      response.reason_phrase, url)
+        return Http2Response(response)
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+def create_transport(name: str,
+                     base_url: str,
+                     ssl: bool = True,
+                     connector=None,
+                     connect_timeout: float | None = None,
+                     read_timeout: float | None = None):
+    """Create the transport of a session
+    :param name: AIOHTTP or HTTP2
+    :param base_url: URL of the backend
+    :param ssl: verify the TLS certificate of the backend
+    :param connector: aiohttp connector shared with other sessions, aiohttp only
+    :param connect_timeout: seconds to establish a connection
+    :param read_timeout: seconds without data before a request fails
+    :return: AiohttpTransport or Http2Transport object"""
+    if name == AIOHTTP:
+        return AiohttpTransport(connector, connect_timeout, read_timeout)
+    if name == HTTP2:
+        return Http2Transport(base_url, ssl is not False, connect_timeout,
+                              read_timeout)
+    raise ValueError(f"Unknown transport {name}, use one of {TRANSPORTS}")
@@ -0,0 +1,2 @@
+from utils.utils import (encrypt, decrypt, decrypt_many, generate_key,
+                         get_or_create_encryption_key, KeyManager, key_manager)
@@ -0,0 +1,187 @@
+"""
+Local callback sender for load tests of the callback receiver.
+Simulates a storm of charge amps callbacks: many charge points posting connector
+statuses and finished charging sessions at the same time.
+
+Usage:
+
+    python -m utils.callback_sender http://127.0.0.1:5000/callbacks --token secret \
+        --requests 10000 --concurrency 50 --charge-points 200
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta
+
+from rfidindex import dec_representations
+
+SESSION_SHARE = 0.1
+
+
+def status_payload(charge_point_id: str, connector_id: int,
+                   rng: random.Random) -> dict:
+    """Build the body of a connector status callback
+    :param charge_point_id: ID of the charge point
+    :param connector_id: ID of the connector
+    :param rng: random number generator
+    :return: JSON object"""
+    charging = rng.random() < 0.5
+    current = round(rng.uniform(6.0, 16.0), 1) if charging else 0.0
+    return {
+        "chargePointId": charge_point_id,
+        "connectorId": connector_id,
+        "totalConsumptionKwh": round(rng.uniform(0, 50), 3),
+        "status": "Charging" if charging else "Available",
+        "measurements": [{
+            "phase": phase,
+            "current": current,
+            "voltage": round(rng.uniform(225.0, 235.0), 1)
+        } for phase in ("L1", "L2", "L3")],
+        "startTime": None,
+        "endTime": None,
+        "sessionId": None
+    }
+
+
+def session_payload(session_id: int, charge_point_id: str, connector_id: int,
+                    rng: random.Random) -> dict:
+    """Build the body of a finished charging session callback
+    :param session_id: ID of the session
+    :param charge_point_id: ID of the charge point
+    :param connector_id: ID of the connector
+    :param rng: random number generator
+    :return: JSON object"""
+    rfid = f"{rng.getrandbits(32):08X}"
+    rfid_dec, rfid_dec_reverse = dec_representations(rfid)
+    end = datetime.now().replace(microsecond=0)
+    start = end - timedelta(minutes=rng.randint(10, 600))
+    return {
+        "id": session_id,
+        "chargePointId": charge_point_id,
+        "connectorId": connector_id,
+        "userId": "load-test",
+        "rfid": rfid,
+        "rfidDec": rfid_dec,
+        "rfidDecReverse": rfid_dec_reverse,
+        "organisationId": None,
+        "sessionType": "RFID",
+        "totalConsumptionKwh": round(rng.uniform(1, 60), 3),
+        "externalTransactionId": None,
+        "externalId": None,
+        "startTime": start.isoformat(),
+        "endTime": end.isoformat()
+    }
+
+
+def build_body(request_number: int, charge_points: int, batch: int,
+               rng: random.Random) -> list[dict]:
+    """Build the events of one callback request"""
+    body = []
+    for i in range(batch):
+        charge_point_id = f"LOAD{rng.randrange(charge_points):06d}"
+        connector_id = rng.randint(1, 2)
+        if rng.random() < SESSION_SHARE:
+            body.append(
+                session_payload(request_number * batch + i, charge_point_id,
+                                connector_id, rng))
+        else:
+            body.append(status_payload(charge_point_id, connector_id, rng))
+    return body
+
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+async def storm(url: str,
+                token: str | None,
+                requests: int,
+                concurrency: int,
+                charge_points: int,
+                batch: int,
+                seed: int = 0) -> dict:
+    """Post callbacks as fast as the receiver accepts them
+    :param url: URL of the callback receiver
+    :param token: callback token, sent in the X-Callback-Token header
+    :param requests: number of requests
+    :param concurrency: requests in flight at the same time
+    :param charge_points: number of simulated charge points
+    :param batch: events per request
+    :param seed: seed of the random events
+    :return: dict with requests, failed, seconds, rps and latency percentiles"""
+    from aiohttp import ClientError, ClientSession, TCPConnector
+
+    rng = random.Random(seed)
+    bodies = [
+        build_body(n, charge_points, batch, rng) for n in range(requests)
+    ]
+    headers = {"X-Callback-Token": token} if token else {}
+    latencies = []
+    failed = 0
+    next_request = iter(range(requests))
+
+    async def sender(session: ClientSession) -> None:
+        nonlocal failed
+        for n in next_request:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=bodies[n],
+                                        headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        failed += 1
+            except (ClientError, OSError):
+                failed += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with ClientSession(connector=TCPConnector(
+            limit=concurrency)) as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "events": requests * batch,
+        "failed": failed,
+        "seconds": seconds,
+        "rps": requests / seconds if seconds else 0.0,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99)
+    }
+
+
+async def main(argv: list[str] | None = None) -> int:
+    """Run the callback sender command line
+    :param argv: command line arguments
+    :return: exit code, 1 if a request failed"""
+    parser = argparse.ArgumentParser(
+        description="Simulate a storm of charge amps callbacks.")
+    parser.add_argument("url", help="URL of the callback receiver")
+    parser.add_argument("--token", help="callback token of the receiver")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--charge-points", type=int, default=100)
+    parser.add_argument("--batch",
+                        type=int,
+                        default=1,
+                        help="events per request")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    result = await storm(args.url, args.token, args.requests,
+                         args.concurrency, args.charge_points, args.batch,
+                         args.seed)
+    print(f"{result['requests']} requests ({result['events']} events), "
+          f"{result['failed']} failed, {result['seconds']:.2f} s, "
+          f"{result['rps']:.0f} req/s, p50 {result['p50'] * 1000:.1f} ms, "
+          f"p99 {result['p99'] * 1000:.1f} ms")
+    return 1 if result["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,106 @@
+"""
+Rotation of the encryption key of the stored credentials.
+A new key becomes the current one and the email addresses and passwords in cfg.ini are
+encrypted with it. The replaced key stays in the .env file, so running workers and
+stored tokens keep working; drop it with --drop-old once all workers were restarted.
+
+Usage:
+
+    python -m utils.rotate_key [--cfg /data/cfg.ini]
+    python -m utils.rotate_key --drop-old
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+
+from chargeampscfgparser import TENANT_SECTION_PREFIX
+from utils.utils import KeyManager, default_env_path, key_manager
+
+ENCRYPTED_OPTIONS = ("email", "password")
+_SECTION = re.compile(r"^\s*\[(?P<name>[^\]]+)\]")
+_OPTION = re.compile(
+    r"^(?P<prefix>\s*(?P<name>[^=:#;\s]+)\s*[=:]\s*)(?P<value>\S.*?)\s*$")
+
+
+def _encrypted_lines(lines: list[str]) -> list[tuple[int, str, str]]:
+    """Find the encrypted options of the account sections
+    :param lines: lines of cfg.ini
+    :return: list of (line index, option prefix, encrypted value)"""
+    result = []
+    section = None
+    for index, line in enumerate(lines):
+        match = _SECTION.match(line)
+        if match:
+            section = match["name"]
+            continue
+        if section != "USERDATA" and not (section or "").startswith(
+                TENANT_SECTION_PREFIX):
+            continue
+        match = _OPTION.match(line)
+        if match is None:
+            continue
+        if match["name"].lower() in ENCRYPTED_OPTIONS and match[
+                "value"] != "None":
+            result.append((index, match["prefix"], match["value"]))
+    return result
+
+
+def rotate_cfg_key(cfg_path: str, manager: KeyManager) -> int:
+    """Rotate the key and encrypt the credentials of cfg.ini with the new key
+    Comments and other options of cfg.ini are kept.
+    :param cfg_path: path of cfg.ini
+    :param manager: KeyManager of the .env file
+    :return: number of re-encrypted values
+    :raises cryptography.fernet.InvalidToken: if a value can not be decrypted, nothing
+        is changed then"""
+    with open(cfg_path, "r") as f:
+        lines = f.readlines()
+    encrypted = _encrypted_lines(lines)
+    # fails before the key is rotated if a value does not belong to the keys
+    manager.decrypt_many(value for _, _, value in encrypted)
+    manager.rotate()
+    for index, prefix, value in encrypted:
+        lines[index] = f"{prefix}{manager.reencrypt(value)}\n"
+    directory = os.path.dirname(os.path.abspath(cfg_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.writelines(lines)
+        # mkstemp creates the file readable by the owner only, cfg.ini keeps its mode
+        os.chmod(tmp_path, os.stat(cfg_path).st_mode & 0o7777)
+        os.replace(tmp_path, cfg_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(encrypted)
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the key rotation command line
+    :param argv: command line arguments
+    :return: exit code"""
+    env_path = default_env_path()
+    parser = argparse.ArgumentParser(
+        description="Rotate the encryption key of the stored credentials.")
+    parser.add_argument("--cfg",
+                        default=os.path.join(os.path.dirname(env_path),
+                                             "cfg.ini"),
+                        help="path of cfg.ini")
+    parser.add_argument("--drop-old",
+                        action="store_true",
+                        help="remove the rotated out keys instead of rotating")
+    args = parser.parse_args(argv)
+    manager = key_manager(env_path)
+    if args.drop_old:
+        manager.drop_old_keys()
+        print("Old encryption keys removed")
+        return 0
+    count = rotate_cfg_key(args.cfg, manager)
+    print(f"New encryption key, {count} values of {args.cfg} re-encrypted")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
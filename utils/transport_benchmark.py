@@ -0,0 +1,233 @@
+"""
+Benchmark of the HTTP transports against a local stand-in of the charge amps API.
+The stand-in is served by hypercorn, which speaks HTTP/1.1 and HTTP/2, and answers
+every status request after a fixed latency. Every transport polls the status of many
+charge points concurrently, like a fleet wide fan-out.
+
+Usage:
+
+    python -m utils.transport_benchmark --requests 5000 --concurrency 500 --latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import time
+
+from transport import TRANSPORTS
+
+
+class MockApi:
+    """
+    ASGI stand-in of the charge amps API counting the connections it is used over"""
+
+    def __init__(self, latency: float):
+        """
+        Mock API
+        :param latency: seconds before a status is answered"""
+        self.latency = latency
+        self.connections = set()
+        self.requests = 0
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                await send({"type": message["type"] + ".complete"})
+                if message["type"] == "lifespan.shutdown":
+                    return
+        self.connections.add(tuple(scope["client"]))
+        self.requests += 1
+        while (await receive()).get("more_body"):
+            pass
+        path = scope["path"]
+        status = 200
+        if path.endswith(("/auth/login", "/auth/refreshToken")):
+            body = self.login()
+        elif path.endswith("/status"):
+            await asyncio.sleep(self.latency)
+            body = self.status(path.split("/")[-2])
+        else:
+            status, body = 404, {}
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")]
+        })
+        await send({
+            "type": "http.response.body",
+            "body": json.dumps(body).encode()
+        })
+
+    @staticmethod
+    def login() -> dict:
+        import jwt
+        return {
+            "token": jwt.encode({"exp": int(time.time()) + 3600}, "k" * 32),
+            "refreshToken": "refresh",
+            "user": {
+                "id": "benchmark",
+                "firstName": "Bench",
+                "lastName": "Mark",
+                "email": "benchmark@example.com",
+                "mobile": "",
+                "rfidTags": [],
+                "userStatus": "Valid"
+            }
+        }
+
+    @staticmethod
+    def status(charge_point_id: str) -> dict:
+        return {
+            "id": charge_point_id,
+            "status": "Online",
+            "connectorStatuses": [{
+                "chargePointId": charge_point_id,
+                "connectorId": 1,
+                "totalConsumptionKwh": 12.5,
+                "status": "Charging",
+                "measurements": [{
+                    "phase": phase,
+                    "current": 10.0,
+                    "voltage": 230.0
+                } for phase in ("L1", "L2", "L3")],
+                "startTime": None,
+                "endTime": None,
+                "sessionId": None
+            }]
+        }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def serve(api: MockApi) -> tuple[str, asyncio.Event, asyncio.Task]:
+    """Serve the mock API with hypercorn
+    :param api: MockApi object
+    :return: URL, event stopping the server when set and the server task"""
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+
+    port = free_port()
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.h2_max_concurrent_streams = 1000
+    # hypercorn closes a connection after 1000 requests by default
+    config.keep_alive_max_requests = sys.maxsize
+    shutdown = asyncio.Event()
+    server = asyncio.create_task(
+        hypercorn_serve(api, config, shutdown_trigger=shutdown.wait))
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        await writer.wait_closed()
+        return f"http://127.0.0.1:{port}", shutdown, server
+
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+async def benchmark(api: MockApi, url: str, transport: str, requests: int,
+                    concurrency: int, charge_points: int) -> dict:
+    """Poll charge point statuses through a transport
+    :param api: MockApi object serving url
+    :param url: URL of the mock API
+    :param transport: name of the transport
+    :param requests: number of status requests
+    :param concurrency: requests in flight at the same time
+    :param charge_points: number of simulated charge points
+    :return: dict with transport, requests, failed, seconds, rps, connections and
+        latency percentiles"""
+    from chargeampsclient import Client
+
+    client = Client("benchmark@example.com", "secret", "apikey", url,
+                    transport=transport)
+    await client.init_session()
+    api.connections.clear()
+    latencies = []
+    failed = 0
+    next_request = iter(range(requests))
+
+    async def poller() -> None:
+        nonlocal failed
+        for n in next_request:
+            started = time.perf_counter()
+            try:
+                await client.get_chargepoint_status(
+                    f"BENCH{n % charge_points:06d}")
+            except Exception:
+                failed += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(poller() for _ in range(concurrency)))
+    finally:
+        seconds = time.perf_counter() - started
+        await client.close_session()
+    return {
+        "transport": transport,
+        "requests": requests,
+        "failed": failed,
+        "seconds": seconds,
+        "rps": requests / seconds if seconds else 0.0,
+        "connections": len(api.connections),
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99)
+    }
+
+
+async def main(argv: list[str] | None = None) -> int:
+    """Run the transport benchmark command line
+    :param argv: command line arguments
+    :return: exit code, 1 if a request failed"""
+    parser = argparse.ArgumentParser(
+        description="Compare the HTTP transports against a local mock API.")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--charge-points", type=int, default=500)
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.05,
+                        help="seconds the mock API takes per status")
+    parser.add_argument("--transports",
+                        nargs="+",
+                        choices=TRANSPORTS,
+                        default=list(TRANSPORTS))
+    args = parser.parse_args(argv)
+    api = MockApi(args.latency)
+    url, shutdown, server = await serve(api)
+    failed = 0
+    try:
+        for transport in args.transports:
+            result = await benchmark(api, url, transport, args.requests,
+                                     args.concurrency, args.charge_points)
+            failed += result["failed"]
+            print(f"{result['transport']:8} {result['requests']} requests, "
+                  f"{result['failed']} failed, {result['seconds']:.2f} s, "
+                  f"{result['rps']:.0f} req/s, "
+                  f"{result['connections']} connections, "
+                  f"p50 {result['p50'] * 1000:.1f} ms, "
+                  f"p99 {result['p99'] * 1000:.1f} ms")
+    finally:
+        # let the server notice the closed connections before it stops
+        await asyncio.sleep(0.5)
+        shutdown.set()
+        await server
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -1,13 +1,20 @@
-from cryptography.fernet import Fernet
+import functools
 import os
-from dotenv import load_dotenv
+import tempfile
+import threading
+from dotenv import dotenv_values
 
+from collections.abc import Iterable
 from dataclasses import field
 from datetime import datetime
 
-from ciso8601 import parse_datetime
-from dataclasses_json import config
-from marshmallow import fields
+try:
+    import fcntl
+except ImportError:  # Windows, only one process may write the .env file at a time
+    fcntl = None
+
+# cryptography, ciso8601, dataclasses_json and marshmallow are imported where they are
+# used, importing this module has to stay cheap for the web workers and the CLI
 
 
 def datetime_encoder(x: datetime | None) -> str | None:
@@ -15,10 +22,13 @@ def datetime_encoder(x: datetime | None) -> str | None:
 
 
 def datetime_decoder(x: str | None) -> datetime | None:
+    from ciso8601 import parse_datetime
     return parse_datetime(x) if x is not None else None
 
 
 def datetime_field():
+    from dataclasses_json import config
+    from marshmallow import fields
     return field(
         default=None,
         metadata=config(
@@ -32,9 +42,242 @@ def datetime_field():
 # Key generieren
 def generate_key():
     """Generates a Fernet key for encryption/decryption."""
+    from cryptography.fernet import Fernet
     return Fernet.generate_key()
 
 
+KEY_VARIABLE = "EMAIL_ENCRYPTION_KEY"
+# keys replaced by a rotation, they still decrypt until they are dropped
+OLD_KEYS_VARIABLE = "EMAIL_ENCRYPTION_OLD_KEYS"
+
+
+def default_env_path() -> str:
+    """Path of the .env file holding the encryption keys."""
+    return os.getenv("ENV_PATH",
+                     os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+
+class KeyManager:
+    """
+    Encryption keys of a .env file, loaded once and reloaded when the file changes.
+    The current key encrypts, the keys it replaced still decrypt, so a key can be
+    rotated while workers keep running. Writes of the file are atomic and locked."""
+
+    def __init__(self, env_path: str):
+        """
+        Key manager
+        Args:
+            env_path (str): Path of the .env file.
+        """
+        self._env_path = env_path
+        self._lock = threading.RLock()
+        self._mtime = None
+        self._keys = []
+        self._fernet = None
+
+    def _file_mtime(self) -> int | None:
+        try:
+            return os.stat(self._env_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _file_mode(self) -> int | None:
+        try:
+            return os.stat(self._env_path).st_mode & 0o7777
+        except FileNotFoundError:
+            return None
+
+    def _load(self) -> None:
+        """Read the keys, the .env file wins over the process environment."""
+        mtime = self._file_mtime()
+        values = dotenv_values(self._env_path) if mtime is not None else {}
+        key = values.get(KEY_VARIABLE) or os.getenv(KEY_VARIABLE)
+        old_keys = values.get(OLD_KEYS_VARIABLE) or ""
+        keys = [key] if key else []
+        keys += [old for old in old_keys.split(",") if old and old != key]
+        self._keys = [key.encode() for key in keys]
+        self._fernet = None
+        self._mtime = mtime
+
+    def reload_if_changed(self) -> bool:
+        """Reload the keys if the .env file changed since they were loaded.
+        Returns:
+            bool: True if the keys were reloaded.
+        """
+        with self._lock:
+            if self._keys and self._file_mtime() == self._mtime:
+                return False
+            self._load()
+            return True
+
+    @property
+    def keys(self) -> list[bytes]:
+        """Current key followed by the older keys, empty without key."""
+        self.reload_if_changed()
+        return list(self._keys)
+
+    def _multi_fernet(self):
+        with self._lock:
+            self.reload_if_changed()
+            if not self._keys:
+                raise KeyError(f"No {KEY_VARIABLE} in {self._env_path}")
+            if self._fernet is None:
+                from cryptography.fernet import MultiFernet
+                self._fernet = MultiFernet([_fernet(key) for key in self._keys])
+            return self._fernet
+
+    def _write(self, updates: dict[str, str | None]) -> None:
+        """Set or remove variables of the .env file, other lines are kept.
+        The file is replaced atomically under an exclusive lock, the caller holds it.
+        """
+        try:
+            with open(self._env_path, "r") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+        pending = dict(updates)
+        result = []
+        for line in lines:
+            name = line.split("=", 1)[0].strip()
+            if name in pending:
+                value = pending.pop(name)
+                if value is not None:
+                    result.append(f"{name}={value}\n")
+                continue
+            result.append(line if line.endswith("\n") else line + "\n")
+        for name, value in pending.items():
+            if value is not None:
+                result.append(f"{name}={value}\n")
+        directory = os.path.dirname(os.path.abspath(self._env_path))
+        os.makedirs(directory, exist_ok=True)
+        # a new file is readable by the owner only, a replaced one keeps its mode
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.writelines(result)
+            mode = self._file_mode()
+            if mode is not None:
+                os.chmod(tmp_path, mode)
+            os.replace(tmp_path, self._env_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._load()
+
+    def _locked(self, change):
+        """Run a change of the .env file under the thread and file lock."""
+        with self._lock:
+            with open(self._env_path + ".lock", "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # another process may have changed the file meanwhile
+                self._load()
+                return change()
+
+    def get_or_create_key(self) -> bytes:
+        """Get the current key, a new key is generated and saved if there is none.
+        Returns:
+            bytes: The current key.
+        """
+        keys = self.keys
+        if keys:
+            return keys[0]
+
+        def create() -> bytes:
+            if self._keys:
+                return self._keys[0]
+            self._write({KEY_VARIABLE: generate_key().decode()})
+            print("🔐 New EMAIL_ENCRYPTION_KEY generated and saved to .env")
+            return self._keys[0]
+
+        return self._locked(create)
+
+    def rotate(self) -> bytes:
+        """Make a new key the current one, the replaced keys still decrypt.
+        Re-encrypt the stored secrets with reencrypt, then drop_old_keys.
+        Returns:
+            bytes: The new key.
+        """
+
+        def rotate() -> bytes:
+            key = generate_key().decode()
+            self._write({
+                KEY_VARIABLE:
+                key,
+                OLD_KEYS_VARIABLE:
+                ",".join(old.decode() for old in self._keys) or None
+            })
+            return self._keys[0]
+
+        return self._locked(rotate)
+
+    def drop_old_keys(self) -> None:
+        """Remove the rotated out keys, their tokens can not be decrypted anymore."""
+        self._locked(lambda: self._write({OLD_KEYS_VARIABLE: None}))
+
+    def encrypt(self, text: str) -> str:
+        """Encrypts a text with the current key.
+        Args:
+            text (str): The text to encrypt.
+        Returns:
+            str: The encrypted text.
+        """
+        return self._multi_fernet().encrypt(text.encode()).decode()
+
+    def decrypt(self, token: str) -> str:
+        """Decrypts a token of the current or an older key.
+        Args:
+            token (str): The encrypted text.
+        Returns:
+            str: The decrypted text.
+        """
+        return self._multi_fernet().decrypt(token.encode()).decode()
+
+    def decrypt_many(self, tokens: Iterable[str]) -> list[str]:
+        """Decrypts many tokens, e.g. the credentials of all tenants, in one go.
+        Args:
+            tokens (Iterable[str]): The encrypted texts.
+        Returns:
+            list[str]: The decrypted texts in the same order.
+        """
+        fernet = self._multi_fernet()
+        return [fernet.decrypt(token.encode()).decode() for token in tokens]
+
+    def reencrypt(self, token: str) -> str:
+        """Encrypts a token of an older key with the current key.
+        Args:
+            token (str): The encrypted text.
+        Returns:
+            str: The text encrypted with the current key.
+        """
+        return self._multi_fernet().rotate(token.encode()).decode()
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def key_manager(env_path: str | None = None) -> KeyManager:
+    """Get the key manager of a .env file, one per file and process.
+    Args:
+        env_path (str): Path of the .env file, defaults to ENV_PATH.
+    Returns:
+        KeyManager: The key manager.
+    """
+    env_path = os.path.abspath(env_path or default_env_path())
+    with _managers_lock:
+        if env_path not in _managers:
+            _managers[env_path] = KeyManager(env_path)
+        return _managers[env_path]
+
+
+@functools.lru_cache(maxsize=32)
+def _fernet(key: bytes):
+    """Fernet of a key, built once per key and process."""
+    from cryptography.fernet import Fernet
+    return Fernet(key)
+
+
 # encrypt E-Mail
 
 
@@ -46,21 +289,44 @@ def encrypt(email: str, key: bytes) -> str:
     Returns:
         str: The encrypted email address.
     """
-    fernet = Fernet(key)
-    return fernet.encrypt(email.encode()).decode()
+    return _fernet(key).encrypt(email.encode()).decode()
 
 
 # decrypt E-Mail
 def decrypt(token: str, key: bytes) -> str:
     """Decrypts an encrypted email address using the provided key.
+    Tokens of a newer or older key of the .env file are decrypted as well, e.g.
+    while a key is rotated.
     Args:
         token (str): The encrypted email address to decrypt.
         key (bytes): The key used for decryption.
     Returns:
         str: The decrypted email address.
     """
-    fernet = Fernet(key)
-    return fernet.decrypt(token.encode()).decode()
+    return decrypt_many([token], key)[0]
+
+
+def decrypt_many(tokens: Iterable[str], key: bytes) -> list[str]:
+    """Decrypts many tokens, e.g. the credentials of all tenants, using the provided key.
+    Tokens of a newer or older key of the .env file are decrypted as well.
+    Args:
+        tokens (Iterable[str]): The encrypted texts.
+        key (bytes): The key used for decryption.
+    Returns:
+        list[str]: The decrypted texts in the same order.
+    """
+    from cryptography.fernet import InvalidToken
+    fernet = _fernet(key)
+    result = []
+    for token in tokens:
+        try:
+            result.append(fernet.decrypt(token.encode()).decode())
+        except InvalidToken:
+            manager = key_manager()
+            if not manager.keys or manager.keys == [key]:
+                raise
+            result.append(manager.decrypt(token))
+    return result
 
 
 def get_or_create_encryption_key():
@@ -68,38 +334,6 @@ def get_or_create_encryption_key():
     Get or create an encryption key for email encryption.
     If the key already exists in the .env file, it will be returned.
     If not, a new key will be generated and saved to the .env file.
+    The key is read once per process and again only after the file changed.
     """
-    env_path = os.getenv("ENV_PATH",
-                         os.path.join(os.path.dirname(__file__), '..', '.env'))
-    load_dotenv(dotenv_path=env_path)
-    key = os.getenv("EMAIL_ENCRYPTION_KEY")
-
-    if key:
-        return key.encode() if isinstance(key, str) else key
-
-    # Generate new key
-    key = Fernet.generate_key().decode()
-
-    # Read existing .env content
-    if os.path.exists(env_path):
-        with open(env_path, "r") as f:
-            lines = f.readlines()
-    else:
-        lines = []
-
-    # Replace or append the key in the lines
-    key_written = False
-    for i, line in enumerate(lines):
-        if line.startswith("EMAIL_ENCRYPTION_KEY="):
-            lines[i] = f"EMAIL_ENCRYPTION_KEY={key}\n"
-            key_written = True
-            break
-    if not key_written:
-        lines.append(f"EMAIL_ENCRYPTION_KEY={key}\n")
-
-    # Write updated lines to .env
-    with open(env_path, "w") as f:
-        f.writelines(lines)
-
-    print("🔐 New EMAIL_ENCRYPTION_KEY generated and saved to .env")
-    return key.encode() if isinstance(key, str) else key
+    return key_manager().get_or_create_key()
@@ -0,0 +1,132 @@
+"""
+Watermarks of incremental exports.
+For every charger, connector and RFID tag the newest exported charging session is
+remembered, so a recurring export can fetch only the sessions that ended since the
+last run and never bills a session twice.
+"""
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from chargeampscfgparser import DEFAULT_TENANT
+
+try:
+    import fcntl
+except ImportError:  # Windows, only one process may export at a time
+    fcntl = None
+
+# sessions ending after the watermark may have started up to this long before it
+INCREMENTAL_LOOKBACK = timedelta(days=1)
+
+
+@dataclass(frozen=True, order=True)
+class Watermark:
+    """Class representing the newest exported charging session."""
+    end_time: datetime
+    session_id: int
+
+    def is_before(self, session) -> bool:
+        """Check if a charging session is newer than the watermark
+        :param session: ChargingSession object
+        :return: True if the session was not exported yet"""
+        return session.end_time is not None and (
+            session.end_time, session.id) > (self.end_time, self.session_id)
+
+    @classmethod
+    def of(cls, session) -> "Watermark":
+        """Create the watermark of a charging session
+        :param session: ChargingSession object
+        :return: Watermark object"""
+        return cls(session.end_time, session.id)
+
+
+def watermark_key(charge_point_id: str,
+                  connector_id: int,
+                  rfid: str | None,
+                  tenant: str = DEFAULT_TENANT) -> str:
+    """Get the key of an export in the watermark store
+    :param charge_point_id: ID of the charge point
+    :param connector_id: ID of the connector
+    :param rfid: RFID tag of the export, None for all tags
+    :param tenant: name of the tenant
+    :return: key"""
+    return f"{tenant}|{charge_point_id}|{connector_id}|{rfid or '*'}"
+
+
+class WatermarkStore:
+    """
+    Watermarks in a JSON file shared by all processes on a host"""
+
+    def __init__(self, path: str):
+        """
+        Watermark store
+        :param path: path of the JSON file"""
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        self._path = path
+        self._lock = asyncio.Lock()
+
+    def _read(self) -> dict:
+        """Read all watermarks"""
+        try:
+            with open(self._path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write(self, watermarks: dict) -> None:
+        """Replace the file atomically, readers never see a partial file"""
+        directory = os.path.dirname(os.path.abspath(self._path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(watermarks, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _advance(self, key: str, watermark: Watermark) -> Watermark:
+        """Move a watermark forward under an exclusive file lock"""
+        with open(self._path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            watermarks = self._read()
+            current = self._decode(watermarks.get(key))
+            if current is not None and current >= watermark:
+                return current
+            watermarks[key] = {
+                "end_time": watermark.end_time.isoformat(),
+                "session_id": watermark.session_id
+            }
+            self._write(watermarks)
+            return watermark
+
+    @staticmethod
+    def _decode(entry: dict | None) -> Watermark | None:
+        """Decode a stored watermark"""
+        if entry is None:
+            return None
+        return Watermark(datetime.fromisoformat(entry["end_time"]),
+                         entry["session_id"])
+
+    async def get(self, key: str) -> Watermark | None:
+        """Get a watermark
+        :param key: key of the export, see watermark_key
+        :return: Watermark object or None before the first export"""
+        watermarks = await asyncio.to_thread(self._read)
+        return self._decode(watermarks.get(key))
+
+    async def advance(self, key: str, watermark: Watermark) -> Watermark:
+        """Store a watermark unless a newer one is stored already
+        :param key: key of the export, see watermark_key
+        :param watermark: Watermark of the newest exported session
+        :return: stored Watermark object"""
+        async with self._lock:
+            return await asyncio.to_thread(self._advance, key, watermark)
@@ -1,19 +1,208 @@
-import xlsxwriter
 import time
 from chargeampsdata import ChargingSession
 from datetime import datetime
 import os
 from io import BytesIO
+from collections.abc import AsyncIterable
+from rfidreport import RfidUsage
+from typing import TYPE_CHECKING
+
+# xlsxwriter is only needed when a file is exported
+if TYPE_CHECKING:
+    import xlsxwriter
+    from xlsxtemplate import XlsxTemplate
+
+INVALID_SHEET_CHARS = str.maketrans({c: "_" for c in "[]:*?/\\"})
+MAX_SHEET_NAME = 31
+SUMMARY_SHEET = "RFID Summary"
+
+
+def sheet_names(rfids: list[str]) -> dict[str, str]:
+    """
+    Gets unique worksheet names of the tag detail sheets.
+    Excel compares sheet names case insensitively and cuts them at 31 characters.
+    :param rfids: RFID tags
+    :return: dict of sheet names by RFID tag
+    """
+    names = {}
+    used = {SUMMARY_SHEET.lower()}
+    for rfid in rfids:
+        stem = rfid.translate(INVALID_SHEET_CHARS).strip("'") or "rfid"
+        name = stem[:MAX_SHEET_NAME]
+        n = 1
+        while name.lower() in used:
+            n += 1
+            suffix = f"_{n}"
+            name = stem[:MAX_SHEET_NAME - len(suffix)] + suffix
+        used.add(name.lower())
+        names[rfid] = name
+    return names
 
 
 class XlsxResult:
     """
     Class to generate an xlsx file with charging sessions data."""
 
-    def __init__(self):
+    def __init__(self, template: "XlsxTemplate | None" = None):
+        """
+        Initialize the XlsxResult class.
+        :param template: layout of the charging summary, see xlsxtemplate.load_template,
+            None uses the built-in layout"""
+        self._template = template
+
+    def _add_formats(self, workbook: "xlsxwriter.Workbook") -> dict:
+        """
+        Adds the cell formats used by the charging summary to the workbook.
+        :param workbook: Workbook object
+        :return: dict of named Format objects
+        """
+        return {
+            "header":
+            workbook.add_format({
+                'align': 'center',
+                'bold': True,
+                'bottom': True,
+                'border': 2
+            }),
+            "header_euros":
+            workbook.add_format({
+                'align': 'center',
+                'num_format': '#,##0.00€',
+                'bold': True,
+                'bottom': True,
+                'border': 2
+            }),
+            "cell":
+            workbook.add_format({
+                'align': 'center',
+                'bold': False,
+                'bottom': True,
+                'border': 1
+            }),
+            "euros":
+            workbook.add_format({
+                'align': 'center',
+                'num_format': '#,##0.00€',
+                'bottom': True,
+                'border': 1
+            }),
+            "cents":
+            workbook.add_format({'num_format': '#,##0 cents'}),
+            "date":
+            workbook.add_format({
+                'align': 'center',
+                'num_format': 'yyyy-mm-d hh:mm',
+                'bottom': True,
+                'border': 1
+            }),  #2024-12-09T05:35:32
+        }
+
+    def _write_header(self, worksheet, formats: dict) -> None:
+        """
+        Writes the header row of the charging summary.
+        :param worksheet: Worksheet object
+        :param formats: dict of named Format objects
+        """
+        header_format = formats["header"]
+        worksheet.write(0, 0, "No of Charging Process", header_format)
+        worksheet.write(0, 1, "Start", header_format)
+        worksheet.write(0, 2, "End", header_format)
+        worksheet.write(0, 3, "RFID tag", header_format)
+        worksheet.write(0, 4, "kWh", header_format)
+        worksheet.write(0, 5, "cent/kWh", header_format)
+        worksheet.write(0, 6, "total costs", header_format)
+
+    def _write_row(self, worksheet, formats: dict, row: int,
+                   csession: ChargingSession, kwh_price: float) -> None:
+        """
+        Writes a single charging session.
+        :param worksheet: Worksheet object
+        :param formats: dict of named Format objects
+        :param row: zero based row index
+        :param csession: ChargingSession object
+        :param kwh_price: Price per kWh in cents
+        """
+        cell_format = formats["cell"]
+        date_format = formats["date"]
+        worksheet.write_number(row, 0, row, cell_format)
+        worksheet.write_datetime(row, 1, csession.start_time, date_format)
+        if csession.end_time is not None:
+            worksheet.write_datetime(row, 2, csession.end_time, date_format)
+        else:
+            # the session is still ongoing
+            worksheet.write_blank(row, 2, None, date_format)
+        worksheet.write_string(row, 3, csession.rfid, cell_format)
+        worksheet.write_number(row, 4, csession.total_consumption_kwh,
+                               cell_format)
+        worksheet.write_number(row, 5, float(kwh_price), cell_format)
+        worksheet._write_formula(
+            row, 6, "=E" + str(row + 1) + "*" + "F" + str(row + 1) + "/100",
+            formats["euros"])
+
+    def _write_total(self, worksheet, formats: dict, row: int) -> None:
+        """
+        Writes the total costs below the last charging session.
+        :param worksheet: Worksheet object
+        :param formats: dict of named Format objects
+        :param row: zero based row index of the total row
+        """
+        worksheet.write_string(row, 5, "Total Costs", formats["header"])
+        worksheet._write_formula(row, 6, "=SUM(G2:G" + str(row) + ")",
+                                 formats["header_euros"])
+
+    def _add_summary_formats(self, workbook: "xlsxwriter.Workbook") -> dict:
+        """
+        Adds the cell formats of the charging summary, those of the template if set.
+        :param workbook: Workbook object
+        :return: dict of named Format objects
+        """
+        if self._template is not None:
+            return self._template.add_formats(workbook)
+        return self._add_formats(workbook)
+
+    def _write_summary_header(self, worksheet, formats: dict) -> None:
+        """
+        Writes the header row of the charging summary in the layout of the template.
+        :param worksheet: Worksheet object
+        :param formats: dict of _add_summary_formats
+        """
+        if self._template is not None:
+            self._template.write_header(worksheet, formats)
+        else:
+            self._write_header(worksheet, formats)
+
+    def _write_summary_row(self, worksheet, formats: dict, row: int,
+                           csession: ChargingSession,
+                           kwh_price: float) -> float:
+        """
+        Writes a single charging session in the layout of the template.
+        :param worksheet: Worksheet object
+        :param formats: dict of _add_summary_formats
+        :param row: zero based row index
+        :param csession: ChargingSession object
+        :param kwh_price: Price per kWh in cents
+        :return: costs of the charging session
+        """
+        if self._template is not None:
+            return self._template.write_row(worksheet, formats, row, csession,
+                                            kwh_price)
+        self._write_row(worksheet, formats, row, csession, kwh_price)
+        return csession.total_consumption_kwh * float(kwh_price) / 100
+
+    def _write_summary_total(self, worksheet, formats: dict, row: int,
+                             total_costs: float) -> None:
+        """
+        Writes the total costs in the layout of the template.
+        The template gets the computed total, the built-in layout a SUM formula.
+        :param worksheet: Worksheet object
+        :param formats: dict of _add_summary_formats
+        :param row: zero based row index of the total row
+        :param total_costs: sum of the costs of all charging sessions
         """
-        Initialize the XlsxResult class."""
-        return None
+        if self._template is not None:
+            self._template.write_total(worksheet, formats, row, total_costs)
+        else:
+            self._write_total(worksheet, formats, row)
 
     def gen_output_file(self, charge_sessions: list[ChargingSession],
                         kwh_price: float) -> BytesIO:
@@ -23,69 +212,113 @@ class XlsxResult:
         :param kwh_price: Price per kWh in cents
         :return: BytesIO object containing the xlsx file
         """
+        import xlsxwriter
         output = BytesIO()
 
         workbook = xlsxwriter.Workbook(output, {'in_memory': True})
         worksheet = workbook.add_worksheet("Charging Summary")
-        #Formats
-        header_format = workbook.add_format({
-            'align': 'center',
-            'bold': True,
-            'bottom': True,
-            'border': 2
-        })
-        header_format_euros = workbook.add_format({
-            'align': 'center',
-            'num_format': '#,##0.00€',
-            'bold': True,
-            'bottom': True,
-            'border': 2
-        })
-        cell_format = workbook.add_format({
-            'align': 'center',
-            'bold': False,
-            'bottom': True,
-            'border': 1
-        })
-        euros = workbook.add_format({
-            'align': 'center',
-            'num_format': '#,##0.00€',
-            'bottom': True,
-            'border': 1
-        })
-        cents = workbook.add_format({'num_format': '#,##0 cents'})
-        date_format = workbook.add_format({
-            'align': 'center',
-            'num_format': 'yyyy-mm-d hh:mm',
-            'bottom': True,
-            'border': 1
-        })  #2024-12-09T05:35:32
+        formats = self._add_summary_formats(workbook)
 
-        worksheet.write(0, 0, "No of Charging Process", header_format)
-        worksheet.write(0, 1, "Start", header_format)
-        worksheet.write(0, 2, "End", header_format)
-        worksheet.write(0, 3, "RFID tag", header_format)
-        worksheet.write(0, 4, "kWh", header_format)
-        worksheet.write(0, 5, "cent/kWh", header_format)
-        worksheet.write(0, 6, "total costs", header_format)
+        self._write_summary_header(worksheet, formats)
         row = 1
-        idx = 1
+        total_costs = 0.0
         for csession in charge_sessions:
-            worksheet.write_number(row, 0, idx, cell_format)
-            worksheet.write_datetime(row, 1, csession.start_time, date_format)
-            worksheet.write_datetime(row, 2, csession.end_time, date_format)
-            worksheet.write_string(row, 3, csession.rfid, cell_format)
-            worksheet.write_number(row, 4, csession.total_consumption_kwh,
-                                   cell_format)
-            worksheet.write_number(row, 5, float(kwh_price), cell_format)
-            worksheet._write_formula(
-                row, 6,
-                "=E" + str(row + 1) + "*" + "F" + str(row + 1) + "/100", euros)
+            total_costs += self._write_summary_row(worksheet, formats, row,
+                                                   csession, kwh_price)
+            row += 1
+        self._write_summary_total(worksheet, formats, row, total_costs)
+
+        workbook.close()
+        output.seek(0)
+        return output
+
+    async def gen_output_file_from_stream(self,
+                                          priced_sessions: AsyncIterable,
+                                          kwh_price: float) -> BytesIO:
+        """
+        Generates an xlsx file while the charging sessions are still arriving.
+        Rows are flushed to disk as they are written (constant memory mode), but the
+        finished file is buffered: an xlsx is a zip archive only complete on close, so
+        unlike the CSV export it cannot be sent while the sessions arrive.
+        :param priced_sessions: async iterable of PricedSession objects
+        :param kwh_price: Price per kWh in cents
+        :return: BytesIO object containing the xlsx file
+        """
+        import xlsxwriter
+        output = BytesIO()
+
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+        worksheet = workbook.add_worksheet("Charging Summary")
+        formats = self._add_summary_formats(workbook)
+
+        self._write_summary_header(worksheet, formats)
+        row = 1
+        total_costs = 0.0
+        async for priced in priced_sessions:
+            total_costs += self._write_summary_row(worksheet, formats, row,
+                                                   priced.session, kwh_price)
+            row += 1
+        self._write_summary_total(worksheet, formats, row, total_costs)
+
+        workbook.close()
+        output.seek(0)
+        return output
+
+    def gen_rfid_report(self, usages: dict[str, RfidUsage],
+                        kwh_price: float) -> BytesIO:
+        """
+        Generates an xlsx file with a per RFID tag summary and one detail sheet per tag.
+        :param usages: dict of RfidUsage objects by RFID tag
+        :param kwh_price: Price per kWh in cents
+        :return: BytesIO object containing the xlsx file
+        """
+        import xlsxwriter
+        output = BytesIO()
+
+        workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+        summary = workbook.add_worksheet(SUMMARY_SHEET)
+        formats = self._add_formats(workbook)
+        header_format = formats["header"]
+        cell_format = formats["cell"]
+
+        summary.write(0, 0, "RFID tag", header_format)
+        summary.write(0, 1, "No of Charging Processes", header_format)
+        summary.write(0, 2, "kWh", header_format)
+        summary.write(0, 3, "cent/kWh", header_format)
+        summary.write(0, 4, "total costs", header_format)
+        row = 1
+        total_kwh = 0.0
+        total_costs = 0.0
+        for usage in usages.values():
+            summary.write_string(row, 0, usage.rfid, cell_format)
+            summary.write_number(row, 1, usage.session_count, cell_format)
+            summary.write_number(row, 2, usage.total_consumption_kwh,
+                                 cell_format)
+            summary.write_number(row, 3, float(kwh_price), cell_format)
+            summary.write_number(row, 4, usage.total_costs, formats["euros"])
+            total_kwh += usage.total_consumption_kwh
+            total_costs += usage.total_costs
             row += 1
-            idx += 1
-        worksheet.write_string(row, 5, "Total Costs", header_format)
-        worksheet._write_formula(row, 6, "=SUM(G2:G" + str(idx - 1) + ")",
-                                 header_format_euros)
+        summary.write_string(row, 0, "Total", header_format)
+        summary.write_number(row, 2, total_kwh, header_format)
+        summary.write_number(row, 4, total_costs, formats["header_euros"])
+
+        if self._template is not None:
+            formats = self._add_summary_formats(workbook)
+        names = sheet_names(
+            [usage.rfid for usage in usages.values() if usage.sessions])
+        for usage in usages.values():
+            if not usage.sessions:
+                continue
+            worksheet = workbook.add_worksheet(names[usage.rfid])
+            self._write_summary_header(worksheet, formats)
+            row = 1
+            total_costs = 0.0
+            for csession in usage.sessions:
+                total_costs += self._write_summary_row(
+                    worksheet, formats, row, csession, kwh_price)
+                row += 1
+            self._write_summary_total(worksheet, formats, row, total_costs)
 
         workbook.close()
         output.seek(0)
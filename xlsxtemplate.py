@@ -0,0 +1,237 @@
+"""
+Layout of the charging summary taken from a branded xlsx template.
+The template (template_csts.xlsx by default) is parsed once per process with openpyxl:
+the header row gives the columns, their titles and header styles, the first data row
+the cell styles and number formats. Workbooks are then written with xlsxwriter from
+the cached formats, costs and totals are computed while the rows are written.
+"""
+import functools
+import os
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from chargeampsdata import ChargingSession
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "template_csts.xlsx")
+DATE_FORMAT = "yyyy-mm-d hh:mm"
+TOTAL_LABEL = "Total Costs"
+
+# value of a column by its normalized header title
+COLUMN_VALUES = {
+    "no charging process": "number",
+    "no of charging process": "number",
+    "start": "start_time",
+    "end": "end_time",
+    "kwh": "kwh",
+    "rfid tag": "rfid",
+    "cent/kwh": "kwh_price",
+    "total costs": "costs",
+}
+# openpyxl border styles as xlsxwriter border indices
+BORDER_STYLES = {
+    "thin": 1,
+    "medium": 2,
+    "dashed": 3,
+    "dotted": 4,
+    "thick": 5,
+    "double": 6,
+    "hair": 7,
+    "mediumDashed": 8,
+    "dashDot": 9,
+    "mediumDashDot": 10,
+    "dashDotDot": 11,
+    "mediumDashDotDot": 12,
+    "slantDashDot": 13,
+}
+ALIGNMENTS = {"centerContinuous": "center_across", "general": None}
+VERTICAL_ALIGNMENTS = {"center": "vcenter"}
+
+
+def _color(color) -> str | None:
+    # theme and indexed colors have no RGB value
+    if color is None or not isinstance(color.rgb, str):
+        return None
+    return "#" + color.rgb[-6:]
+
+
+def format_properties(cell) -> dict:
+    """Convert the style of an openpyxl cell to xlsxwriter format properties
+    :param cell: openpyxl Cell object
+    :return: dict of format properties"""
+    properties = {}
+    font = cell.font
+    if font.b:
+        properties["bold"] = True
+    if font.i:
+        properties["italic"] = True
+    if font.name:
+        properties["font_name"] = font.name
+    if font.sz:
+        properties["font_size"] = font.sz
+    if _color(font.color):
+        properties["font_color"] = _color(font.color)
+    horizontal = cell.alignment.horizontal
+    if horizontal:
+        horizontal = ALIGNMENTS.get(horizontal, horizontal)
+        if horizontal:
+            properties["align"] = horizontal
+    vertical = cell.alignment.vertical
+    if vertical:
+        properties["valign"] = VERTICAL_ALIGNMENTS.get(vertical, vertical)
+    if cell.alignment.wrap_text:
+        properties["text_wrap"] = True
+    for side in ("left", "right", "top", "bottom"):
+        style = getattr(cell.border, side).style
+        if style:
+            properties[side] = BORDER_STYLES.get(style, 1)
+    if cell.fill.fill_type == "solid" and _color(cell.fill.fgColor):
+        properties["bg_color"] = _color(cell.fill.fgColor)
+    if cell.number_format != "General":
+        properties["num_format"] = cell.number_format
+    return properties
+
+
+@dataclass(frozen=True)
+class TemplateColumn:
+    """Class representing a column of the template."""
+    value: str
+    title: str
+    header: dict
+    cell: dict
+    width: float | None
+
+
+@dataclass(frozen=True)
+class XlsxTemplate:
+    """Class representing the parsed layout of a template."""
+    columns: tuple[TemplateColumn, ...]
+
+    def add_formats(self, workbook) -> dict:
+        """Adds the formats of the template to a workbook
+        :param workbook: xlsxwriter Workbook object
+        :return: dict of lists of Format objects per column"""
+        costs = [column.cell.get("num_format") for column in self.columns
+                 if column.value == "costs"]
+        total = dict(self.columns[0].header)
+        if costs and costs[0]:
+            total["num_format"] = costs[0]
+        return {
+            "header": [workbook.add_format(c.header) for c in self.columns],
+            "cell": [workbook.add_format(c.cell) for c in self.columns],
+            "total_label": workbook.add_format(self.columns[0].header),
+            "total": workbook.add_format(total),
+        }
+
+    def write_header(self, worksheet, formats: dict) -> None:
+        """Writes the column widths and the header row
+        :param worksheet: xlsxwriter Worksheet object
+        :param formats: formats of add_formats"""
+        for col, column in enumerate(self.columns):
+            if column.width is not None:
+                worksheet.set_column(col, col, column.width)
+            worksheet.write_string(0, col, column.title, formats["header"][col])
+
+    def write_row(self, worksheet, formats: dict, row: int,
+                  csession: "ChargingSession", kwh_price: float) -> float:
+        """Writes a single charging session
+        :param worksheet: xlsxwriter Worksheet object
+        :param formats: formats of add_formats
+        :param row: zero based row index
+        :param csession: ChargingSession object
+        :param kwh_price: price per kWh in cents
+        :return: costs of the session"""
+        kwh_price = float(kwh_price)
+        costs = csession.total_consumption_kwh * kwh_price / 100
+        cells = formats["cell"]
+        for col, column in enumerate(self.columns):
+            value = column.value
+            if value == "number":
+                worksheet.write_number(row, col, row, cells[col])
+            elif value == "start_time" or value == "end_time":
+                moment = getattr(csession, value)
+                if moment is None:
+                    # the end of a session still ongoing
+                    worksheet.write_blank(row, col, None, cells[col])
+                else:
+                    worksheet.write_datetime(row, col, moment, cells[col])
+            elif value == "kwh":
+                worksheet.write_number(row, col,
+                                       csession.total_consumption_kwh,
+                                       cells[col])
+            elif value == "rfid":
+                worksheet.write_string(row, col, csession.rfid, cells[col])
+            elif value == "kwh_price":
+                worksheet.write_number(row, col, kwh_price, cells[col])
+            else:
+                worksheet.write_number(row, col, costs, cells[col])
+        return costs
+
+    def write_total(self, worksheet, formats: dict, row: int,
+                    total_costs: float) -> None:
+        """Writes the total costs below the last charging session
+        :param worksheet: xlsxwriter Worksheet object
+        :param formats: formats of add_formats
+        :param row: zero based row index of the total row
+        :param total_costs: sum of the costs of all rows"""
+        values = [column.value for column in self.columns]
+        if "costs" not in values:
+            return
+        col = values.index("costs")
+        worksheet.write_string(row, max(col - 1, 0), TOTAL_LABEL,
+                               formats["total_label"])
+        worksheet.write_number(row, col, total_costs, formats["total"])
+
+
+def _date_properties(properties: dict) -> dict:
+    # the sample row holds the times as text, a date only format would hide the time
+    num_format = properties.get("num_format")
+    if num_format is None:
+        num_format = DATE_FORMAT
+    elif "h" not in num_format.lower():
+        num_format += " hh:mm"
+    return {**properties, "num_format": num_format}
+
+
+def parse_template(path: str) -> XlsxTemplate:
+    """Parse the layout of a template
+    :param path: path of the xlsx template
+    :return: XlsxTemplate object
+    :raises ValueError: if the template has an unknown column"""
+    import openpyxl
+    from openpyxl.utils import get_column_letter
+
+    worksheet = openpyxl.load_workbook(path).active
+    columns = []
+    for header in next(worksheet.iter_rows(min_row=1, max_row=1)):
+        if header.value is None:
+            continue
+        title = str(header.value).strip()
+        value = COLUMN_VALUES.get(" ".join(title.lower().split()))
+        if value is None:
+            raise ValueError(f"Unknown column {title!r} in {path}")
+        cell = format_properties(
+            worksheet.cell(row=2, column=header.column))
+        if value in ("start_time", "end_time"):
+            cell = _date_properties(cell)
+        letter = get_column_letter(header.column)
+        dimension = worksheet.column_dimensions.get(letter)
+        columns.append(
+            TemplateColumn(value=value,
+                           title=title,
+                           header=format_properties(header),
+                           cell=cell,
+                           width=dimension.width
+                           if dimension is not None and dimension.customWidth
+                           else None))
+    return XlsxTemplate(columns=tuple(columns))
+
+
+@functools.lru_cache(maxsize=None)
+def load_template(path: str = TEMPLATE_PATH) -> XlsxTemplate:
+    """Get the parsed layout of a template, parsed once per process
+    :param path: path of the xlsx template
+    :return: XlsxTemplate object"""
+    return parse_template(path)